@@ -1,103 +1,395 @@
-import boto3
 import json
 import os
 import sys
 import logging
-from dotenv import load_dotenv
+import logging.handlers
+import queue
+import atexit
+import copy
 import argparse
 import re
-from botocore.exceptions import BotoCoreError, ClientError
+import time
+import hashlib
+import sqlite3
+import threading
+import random
+import heapq
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+# boto3, botocore and dotenv are imported lazily where they are used to keep startup fast
 
-# Define supported model prefixes and their configurations
+from latency_stats import LatencyWindow
+
+# Define supported providers and how to build their requests and parse their responses.
+# The models themselves, their ID patterns and per-model defaults live in bedrock_models.json.
 MODEL_PREFIX_CONFIGURATIONS = [
     {
         "provider": "mistral",
-        "prefixes": [r"^mistral.*"],
-        "config_builder": lambda prompt, stop_sequences=None: {
+        "config_builder": lambda prompt, stop_sequences=None, max_tokens=256: {
             "prompt": prompt,
-            "max_tokens": 256,          
+            "max_tokens": max_tokens,
             "stop": stop_sequences if stop_sequences else [],
             "temperature": 0.7,         
             "top_p": 0.95,              
             "top_k": 40,                
         },
         "response_parser": lambda response_body: response_body.get("outputs", ""),
+        "stream_parser": lambda chunk: "".join(output.get("text", "") for output in chunk.get("outputs", [])),
         "api_type": "invoke_model",
     },
     {
         "provider": "amazon",
-        "prefixes": [r"^amazon.*"],
-        "config_builder": lambda prompt, stop_sequences=None: {
+        "config_builder": lambda prompt, stop_sequences=None, max_tokens=150: {
             "inputText": prompt,
             "textGenerationConfig": {
                 "temperature": 0.6,
                 "topP": 0.95,
-                "maxTokenCount": 150,
+                "maxTokenCount": max_tokens,
                 "stopSequences": stop_sequences if stop_sequences else []
             }
         },
         "response_parser": lambda response_body: response_body.get("results", [{}])[0].get("outputText", ""),
+        "stream_parser": lambda chunk: chunk.get("outputText", ""),
         "api_type": "invoke_model",
     },
     {
         "provider": "meta",
-        "prefixes": [r"^meta.*"],
-        "config_builder": lambda prompt, stop_sequences=None: {
+        "config_builder": lambda prompt, stop_sequences=None, max_tokens=512: {
             "prompt": prompt,
-            "max_gen_len": 512,
+            "max_gen_len": max_tokens,
             "temperature": 0.4,
             "top_p": 0.9,
         },
         "response_parser": lambda response_body: response_body.get("generation", ""),
+        "stream_parser": lambda chunk: chunk.get("generation", ""),
         "api_type": "invoke_model",
     },
     {
         "provider": "anthropic",
-        "prefixes": [r"^anthropic.*"],
-        "config_builder": lambda prompt, stop_sequences=None: {
+        "config_builder": lambda prompt, stop_sequences=None, max_tokens=200: {
             "prompt": f"\n\nHuman: {prompt}\n\nAssistant:",
             "temperature": 0.7,            
             "top_p": 0.9,                  
             "top_k": 50,                   
-            "max_tokens_to_sample": 200,   
+            "max_tokens_to_sample": max_tokens,
             "stop_sequences": stop_sequences if stop_sequences else []
         },
         "response_parser": lambda response_body: response_body.get("completion", "").strip(),
+        "stream_parser": lambda chunk: chunk.get("completion", ""),
         "api_type": "invoke_model",
     },
-    # Add more model configurations here as needed
+    {
+        "provider": "titan-embed",
+        # dimensions is only accepted by Titan Text Embeddings V2; V1 always returns 1536 values
+        "config_builder": lambda text, dimensions=None: (
+            {"inputText": text, "dimensions": dimensions, "normalize": True} if dimensions else {"inputText": text}
+        ),
+        "response_parser": lambda response_body: response_body.get("embedding"),
+        "stream_parser": None,
+        "api_type": "embedding",
+    },
+    # Add more provider configurations here as needed, then declare their models in bedrock_models.json
 ]
 
-def setup_logger(log_file_path="bedrock.log"):
+DEFAULT_MODELS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bedrock_models.json")
+
+# Per-model defaults that bedrock_models.json may set on a provider or on a single model
+MODEL_DEFAULT_KEYS = ("api_type", "max_tokens", "dimensions", "embed_dimensions", "prompt_caching", "context_tokens",
+                      "max_output_tokens", "temperature")
+
+# A pattern of the form ^literal.* is indexed in the prefix trie instead of being run as a regex
+LITERAL_PREFIX_PATTERN = re.compile(r"\^?((?:[\w:\-]|\\\.)+)\.\*\$?")
+
+class ModelRegistry:
+    """
+    Model registry loaded from a declarative JSON file (bedrock_models.json by default,
+    or BEDROCK_MODELS_FILE). At load time it builds a dispatch index of exact model IDs,
+    a prefix trie and precompiled regex fallbacks, each resolving to a provider
+    configuration merged with the per-model defaults (max_tokens, api_type).
+    The file is re-read when its modification time changes, so models can be added
+    without restarting a long-running process.
+    """
+
+    def __init__(self, path=None, reload_interval=2.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._index = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Loads the registry file and atomically swaps in the new index.
+        Raises OSError or ValueError if the file cannot be read or is invalid.
+        """
+        path = self.path or os.getenv("BEDROCK_MODELS_FILE") or DEFAULT_MODELS_FILE
+        with self._lock:
+            mtime = os.path.getmtime(path)
+            with open(path, 'r', encoding='utf-8') as registry_file:
+                declaration = json.load(registry_file)
+            self._index = self._build_index(declaration)
+            self._mtime = mtime
+            self._checked_at = time.monotonic()
+        logging.getLogger(__name__).info(
+            f"Loaded model registry from {path}: {len(self._index['models'])} models")
+
+    @staticmethod
+    def _build_index(declaration):
+        code_configs = {config["provider"]: config for config in MODEL_PREFIX_CONFIGURATIONS}
+        providers = {}
+        exact = {}
+        trie = {}
+        regexes = []
+        for provider, provider_declaration in declaration.get("providers", {}).items():
+            if provider not in code_configs:
+                raise ValueError(f"Provider '{provider}' has no entry in MODEL_PREFIX_CONFIGURATIONS.")
+            provider_config = dict(code_configs[provider])
+            for key in MODEL_DEFAULT_KEYS:
+                if key in provider_declaration:
+                    provider_config[key] = provider_declaration[key]
+            provider_config["display_name"] = provider_declaration.get("display_name", provider)
+            providers[provider] = provider_config
+            for pattern in provider_declaration.get("prefixes", []):
+                literal = LITERAL_PREFIX_PATTERN.fullmatch(pattern)
+                if literal:
+                    node = trie
+                    for char in literal.group(1).replace("\\.", "."):
+                        node = node.setdefault(char, {})
+                    node.setdefault(None, provider_config)
+                else:
+                    regexes.append((re.compile(pattern), provider_config))
+
+        models = []
+        for model in declaration.get("models", []):
+            if model.get("provider") not in providers:
+                raise ValueError(f"Model '{model.get('model_id')}' references an undeclared provider.")
+            model_config = dict(providers[model["provider"]])
+            for key in MODEL_DEFAULT_KEYS:
+                if key in model:
+                    model_config[key] = model[key]
+            exact[model["model_id"]] = model_config
+            models.append(model)
+        return {"providers": providers, "exact": exact, "trie": trie, "regexes": regexes, "models": models}
+
+    def _current_index(self):
+        if self._index is None:
+            self.load()
+        elif time.monotonic() - self._checked_at >= self.reload_interval:
+            self._checked_at = time.monotonic()
+            path = self.path or os.getenv("BEDROCK_MODELS_FILE") or DEFAULT_MODELS_FILE
+            try:
+                if os.path.getmtime(path) != self._mtime:
+                    self.load()
+            except (OSError, ValueError) as e:
+                # Keep serving the previous index if the edited file is missing or invalid
+                logging.getLogger(__name__).error(f"Failed to reload model registry from {path}: {e}")
+        return self._index
+
+    def lookup(self, model_id):
+        """
+        Returns the configuration for model_id: exact ID first, then the longest
+        matching prefix in the trie, then the regex fallbacks. Returns None if unknown.
+        """
+        index = self._current_index()
+        model_config = index["exact"].get(model_id)
+        if model_config is not None:
+            return model_config
+        node = index["trie"]
+        for char in model_id:
+            node = node.get(char)
+            if node is None:
+                break
+            model_config = node.get(None, model_config)
+        if model_config is not None:
+            return model_config
+        for pattern, provider_config in index["regexes"]:
+            if pattern.fullmatch(model_id):
+                return provider_config
+        return None
+
+    def models(self):
+        """
+        Returns the declared models as (display provider, name, version, model_id) tuples.
+        """
+        index = self._current_index()
+        return [
+            (index["providers"][model["provider"]]["display_name"], model["name"], model["version"], model["model_id"])
+            for model in index["models"]
+        ]
+
+MODEL_REGISTRY = ModelRegistry()
+
+# Error codes that reduce the AIMD concurrency limit and are retried with backoff
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+
+# Error codes worth retrying; anything else (validation, access denied, unknown model) fails fast
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    "ServiceUnavailableException", "InternalServerException", "ModelNotReadyException",
+    "ModelTimeoutException", "ModelStreamErrorException",
+}
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotating file handler that rolls over when the file reaches max_bytes or when
+    rotate_seconds have passed since the last rollover, whichever comes first.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count, rotate_seconds):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.rotate_seconds = rotate_seconds
+        self.rollover_at = time.time() + rotate_seconds if rotate_seconds else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rotate_seconds:
+            self.rollover_at = time.time() + self.rotate_seconds
+
+class BodyLogFilter(logging.Filter):
+    """
+    Truncates or samples the request/response body attached to a record through
+    extra={"body": ...}, before the record is queued. Records without a body pass unchanged.
+    """
+
+    def __init__(self, max_chars=2000, sample_rate=1.0):
+        super().__init__()
+        self.max_chars = max_chars
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        body = getattr(record, "body", None)
+        if body is None:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            record.body = None
+        elif self.max_chars and len(body) > self.max_chars:
+            record.body = f"{body[:self.max_chars]}... [truncated {len(body) - self.max_chars} chars]"
+        return True
+
+class BodyTextFormatter(logging.Formatter):
+    """
+    Plain-text formatter that appends the record's body, if any, to the message.
+    """
+
+    def format(self, record):
+        message = super().format(record)
+        body = getattr(record, "body", None)
+        return f"{message}: {body}" if body is not None else message
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    Formats each record as one JSON object per line.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        body = getattr(record, "body", None)
+        if body is not None:
+            entry["body"] = body
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+_traceback_formatter = logging.Formatter()
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks the request thread: records are dropped and counted
+    when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Merges the message arguments like QueueHandler.prepare, but keeps the traceback in
+        exc_text instead of folding it into the message, so the file formatter can still
+        render it (as the "exception" field in JSON logs).
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logger(log_file_path="bedrock.log", max_bytes=10 * 1024 * 1024, backup_count=5, rotate_seconds=86400,
+                 log_format="text", body_max_chars=2000, body_sample_rate=1.0, queue_size=10000):
     """
     Sets up the logger to log messages to a specified file.
     Does not log messages to the console.
+    Records are handed to a bounded queue and written by a background listener thread,
+    so file I/O never runs on the request thread. The file rotates by size and by age,
+    and request/response bodies are truncated or sampled before they are queued.
     """
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
-    # File handler
-    file_handler = logging.FileHandler(log_file_path)
-    file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', 
-                                       datefmt='%Y-%m-%d %H:%M:%S')
+    # Remove other handlers if any (e.g., StreamHandler)
+    for handler in list(logger.handlers):
+        if isinstance(handler, (logging.StreamHandler, logging.handlers.QueueHandler)):
+            logger.removeHandler(handler)
+
+    # File handler, driven by the background listener
+    file_handler = SizeAndTimeRotatingFileHandler(log_file_path, max_bytes, backup_count, rotate_seconds)
+    if log_format == "json":
+        file_formatter = JsonLogFormatter(datefmt='%Y-%m-%d %H:%M:%S')
+    else:
+        file_formatter = BodyTextFormatter('%(asctime)s - %(levelname)s - %(message)s',
+                                           datefmt='%Y-%m-%d %H:%M:%S')
     file_handler.setFormatter(file_formatter)
-    logger.addHandler(file_handler)
 
-    # Remove other handlers if any (e.g., StreamHandler)
-    if logger.hasHandlers():
-        for handler in logger.handlers:
-            if isinstance(handler, logging.StreamHandler):
-                logger.removeHandler(handler)
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    queue_handler.addFilter(BodyLogFilter(body_max_chars, body_sample_rate))
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    listener.start()
+
+    def stop_listener():
+        listener.stop()
+        if queue_handler.dropped:
+            file_handler.handle(logging.makeLogRecord({
+                "msg": f"Dropped {queue_handler.dropped} log records because the log queue was full.",
+                "levelno": logging.WARNING, "levelname": "WARNING"}))
+        file_handler.close()
 
+    atexit.register(stop_listener)
     return logger
 
 def load_environment(execution_dir, logger):
     """
     Loads environment variables from a .env file located in the execution directory or current directory.
+    Without a .env file, the process environment is used as-is when it already provides AWS_REGION,
+    so the script can be called from cron or other tools.
     """
     if execution_dir:
         dotenv_path = os.path.join(execution_dir, '.env')
         if os.path.isfile(dotenv_path):
+            from dotenv import load_dotenv
             load_dotenv(dotenv_path)
             logger.info(f"Loaded .env from {dotenv_path}")
         else:
@@ -106,12 +398,38 @@ def load_environment(execution_dir, logger):
     else:
         dotenv_path = '.env'
         if os.path.isfile(dotenv_path):
+            from dotenv import load_dotenv
             load_dotenv(dotenv_path)
             logger.info(f"Loaded .env from current directory: {dotenv_path}")
+        elif os.getenv('AWS_REGION'):
+            logger.info("No .env file found; using AWS settings from the process environment.")
         else:
             logger.error("EXECUTION_DIR not set and .env file not found in the current directory.")
             sys.exit(1)
 
+def get_region_pool(region):
+    """
+    Returns the regions to route between: AWS_REGION first, then any extra regions listed
+    in the comma-separated AWS_REGIONS variable.
+    """
+    regions = [region]
+    for extra_region in os.getenv('AWS_REGIONS', '').split(','):
+        extra_region = extra_region.strip()
+        if extra_region and extra_region not in regions:
+            regions.append(extra_region)
+    return regions
+
+def create_region_router(regions, logger, max_pool_connections=10, endpoint_url=None, hedge=True):
+    """
+    Returns a RegionRouter over one client per region, or None when only one region is configured.
+    """
+    if len(regions) < 2:
+        return None
+    clients = {region: create_bedrock_client(region, logger, max_pool_connections, endpoint_url)
+               for region in regions}
+    logger.info(f"Routing requests across regions: {', '.join(regions)} (hedging={'on' if hedge else 'off'})")
+    return RegionRouter(clients, logger, hedge=hedge)
+
 def get_env_variables(logger, args):
     """
     Retrieves AWS_REGION and STOP_SEQUENCES from environment variables.
@@ -139,149 +457,3125 @@ def find_model_configuration(model_id):
     """
     Finds and returns the model configuration based on the provided model_id.
     """
-    for model_config in MODEL_PREFIX_CONFIGURATIONS:
-        for prefix in model_config["prefixes"]:
-            if re.fullmatch(prefix, model_id):
-                return model_config
-    return None
+    return MODEL_REGISTRY.lookup(model_id)
 
-def invoke_model(client, model_config, model_id, prompt_text, logger, stop_sequences=None):
+class BedrockInvocationError(Exception):
     """
-    Invokes the Bedrock model using the appropriate API and parses the response.
-    Implements retries for transient errors.
+    Raised by invoke_model when exit_on_error is False and the invocation fails.
     """
-    api_type = model_config.get("api_type", "invoke_model")
 
-    if api_type == "invoke_model":
-        # Build the configuration based on the model
-        config = model_config["config_builder"](prompt_text, stop_sequences)
-    elif api_type == "messages":
-        # For Messages API, include system and user messages
-        config = model_config["config_builder"](prompt_text)
-    else:
-        logger.error(f"Unsupported API type: {api_type}")
+def _fail(logger, message, exit_on_error):
+    """
+    Logs an invocation error and either exits (interactive mode) or raises (batch mode).
+    """
+    logger.error(message)
+    if exit_on_error:
         sys.exit(1)
+    raise BedrockInvocationError(message)
 
-    config_json = json.dumps(config)
-    logger.info(f"Configuration Payload: {config_json}")
+def _botocore_exceptions():
+    """
+    Returns botocore.exceptions, importing it on first use so that loading this module
+    (e.g. from multi-cloud-ai for a client without Bedrock) does not need botocore.
+    """
+    import botocore.exceptions
+    return botocore.exceptions
 
-    try:
-        response = client.invoke_model(
-            body=config_json,
-            modelId=model_id,
-            accept="application/json",
-            contentType="application/json"
-        )
-        response_body = json.loads(response.get('body').read())
-        generation = model_config["response_parser"](response_body)
+def _aws_errors():
+    """
+    Returns the exception classes raised by boto3 calls, for except clauses.
+    """
+    exceptions = _botocore_exceptions()
+    return exceptions.BotoCoreError, exceptions.ClientError
 
-        if generation:
-            return generation
-        else:
-            logger.error("No generation found in the response.")
-            return None
-    except (BotoCoreError, ClientError) as e:
-        logger.error(f"An error occurred while invoking the model: {e}")
-        sys.exit(1)
-    except json.JSONDecodeError:
-        logger.error("Failed to decode the response body as JSON.")
+def _connection_errors():
+    """
+    Returns the botocore exceptions for failed connections and timeouts.
+    """
+    exceptions = _botocore_exceptions()
+    return exceptions.ConnectionError, exceptions.ReadTimeoutError, exceptions.ConnectTimeoutError
+
+_BOTO_SESSION = None
+_CLIENT_CACHE = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+def _get_boto_session():
+    """
+    Returns the process-wide boto3 session, creating it on first use. Reusing one session
+    keeps botocore's loaded service models and endpoint data for every later client.
+    """
+    global _BOTO_SESSION
+    if _BOTO_SESSION is None:
+        import boto3
+        _BOTO_SESSION = boto3.session.Session()
+    return _BOTO_SESSION
+
+def create_bedrock_client(region, logger, max_pool_connections=10, endpoint_url=None):
+    """
+    Creates a bedrock-runtime client whose connection pool is sized for the given concurrency.
+    boto3 clients are thread-safe, so a single client is shared by all batch workers, and
+    clients are cached per (region, pool size, endpoint) for the life of the process.
+    endpoint_url (or BEDROCK_ENDPOINT_URL) points the client at a local stand-in, e.g. for benchmarks.
+    """
+    from botocore.config import Config
+
+    endpoint_url = endpoint_url or os.getenv('BEDROCK_ENDPOINT_URL') or None
+    cache_key = (region, max_pool_connections, endpoint_url)
+    with _CLIENT_CACHE_LOCK:
+        if cache_key in _CLIENT_CACHE:
+            return _CLIENT_CACHE[cache_key]
+
+    client_config = Config(
+        region_name=region,
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=True,
+        connect_timeout=10,
+        read_timeout=120,
+        # Retries are handled by RetryEngine; botocore retrying as well would multiply attempts
+        retries={"total_max_attempts": 1, "mode": "standard"},
+    )
+    try:
+        with _CLIENT_CACHE_LOCK:
+            client = _CLIENT_CACHE.get(cache_key)
+            if client is None:
+                client = _get_boto_session().client(service_name='bedrock-runtime', config=client_config,
+                                                    endpoint_url=endpoint_url)
+                _CLIENT_CACHE[cache_key] = client
+        logger.info(f"Initialized Bedrock client for region: {region} (max_pool_connections={max_pool_connections})")
+        return client
+    except _aws_errors() as e:
+        logger.error(f"Failed to initialize Bedrock client: {e}")
         sys.exit(1)
-    except Exception as e:
-        logger.error(f"An unexpected error occurred: {e}")
+
+def create_aws_client(service_name, region, logger, endpoint_url=None, max_pool_connections=10):
+    """
+    Creates a client for the other AWS services used by batch-job mode (s3 and the bedrock
+    control plane). botocore's own adaptive retries are kept for these low-rate calls.
+    endpoint_url points the client at a local stand-in, e.g. moto for S3.
+    """
+    from botocore.config import Config
+
+    client_config = Config(
+        region_name=region,
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=True,
+        retries={"max_attempts": 5, "mode": "adaptive"},
+        # Local S3 stand-ins rarely resolve virtual-hosted bucket names
+        s3={"addressing_style": "path"} if endpoint_url else None,
+    )
+    try:
+        client = _get_boto_session().client(service_name=service_name, config=client_config,
+                                            endpoint_url=endpoint_url)
+        logger.info(f"Initialized {service_name} client for region: {region}")
+        return client
+    except _aws_errors() as e:
+        logger.error(f"Failed to initialize {service_name} client: {e}")
         sys.exit(1)
 
-def parse_arguments():
+# Named priority classes; lower rank is dispatched first. Only "interactive" may use reserved slots.
+PRIORITY_CLASSES = {"interactive": 0, "default": 1, "bulk": 2}
+
+class DeadlineExceededError(Exception):
     """
-    Parses command-line arguments for log file path and execution directory.
+    Raised by PriorityScheduler when a queued request has already missed its deadline.
     """
-    parser = argparse.ArgumentParser(description="Invoke Bedrock model with a fixed prompt.")
-    parser.add_argument('--log', type=str, default="bedrock.log",
-                        help='Path to the log file.')
-    parser.add_argument('--execution_dir', type=str, default=None,
-                        help='Directory containing the .env file.')
-    return parser.parse_args()
 
-def display_model_selection(logger):
+class PriorityScheduler:
     """
-    Displays the model selection menu and returns the selected model_id.
+    Admission scheduler shared by all callers of one bedrock-runtime client.
+    Requests wait in per-class queues and are dispatched by class rank, then by weighted
+    fair queuing across tenants within a class. reserved_interactive slots are kept free
+    for the interactive class, so bulk jobs can never take the whole capacity.
+    Requests whose deadline has passed are dropped instead of being sent.
     """
-    print("----------------------------------------")
-    print("Choose the model to deploy:")
-    print("----------------------------------------")
 
-    # Define the list of available models with their IDs
-    models = [
-        "Amazon|Titan Text G1 - Express|1.x|amazon.titan-text-express-v1",
-        "Amazon|Titan Text G1 - Lite|1.x|amazon.titan-text-lite-v1",
-        "Anthropic|Claude|2.0|anthropic.claude-v2",
-        "Anthropic|Claude|2.1|anthropic.claude-v2:1",
-        "Anthropic|Claude Instant|1.x|anthropic.claude-instant-v1",
-        "Meta|Llama 3 8B Instruct|1.x|meta.llama3-8b-instruct-v1:0",
-        "Meta|Llama 3 70B Instruct|1.x|meta.llama3-70b-instruct-v1:0",
-        "Meta|Llama 3.1 8B Instruct|1.x|meta.llama3-1-8b-instruct-v1:0",
-        "Mistral AI|Mistral 7B Instruct|0.x|mistral.mistral-7b-instruct-v0:2",
-        "Mistral AI|Mixtral 8X7B Instruct|0.x|mistral.mixtral-8x7b-instruct-v0:1",
-        "Mistral AI|Mistral Large|1.x|mistral.mistral-large-2402-v1:0"
-    ]
+    def __init__(self, logger, capacity=16, reserved_interactive=2, tenant_weights=None):
+        if reserved_interactive >= capacity:
+            raise ValueError("reserved_interactive must be smaller than capacity.")
+        self.logger = logger
+        self.capacity = capacity
+        self.reserved_interactive = reserved_interactive
+        self.tenant_weights = tenant_weights or {}
+        self.running = 0
+        self.dropped = 0
+        self._queues = {priority: [] for priority in PRIORITY_CLASSES}
+        self._virtual_time = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        self._tenant_finish = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
 
-    # Display the models with numbering
-    for index, model in enumerate(models, start=1):
-        provider, model_name, version, model_id = model.split("|")
-        print(f"{index}. {provider} - {model_name} (Version: {version})")
+    def _enqueue(self, priority, tenant, deadline):
+        weight = self.tenant_weights.get(tenant, 1.0)
+        start = max(self._virtual_time[priority], self._tenant_finish.get((priority, tenant), 0.0))
+        finish = start + 1.0 / weight
+        self._tenant_finish[(priority, tenant)] = finish
+        ticket = {"event": threading.Event(), "deadline": deadline, "admitted": False, "cancelled": False,
+                  "released": False, "finish": finish}
+        heapq.heappush(self._queues[priority], (finish, next(self._sequence), ticket))
+        return ticket
 
-    # Prompt the user for selection
-    while True:
+    def _dispatch(self):
+        now = time.monotonic()
+        for priority in sorted(PRIORITY_CLASSES, key=PRIORITY_CLASSES.get):
+            limit = self.capacity if priority == "interactive" else self.capacity - self.reserved_interactive
+            queue = self._queues[priority]
+            while queue and self.running < limit:
+                _, _, ticket = heapq.heappop(queue)
+                if ticket["cancelled"]:
+                    continue
+                self._virtual_time[priority] = ticket["finish"]
+                if ticket["deadline"] is not None and ticket["deadline"] <= now:
+                    ticket["cancelled"] = True
+                    self.dropped += 1
+                else:
+                    ticket["admitted"] = True
+                    self.running += 1
+                ticket["event"].set()
+
+    def acquire(self, priority="interactive", tenant="default", deadline=None):
+        """
+        Waits for a slot for the given priority class and tenant and returns the function that
+        gives it back; calling that function more than once has no further effect.
+        deadline is an absolute time.monotonic() value; DeadlineExceededError is raised
+        if it passes before the request is dispatched.
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {priority}")
+        with self._lock:
+            ticket = self._enqueue(priority, tenant, deadline)
+            self._dispatch()
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not ticket["event"].wait(timeout):
+            with self._lock:
+                if not ticket["admitted"]:
+                    ticket["cancelled"] = True
+                    self.dropped += 1
+        if not ticket["admitted"]:
+            raise DeadlineExceededError(f"Dropped {priority} request for tenant '{tenant}': deadline exceeded.")
+
+        def release():
+            with self._lock:
+                if ticket["released"]:
+                    return
+                ticket["released"] = True
+                self.running -= 1
+                self._dispatch()
+        return release
+
+    def call(self, operation, priority="interactive", tenant="default", deadline=None):
+        """
+        Waits for a slot for the given priority class and tenant, then runs operation().
+        """
+        release = self.acquire(priority, tenant, deadline)
         try:
-            model_choice = int(input("Enter the number corresponding to the model:"))
-            if 1 <= model_choice <= len(models):
-                selected_model = models[model_choice - 1]
-                provider, model_name, version, model_id = selected_model.split("|")
-                logger.info(f"Selected Model: {provider} - {model_name} (Version: {version})")
-                logger.info(f"Model ID set to: {model_id}")
+            return operation()
+        finally:
+            release()
 
-                # Confirmation message to the user
-                print("----------------------------------------------------------------")
-                print(f"Selected Model: {provider} - {model_name} (Version: {version})")
-                return model_id
+class TokenBucket:
+    """
+    Thread-safe token bucket that limits the request rate for one model.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then takes it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AIMDLimiter:
+    """
+    Concurrency limiter using additive increase / multiplicative decrease:
+    the limit grows by one per limit-worth of successes and halves on throttling.
+    """
+
+    def __init__(self, max_limit, initial_limit=None, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max_limit)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit / 2)
             else:
-                print("Invalid choice. Please select a valid number from the list.")
-        except ValueError:
-            print("Invalid input. Please enter a number.")
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
 
-def main():
-    args = parse_arguments()
-    logger = setup_logger(args.log)
+class RetryEngine:
+    """
+    Retry and rate-control layer for Bedrock calls. Each model gets its own token bucket
+    (when a rate is set) and AIMD concurrency limiter. Transient errors are retried with
+    full-jitter exponential backoff while the shared retry budget allows it; throttling
+    also halves the model's concurrency. Non-retryable errors are raised immediately.
+    """
 
-    load_environment(args.execution_dir, logger)
-    region, stop_sequences = get_env_variables(logger, args)
+    def __init__(self, logger, max_retries=4, base_delay=0.5, max_delay=20.0, rate=0, max_concurrency=16,
+                 retry_budget_ratio=0.2, min_retry_budget=10):
+        self.logger = logger
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.retry_budget_ratio = retry_budget_ratio
+        # The budget starts with min_retry_budget tokens and earns retry_budget_ratio per success
+        self.retry_budget = float(min_retry_budget)
+        self.max_retry_budget = float(max(min_retry_budget, max_concurrency))
+        self._buckets = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
 
-    # Model Selection
-    model_id = display_model_selection(logger)
+    def _model_controls(self, model_id):
+        with self._lock:
+            if model_id not in self._limiters:
+                self._limiters[model_id] = AIMDLimiter(self.max_concurrency)
+                if self.rate > 0:
+                    self._buckets[model_id] = TokenBucket(self.rate, max(1.0, self.rate))
+            return self._buckets.get(model_id), self._limiters[model_id]
 
-    # Initialize Bedrock client
-    try:
-        client = boto3.client(service_name='bedrock-runtime', region_name=region)
-        logger.info(f"Initialized Bedrock client for region: {region}")
-    except (BotoCoreError, ClientError) as e:
-        logger.error(f"Failed to initialize Bedrock client: {e}")
-        sys.exit(1)
+    @staticmethod
+    def classify(error):
+        """
+        Returns (retryable, throttled) for an exception raised by a Bedrock call.
+        """
+        if isinstance(error, _botocore_exceptions().ClientError):
+            code = error.response.get("Error", {}).get("Code", "")
+            return code in RETRYABLE_ERROR_CODES, code in THROTTLING_ERROR_CODES
+        if isinstance(error, _connection_errors()):
+            return True, False
+        return False, False
 
-    # Fixed Prompt Handling
-    prompt_text = "Siapa presiden ke-4 Indonesia?"
+    def _spend_retry(self):
+        with self._lock:
+            if self.retry_budget < 1:
+                return False
+            self.retry_budget -= 1
+            return True
 
-    # Log the fixed prompt
-    logger.info(f"Using fixed prompt: {prompt_text}")
+    def _earn_retry(self):
+        with self._lock:
+            self.retry_budget = min(self.max_retry_budget, self.retry_budget + self.retry_budget_ratio)
 
-    # Find the model configuration based on model_id
-    model_config = find_model_configuration(model_id)
-    if not model_config:
-        logger.error(f"Unsupported model_id: {model_id}. Please update the MODEL_PREFIX_CONFIGURATIONS.")
+    def call(self, model_id, operation, admit=None, hold=False):
+        """
+        Runs operation() under the model's rate and concurrency limits, retrying transient errors.
+        admit, if given, is called at the start of every attempt, before the rate and concurrency
+        slots are taken, and returns the function that ends that admission (see
+        PriorityScheduler.acquire). Requests still waiting for admission therefore hold none of
+        the model's slots. With hold=True the admission of the successful attempt is kept and
+        (result, release) is returned instead of the result.
+        """
+        bucket, limiter = self._model_controls(model_id)
+        attempt = 0
+        while True:
+            release = admit() if admit is not None else _release_nothing
+            keep_admission = False
+            try:
+                if bucket is not None:
+                    bucket.acquire()
+                limiter.acquire()
+                throttled = False
+                try:
+                    result = operation()
+                except _aws_errors() as e:
+                    retryable, throttled = self.classify(e)
+                    if not retryable:
+                        raise
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        self.logger.error(f"Giving up on {model_id} after {self.max_retries} retries: {e}")
+                        raise
+                    if not self._spend_retry():
+                        self.logger.error(f"Retry budget exhausted; not retrying {model_id}: {e}")
+                        raise
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+                    self.logger.warning(f"Transient error from {model_id} (attempt {attempt}/{self.max_retries}), "
+                                        f"retrying in {delay:.2f}s: {e}")
+                else:
+                    self._earn_retry()
+                    keep_admission = hold
+                    return (result, release) if hold else result
+                finally:
+                    limiter.release(throttled)
+            finally:
+                if not keep_admission:
+                    release()
+            time.sleep(delay)
+
+def request_key(model_id, config_json):
+    """
+    Returns a stable hash identifying a model and its exact request payload.
+    """
+    return hashlib.sha256(f"{model_id}\n{config_json}".encode("utf-8")).hexdigest()
+
+class RequestCoalescer:
+    """
+    Single-flight layer for identical in-flight requests (same modelId + config_json).
+    The first caller makes the upstream call; callers arriving while it is in flight wait
+    for and share its result or exception. Streams are pumped by one background thread
+    into a shared buffer, so every subscriber receives every delta from the beginning.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.coalesced = 0
+        self._calls = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, operation):
+        """
+        Returns operation()'s result, sharing one upstream call among concurrent callers with the same key.
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = flight
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                flight["result"] = operation()
+            except BaseException as e:
+                flight["error"] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                flight["done"].set()
+        else:
+            flight["done"].wait()
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["result"]
+
+    def stream(self, key, open_stream):
+        """
+        Yields the deltas of open_stream(), sharing one upstream stream among concurrent subscribers.
+        """
+        with self._lock:
+            flight = self._streams.get(key)
+            if flight is None:
+                flight = {"deltas": [], "done": False, "error": None, "changed": threading.Condition(self._lock)}
+                self._streams[key] = flight
+                threading.Thread(target=self._pump, args=(key, flight, open_stream), daemon=True).start()
+            else:
+                self.coalesced += 1
+        position = 0
+        while True:
+            with self._lock:
+                while position >= len(flight["deltas"]) and not flight["done"]:
+                    flight["changed"].wait()
+                pending = flight["deltas"][position:]
+                finished = flight["done"]
+            for delta in pending:
+                yield delta
+            position += len(pending)
+            if finished and position >= len(flight["deltas"]):
+                break
+        if flight["error"] is not None:
+            raise flight["error"]
+
+    def _pump(self, key, flight, open_stream):
+        try:
+            for delta in open_stream():
+                with self._lock:
+                    flight["deltas"].append(delta)
+                    flight["changed"].notify_all()
+        except BaseException as e:
+            flight["error"] = e
+        finally:
+            with self._lock:
+                # New subscribers from here on start a fresh upstream call
+                del self._streams[key]
+                flight["done"] = True
+                flight["changed"].notify_all()
+
+class _Countdown:
+    """
+    Calls callback once done() has been called count times, from whichever thread is last.
+    """
+
+    def __init__(self, count, callback):
+        self._remaining = count
+        self._callback = callback
+        self._lock = threading.Lock()
+
+    def done(self, *_):
+        with self._lock:
+            self._remaining -= 1
+            last = self._remaining == 0
+        if last:
+            self._callback()
+
+# Error codes after which the next region is tried: transient errors plus a model that is
+# not enabled or not available in the region
+REGION_FAILOVER_ERROR_CODES = RETRYABLE_ERROR_CODES | {"AccessDeniedException", "ResourceNotFoundException"}
+
+class RegionRouter:
+    """
+    Routes each request to the healthiest region in a pool of bedrock-runtime clients.
+    Per region and model it tracks an EWMA of latency and of the error rate, plus recent
+    latencies for a p95 estimate. Regions are tried in order of health, failing over on
+    transient or region-specific errors. When hedging is enabled and the first region has
+    not answered within its p95, the same request is also sent to the next region and
+    the first successful answer wins. A small share of requests (explore) goes to another
+    region first, so a region that recovers gets measured again.
+    """
+
+    def __init__(self, clients, logger, hedge=True, alpha=0.2, min_hedge_samples=20, max_hedge_workers=64,
+                 explore=0.05):
+        self.clients = clients
+        self.regions = list(clients)
+        self.logger = logger
+        self.hedge = hedge and len(self.regions) > 1
+        self.alpha = alpha
+        self.min_hedge_samples = min_hedge_samples
+        self.explore = explore
+        self.hedged = 0
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_hedge_workers, thread_name_prefix="region-hedge")
+
+    def _region_stats(self, region, model_id):
+        key = (region, model_id)
+        if key not in self._stats:
+            self._stats[key] = {"latency": None, "error_rate": 0.0,
+                                "samples": LatencyWindow(maxlen=200, min_samples=self.min_hedge_samples)}
+        return self._stats[key]
+
+    def record(self, region, model_id, latency, failed):
+        """
+        Updates the EWMA latency and error rate of a region for a model.
+        """
+        with self._lock:
+            stats = self._region_stats(region, model_id)
+            stats["error_rate"] = self.alpha * (1.0 if failed else 0.0) + (1 - self.alpha) * stats["error_rate"]
+            if not failed:
+                previous = stats["latency"]
+                stats["latency"] = latency if previous is None else self.alpha * latency + (1 - self.alpha) * previous
+                stats["samples"].add(latency)
+
+    def ranked_regions(self, model_id):
+        """
+        Returns the regions ordered from healthiest to least healthy for model_id.
+        Regions that have not been tried sort first so they get explored; regions that have
+        only failed so far sort last, by error rate, and are retried through explore.
+        """
+        with self._lock:
+            def score(region):
+                stats = self._region_stats(region, model_id)
+                if stats["latency"] is None:
+                    return (0, 0.0) if stats["error_rate"] == 0 else (2, stats["error_rate"])
+                return (1, stats["latency"] * (1 + 10 * stats["error_rate"]))
+            regions = sorted(self.regions, key=score)
+        if len(regions) > 1 and random.random() < self.explore:
+            explored = random.randrange(1, len(regions))
+            regions[0], regions[explored] = regions[explored], regions[0]
+        return regions
+
+    def hedge_delay(self, region, model_id):
+        """
+        Returns the p95 latency of a region for a model, or None until enough samples exist.
+        """
+        with self._lock:
+            samples = self._region_stats(region, model_id)["samples"]
+        return samples.hedge_delay()
+
+    def _timed(self, region, model_id, operation):
+        started = time.perf_counter()
+        try:
+            result = operation(self.clients[region])
+        except Exception:
+            self.record(region, model_id, time.perf_counter() - started, True)
+            raise
+        self.record(region, model_id, time.perf_counter() - started, False)
+        return result
+
+    @staticmethod
+    def _should_fail_over(error):
+        if isinstance(error, _botocore_exceptions().ClientError):
+            return error.response.get("Error", {}).get("Code", "") in REGION_FAILOVER_ERROR_CODES
+        return isinstance(error, _connection_errors())
+
+    def call(self, model_id, operation, hedge=True, on_settled=None):
+        """
+        Runs operation(client) against the healthiest region, failing over and hedging as needed.
+        Raises the last error if every region failed. on_settled, if given, is called once every
+        upstream call started for this request has finished; for a hedged request that can be
+        after the winner's result has been returned, while the losing call is still running.
+        """
+        pending = {}
+        try:
+            return self._call_regions(model_id, operation, hedge, pending)
+        finally:
+            if on_settled is not None:
+                settled = _Countdown(len(pending) + 1, on_settled)
+                for future in pending:
+                    future.add_done_callback(settled.done)
+                settled.done()
+
+    def _call_regions(self, model_id, operation, hedge, pending):
+        """
+        The body of call(). Futures still running when it returns or raises are left in pending.
+        """
+        regions = self.ranked_regions(model_id)
+        last_error = None
+        index = 0
+        while index < len(regions):
+            region = regions[index]
+            index += 1
+            if not (hedge and self.hedge):
+                try:
+                    return self._timed(region, model_id, operation)
+                except _aws_errors() as e:
+                    if not self._should_fail_over(e):
+                        raise
+                    last_error = e
+                    self.logger.warning(f"Region {region} failed for {model_id}, failing over: {e}")
+                    continue
+
+            pending[self._executor.submit(self._timed, region, model_id, operation)] = region
+            delay = self.hedge_delay(region, model_id)
+            while pending:
+                can_hedge = index < len(regions) and len(pending) == 1
+                done, _ = wait(pending, timeout=delay if can_hedge else None, return_when=FIRST_COMPLETED)
+                if not done:
+                    # The request is slower than this region's p95: hedge to the next region
+                    hedge_region = regions[index]
+                    index += 1
+                    with self._lock:
+                        self.hedged += 1
+                    self.logger.info(f"Hedging {model_id} request from {region} to {hedge_region}")
+                    pending[self._executor.submit(self._timed, hedge_region, model_id, operation)] = hedge_region
+                    continue
+                for future in done:
+                    failed_region = pending.pop(future)
+                    try:
+                        return future.result()
+                    except _aws_errors() as e:
+                        if not self._should_fail_over(e):
+                            raise
+                        last_error = e
+                        self.logger.warning(f"Region {failed_region} failed for {model_id}, failing over: {e}")
+        raise last_error
+
+    def snapshot(self):
+        """
+        Returns the current per-region, per-model health for logging.
+        """
+        with self._lock:
+            return {f"{region}/{model_id}": {"ewma_latency_ms": round(stats["latency"] * 1000, 1)
+                                              if stats["latency"] is not None else None,
+                                              "error_rate": round(stats["error_rate"], 3)}
+                    for (region, model_id), stats in self._stats.items()}
+
+# Prometheus metric names, types and help text exposed by BedrockMetrics
+METRIC_DEFINITIONS = {
+    "bedrock_requests_total": ("counter", "Upstream Bedrock requests by outcome."),
+    "bedrock_errors_total": ("counter", "Upstream Bedrock errors by error code."),
+    "bedrock_throttles_total": ("counter", "Upstream Bedrock requests rejected by throttling."),
+    "bedrock_request_duration_seconds": ("histogram", "Time from sending a request to reading the full response."),
+    "bedrock_time_to_first_byte_seconds": ("histogram", "Time from sending a request to the first response bytes."),
+    "bedrock_input_tokens_total": ("counter", "Input tokens reported by Bedrock."),
+    "bedrock_output_tokens_total": ("counter", "Output tokens reported by Bedrock."),
+    "bedrock_in_flight_requests": ("gauge", "Upstream Bedrock requests currently in flight."),
+    "bedrock_semantic_cache_requests_total": ("counter", "Semantic cache lookups by result (hit or miss)."),
+}
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class BedrockMetrics:
+    """
+    Thread-safe counters, gauges and histograms for upstream Bedrock calls, labelled by
+    model_id and provider, rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, value=1):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def record_tokens(self, labels, input_tokens, output_tokens):
+        """
+        Adds token counts when Bedrock reported them.
+        """
+        if input_tokens is not None:
+            self.inc("bedrock_input_tokens_total", labels, int(input_tokens))
+        if output_tokens is not None:
+            self.inc("bedrock_output_tokens_total", labels, int(output_tokens))
+
+    def record_error(self, labels, error):
+        """
+        Counts a failed upstream request by error code, and as a throttle when it was one.
+        """
+        code = _error_code(error)
+        self.inc("bedrock_requests_total", dict(labels, status="error"))
+        self.inc("bedrock_errors_total", dict(labels, code=code))
+        if code in THROTTLING_ERROR_CODES:
+            self.inc("bedrock_throttles_total", labels)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                   for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    @staticmethod
+    def _format_value(value):
+        """
+        Formats a sample value without losing precision: integers exactly, floats by their
+        shortest round-tripping repr, and infinities and NaN as Prometheus spells them.
+        """
+        if isinstance(value, float):
+            if value != value:
+                return "NaN"
+            if value in (float("inf"), float("-inf")):
+                return "+Inf" if value > 0 else "-Inf"
+            return repr(value)
+        return str(value)
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                          for key, h in self._histograms.items()}
+        lines = []
+        for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for (metric_name, labels), histogram in sorted(histograms.items()):
+                    if metric_name != name:
+                        continue
+                    for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                        lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {self._format_value(histogram['sum'])}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {histogram['count']}")
+            else:
+                for (metric_name, labels), value in sorted(values.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {self._format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        """
+        Atomically writes the metrics to path, e.g. for the node_exporter textfile collector.
+        """
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(temporary_path, path)
+
+def start_metrics_file_writer(metrics, path, logger, interval=15.0):
+    """
+    Rewrites the metrics file every interval seconds in the background and once more at exit.
+    """
+    def write():
+        try:
+            metrics.write_file(path)
+        except OSError as e:
+            logger.error(f"Failed to write metrics file {path}: {e}")
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            write()
+
+    threading.Thread(target=loop, name="metrics-writer", daemon=True).start()
+    atexit.register(write)
+    logger.info(f"Writing Prometheus metrics to {path} every {interval:g}s")
+
+class ResponseCache:
+    """
+    Two-tier cache of raw Bedrock response bodies keyed on modelId + request payload.
+    Tier 1 is a bounded in-memory LRU; tier 2 is an optional SQLite file with a TTL
+    that is shared by repeated runs and concurrent processes.
+    Payloads with temperature > 0 are only cached when allow_nondeterministic is set.
+    """
+
+    def __init__(self, logger, db_path=None, max_entries=1024, ttl_seconds=86400, allow_nondeterministic=False):
+        self.logger = logger
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.allow_nondeterministic = allow_nondeterministic
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            # One connection guarded by the lock; WAL lets other processes read while we write
+            self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "cache_key TEXT PRIMARY KEY, body TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - ttl_seconds,))
+            self._db.commit()
+            logger.info(f"Opened response cache at {db_path} (ttl={ttl_seconds}s, memory_entries={max_entries})")
+
+    @staticmethod
+    def make_key(model_id, config_json):
+        """
+        Returns the cache key for a model and its exact request payload.
+        """
+        return request_key(model_id, config_json)
+
+    def is_cacheable(self, config):
+        """
+        Returns True if the payload is deterministic or nondeterministic caching is enabled.
+        """
+        if self.allow_nondeterministic:
+            return True
+        generation_config = config.get("textGenerationConfig") or config.get("inferenceConfig") or config
+        return not generation_config.get("temperature", 0)
+
+    def get(self, cache_key):
+        """
+        Returns the cached response body for cache_key, or None on a miss or expired entry.
+        """
+        with self._lock:
+            body = self._memory.get(cache_key)
+            if body is not None:
+                self._memory.move_to_end(cache_key)
+                self.hits["memory"] += 1
+                return body
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT body FROM responses WHERE cache_key = ? AND created_at >= ?",
+                    (cache_key, time.time() - self.ttl_seconds)
+                ).fetchone()
+                if row:
+                    self._remember(cache_key, row[0])
+                    self.hits["disk"] += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, cache_key, body):
+        """
+        Stores a response body in both tiers.
+        """
+        with self._lock:
+            self._remember(cache_key, body)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (cache_key, body, created_at) VALUES (?, ?, ?)",
+                    (cache_key, body, time.time())
+                )
+                self._db.commit()
+
+    def _remember(self, cache_key, body):
+        self._memory[cache_key] = body
+        self._memory.move_to_end(cache_key)
+        if len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        """
+        Logs hit/miss counts and closes the SQLite tier.
+        """
+        self.logger.info(f"Response cache stats: memory_hits={self.hits['memory']}, "
+                         f"disk_hits={self.hits['disk']}, misses={self.misses}")
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+class SemanticCache:
+    """
+    In-memory cache of generations keyed on prompt meaning rather than exact payload.
+    Prompts are embedded with an embedding model; each partition (model, stop sequences and
+    max_tokens) keeps its unit-normalized embeddings in one contiguous float32 NumPy matrix,
+    so a lookup is a single matrix-vector product. A cached generation is returned when the
+    cosine similarity of the closest prompt reaches threshold. When a partition is full, the
+    least recently used (policy="lru") or least frequently used (policy="lfu") row is replaced.
+    Raises ImportError if NumPy is not installed.
+    """
+
+    def __init__(self, logger, embed, threshold=0.95, max_entries=10000, policy="lru"):
+        import numpy as np
+
+        self._np = np
+        self.logger = logger
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.policy = policy
+        self.hits = self.misses = self.evictions = self.embed_errors = 0
+        self._partitions = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def partition_key(model_id, model_config, stop_sequences, prefix=None):
+        """
+        Returns the partition for a request; only prompts in the same partition can match.
+        prefix holds anything sent ahead of the prompt (system prompt, context, earlier turns).
+        """
+        prefix_key = request_key(model_id, json.dumps(prefix)) if prefix else None
+        return model_id, tuple(stop_sequences or ()), model_config.get("max_tokens"), prefix_key
+
+    def _new_partition(self, dimensions):
+        capacity = min(self.max_entries, 256)
+        return {
+            "matrix": self._np.zeros((capacity, dimensions), dtype=self._np.float32),
+            "last_used": self._np.zeros(capacity, dtype=self._np.int64),
+            "uses": self._np.zeros(capacity, dtype=self._np.int64),
+            "generations": [None] * capacity,
+            "size": 0,
+        }
+
+    def _grow(self, partition):
+        capacity = min(self.max_entries, len(partition["generations"]) * 2)
+        for name in ("matrix", "last_used", "uses"):
+            grown = self._np.zeros((capacity,) + partition[name].shape[1:], dtype=partition[name].dtype)
+            grown[:partition["size"]] = partition[name][:partition["size"]]
+            partition[name] = grown
+        partition["generations"].extend([None] * (capacity - len(partition["generations"])))
+
+    def _best_match(self, partition, vector):
+        if partition is None or partition["size"] == 0:
+            return None, -1.0
+        similarities = partition["matrix"][:partition["size"]] @ vector
+        row = int(similarities.argmax())
+        return row, float(similarities[row])
+
+    def lookup(self, partition_key, prompt_text):
+        """
+        Returns (generation, vector). generation is None on a miss; vector is the prompt
+        embedding to pass to put, or None if embedding failed (the request then bypasses the cache).
+        """
+        try:
+            embedding = self.embed(prompt_text)
+        except (BedrockInvocationError, ValueError) as e:
+            with self._lock:
+                self.embed_errors += 1
+            self.logger.warning(f"Semantic cache bypassed, embedding failed: {e}")
+            return None, None
+        if not embedding:
+            return None, None
+        vector = self._np.asarray(embedding, dtype=self._np.float32)
+        norm = self._np.linalg.norm(vector)
+        if norm == 0:
+            return None, None
+        vector /= norm
+
+        with self._lock:
+            partition = self._partitions.get(partition_key)
+            if partition is not None and partition["matrix"].shape[1] != vector.shape[0]:
+                return None, None
+            row, similarity = self._best_match(partition, vector)
+            if row is not None and similarity >= self.threshold:
+                self._clock += 1
+                partition["last_used"][row] = self._clock
+                partition["uses"][row] += 1
+                self.hits += 1
+                self.logger.info(f"Semantic cache hit for {partition_key[0]} (similarity={similarity:.4f})")
+                return partition["generations"][row], vector
+            self.misses += 1
+            return None, vector
+
+    def put(self, partition_key, vector, generation):
+        """
+        Stores a generation under its prompt embedding, evicting a row if the partition is full.
+        Skipped if an equivalent prompt was stored meanwhile, e.g. by a concurrent request.
+        """
+        if vector is None or not generation:
+            return
+        with self._lock:
+            partition = self._partitions.get(partition_key)
+            if partition is None:
+                partition = self._partitions[partition_key] = self._new_partition(vector.shape[0])
+            elif partition["matrix"].shape[1] != vector.shape[0]:
+                return
+            if self._best_match(partition, vector)[1] >= self.threshold:
+                return
+            if partition["size"] == len(partition["generations"]) and partition["size"] < self.max_entries:
+                self._grow(partition)
+            if partition["size"] < len(partition["generations"]):
+                row = partition["size"]
+                partition["size"] += 1
+            else:
+                size = partition["size"]
+                if self.policy == "lfu":
+                    # Fewest uses first; ties go to the least recently used row
+                    row = int(self._np.lexsort((partition["last_used"][:size], partition["uses"][:size]))[0])
+                else:
+                    row = int(partition["last_used"][:size].argmin())
+                self.evictions += 1
+            self._clock += 1
+            partition["matrix"][row] = vector
+            partition["last_used"][row] = self._clock
+            partition["uses"][row] = 0
+            partition["generations"][row] = generation
+
+    def stats(self):
+        """
+        Returns hit, miss, eviction and size counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "embed_errors": self.embed_errors,
+                "entries": sum(partition["size"] for partition in self._partitions.values()),
+            }
+
+def create_semantic_cache(logger, get_client, embed_model_id, threshold=0.95, max_entries=10000, policy="lru",
+                          retry=None, metrics=None):
+    """
+    Builds a SemanticCache that embeds prompts with embed_model_id through invoke_model.
+    get_client returns the bedrock-runtime client for each embedding call. Exits if the model
+    is not a registered embedding model or NumPy is not installed.
+    """
+    embed_config = find_model_configuration(embed_model_id)
+    if not embed_config or embed_config.get("api_type") != "embedding":
+        logger.error(f"--semantic-cache-model {embed_model_id} is not a registered embedding model.")
+        sys.exit(1)
+    embed = lambda text: invoke_model(get_client(), embed_config, embed_model_id, text, logger, exit_on_error=False,
+                                      retry=retry, metrics=metrics)
+    try:
+        semantic_cache = SemanticCache(logger, embed, threshold, max_entries, policy)
+    except ImportError:
+        logger.error("--semantic-cache requires NumPy. Install it with: pip install numpy")
         sys.exit(1)
+    logger.info(f"Semantic cache enabled: model={embed_model_id}, threshold={threshold}, "
+                f"max_entries={max_entries}, policy={policy}")
+    return semantic_cache
 
-    # Log which provider is being used
-    logger.info(f"Using provider: {model_config['provider']}")
+def _error_code(error):
+    """
+    Returns the AWS error code of a ClientError, or the exception class name otherwise.
+    """
+    if isinstance(error, _botocore_exceptions().ClientError):
+        return error.response.get("Error", {}).get("Code", "") or type(error).__name__
+    return type(error).__name__
+
+def _call_invoke_model(client, model_id, config_json, metrics=None, provider=None):
+    """
+    Sends one invoke_model request and returns the raw response body as a string.
+    When BedrockMetrics is given, records latency, time to first byte, token counts
+    from the response headers, errors and in-flight requests for this attempt.
+    """
+    if metrics is None:
+        response = client.invoke_model(
+            body=config_json,
+            modelId=model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+        return response.get('body').read().decode("utf-8")
+
+    labels = {"model_id": model_id, "provider": provider}
+    metrics.inc("bedrock_in_flight_requests", labels)
+    started = time.perf_counter()
+    try:
+        response = client.invoke_model(
+            body=config_json,
+            modelId=model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+        # invoke_model returns once the response headers arrive; the body is read afterwards
+        metrics.observe("bedrock_time_to_first_byte_seconds", labels, time.perf_counter() - started)
+        raw_body = response.get('body').read().decode("utf-8")
+    except Exception as e:
+        metrics.record_error(labels, e)
+        raise
+    finally:
+        metrics.inc("bedrock_in_flight_requests", labels, -1)
+    metrics.observe("bedrock_request_duration_seconds", labels, time.perf_counter() - started)
+    metrics.inc("bedrock_requests_total", dict(labels, status="success"))
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    metrics.record_tokens(labels, headers.get("x-amzn-bedrock-input-token-count"),
+                          headers.get("x-amzn-bedrock-output-token-count"))
+    return raw_body
+
+def _call_converse(client, model_id, config_json, metrics=None, provider=None):
+    """
+    Sends one Converse request and returns the response, without its ResponseMetadata, as a
+    JSON string. Metrics are recorded like in _call_invoke_model; Converse returns the whole
+    response at once, so time to first byte equals the request duration.
+    """
+    request = json.loads(config_json)
+    if metrics is None:
+        response = client.converse(modelId=model_id, **request)
+    else:
+        labels = {"model_id": model_id, "provider": provider}
+        metrics.inc("bedrock_in_flight_requests", labels)
+        started = time.perf_counter()
+        try:
+            response = client.converse(modelId=model_id, **request)
+        except Exception as e:
+            metrics.record_error(labels, e)
+            raise
+        finally:
+            metrics.inc("bedrock_in_flight_requests", labels, -1)
+        elapsed = time.perf_counter() - started
+        metrics.observe("bedrock_time_to_first_byte_seconds", labels, elapsed)
+        metrics.observe("bedrock_request_duration_seconds", labels, elapsed)
+        metrics.inc("bedrock_requests_total", dict(labels, status="success"))
+        usage = response.get("usage", {})
+        metrics.record_tokens(labels, usage.get("inputTokens"), usage.get("outputTokens"))
+    response.pop("ResponseMetadata", None)
+    return json.dumps(response, default=str)
+
+def converse_text(response_body):
+    """
+    Returns the text of a Converse response's output message.
+    """
+    content = response_body.get("output", {}).get("message", {}).get("content", [])
+    return "".join(block.get("text", "") for block in content).strip()
+
+def _release_nothing():
+    pass
+
+def _with_retry(retry, model_id, operation, scheduler=None, priority="interactive", tenant="default",
+                deadline=None, hold=False):
+    """
+    Runs operation through the RetryEngine if one is configured. Each attempt is admitted by
+    the PriorityScheduler before it takes the model's rate and concurrency slots, so queued
+    requests hold no limiter slot and backoff sleeps hold no scheduler slot.
+    With hold=True, returns (result, release) and the scheduler slot stays taken until
+    release() is called, e.g. once a stream's body has been read.
+    """
+    admit = None
+    if scheduler is not None:
+        admit = lambda: scheduler.acquire(priority, tenant, deadline)
+    if retry is not None:
+        return retry.call(model_id, operation, admit=admit, hold=hold)
+    release = admit() if admit is not None else _release_nothing
+    try:
+        result = operation()
+    except BaseException:
+        release()
+        raise
+    if hold:
+        return result, release
+    release()
+    return result
+
+def _with_retry_routed(retry, router, model_id, operation, **schedule_options):
+    """
+    _with_retry for router.call(model_id, operation). The scheduler slot of a hedged request
+    is kept until the losing region's call has finished too, so hedging never puts more calls
+    in flight than the scheduler's capacity.
+    """
+    attempts = []
+
+    def send():
+        attempt = {"release": _release_nothing}
+        attempt["settled"] = _Countdown(2, lambda: attempt["release"]())
+        attempts.append(attempt)
+        return router.call(model_id, operation, on_settled=attempt["settled"].done)
+
+    result, release = _with_retry(retry, model_id, send, hold=True, **schedule_options)
+    # Failed attempts already gave their slot back; the successful one waits for its losers
+    attempts[-1]["release"] = release
+    attempts[-1]["settled"].done()
+    return result
+
+def stream_generation(client, model_config, model_id, config_json, logger, exit_on_error=True, retry=None,
+                      router=None, metrics=None, stats=None, **schedule_options):
+    """
+    Calls invoke_model_with_response_stream (or converse_stream for the converse api_type)
+    and yields text deltas as they arrive. Each chunk is decoded with the provider's stream_parser.
+    Time-to-first-token and time-to-last-token are logged when the stream ends, and recorded in
+    BedrockMetrics if given. A stats dict, if given, receives the same values when the stream ends.
+    """
+    converse = model_config.get("api_type") == "converse"
+    stream_parser = model_config.get("stream_parser")
+    if stream_parser is None and not converse:
+        _fail(logger, f"Streaming is not supported for provider: {model_config['provider']}", exit_on_error)
+
+    labels = {"model_id": model_id, "provider": model_config["provider"]}
+    if metrics is not None:
+        metrics.inc("bedrock_in_flight_requests", labels)
+    started = time.perf_counter()
+    first_token_at = last_token_at = None
+    invocation_metrics = {}
+    stream_error = None
+    # The scheduler slot is held until the whole body has been read, not just until the stream opens
+    release_slot = _release_nothing
+    try:
+        # Only opening the stream is retried; retrying mid-stream would repeat deltas
+        if converse:
+            request = json.loads(config_json)
+            open_stream = lambda stream_client: stream_client.converse_stream(modelId=model_id, **request)
+        else:
+            open_stream = lambda stream_client: stream_client.invoke_model_with_response_stream(
+                body=config_json,
+                modelId=model_id,
+                accept="application/json",
+                contentType="application/json"
+            )
+        if router is not None:
+            # Streams fail over between regions but are not hedged
+            response, release_slot = _with_retry(retry, model_id,
+                                                 lambda: router.call(model_id, open_stream, hedge=False),
+                                                 hold=True, **schedule_options)
+        else:
+            response, release_slot = _with_retry(retry, model_id, lambda: open_stream(client), hold=True,
+                                                 **schedule_options)
+        events = _converse_stream_events(response) if converse else _invoke_stream_events(response, stream_parser)
+        for delta, event_metrics in events:
+            if event_metrics:
+                invocation_metrics = event_metrics
+            if delta:
+                last_token_at = time.perf_counter()
+                if first_token_at is None:
+                    first_token_at = last_token_at
+                yield delta
+    except _aws_errors() as e:
+        stream_error = e
+        _fail(logger, f"An error occurred while streaming from the model: {e}", exit_on_error)
+    except json.JSONDecodeError as e:
+        stream_error = e
+        _fail(logger, "Failed to decode a response stream chunk as JSON.", exit_on_error)
+    except DeadlineExceededError as e:
+        stream_error = e
+        _fail(logger, str(e), exit_on_error)
+    finally:
+        release_slot()
+        if metrics is not None:
+            metrics.inc("bedrock_in_flight_requests", labels, -1)
+            if stream_error is not None:
+                metrics.record_error(labels, stream_error)
+            elif first_token_at is not None:
+                metrics.observe("bedrock_time_to_first_byte_seconds", labels, first_token_at - started)
+
+    if metrics is not None:
+        metrics.observe("bedrock_request_duration_seconds", labels, time.perf_counter() - started)
+        metrics.inc("bedrock_requests_total", dict(labels, status="success"))
+        metrics.record_tokens(labels, invocation_metrics.get("inputTokenCount"),
+                              invocation_metrics.get("outputTokenCount"))
+
+    ttft_ms = round((first_token_at - started) * 1000, 1) if first_token_at else None
+    ttlt_ms = round((last_token_at - started) * 1000, 1) if last_token_at else None
+    logger.info(f"Stream complete for {model_id}: time_to_first_token_ms={ttft_ms}, "
+                f"time_to_last_token_ms={ttlt_ms}, invocation_metrics={json.dumps(invocation_metrics)}")
+    if stats is not None:
+        stats.update(time_to_first_token_ms=ttft_ms, time_to_last_token_ms=ttlt_ms,
+                     invocation_metrics=invocation_metrics)
+    if first_token_at is None:
+        logger.error("No generation found in the response stream.")
+
+def _invoke_stream_events(response, stream_parser):
+    """
+    Yields (delta, invocation metrics or None) for each chunk of an invoke_model_with_response_stream body.
+    """
+    for event in response.get('body'):
+        chunk_bytes = event.get('chunk', {}).get('bytes')
+        if not chunk_bytes:
+            continue
+        chunk = json.loads(chunk_bytes)
+        # The last chunk carries Bedrock's own token counts and latencies
+        yield stream_parser(chunk), chunk.get("amazon-bedrock-invocationMetrics")
+
+def _converse_stream_events(response):
+    """
+    Yields (delta, invocation metrics or None) for each event of a converse_stream response.
+    The closing metadata event is mapped onto the invocation metric names used by invoke_model
+    streams, plus the prompt cache read and write token counts.
+    """
+    for event in response.get('stream'):
+        if "contentBlockDelta" in event:
+            yield event["contentBlockDelta"].get("delta", {}).get("text", ""), None
+        elif "metadata" in event:
+            usage = event["metadata"].get("usage", {})
+            yield "", {
+                "inputTokenCount": usage.get("inputTokens"),
+                "outputTokenCount": usage.get("outputTokens"),
+                "cacheReadInputTokenCount": usage.get("cacheReadInputTokens", 0),
+                "cacheWriteInputTokenCount": usage.get("cacheWriteInputTokens", 0),
+                "invocationLatency": event["metadata"].get("metrics", {}).get("latencyMs"),
+            }
+
+def _semantic_caching_stream(deltas, semantic_cache, semantic_key, semantic_vector):
+    """
+    Passes deltas through and stores the full generation in the semantic cache once the
+    stream completes; abandoned or failed streams are not cached.
+    """
+    parts = []
+    for delta in deltas:
+        parts.append(delta)
+        yield delta
+    semantic_cache.put(semantic_key, semantic_vector, "".join(parts).strip())
+
+def _coalesced_stream(coalescer, key, exit_on_error, open_stream):
+    """
+    Subscribes to a shared stream, exiting on failure when exit_on_error is set.
+    The pump always runs with exit_on_error=False, so errors arrive as BedrockInvocationError.
+    """
+    try:
+        yield from coalescer.stream(key, open_stream)
+    except BedrockInvocationError:
+        if exit_on_error:
+            sys.exit(1)
+        raise
+
+def apply_temperature(body, temperature):
+    """
+    Overrides the sampling temperature set by a config_builder, at the top level of the body
+    or in a nested generation config such as Titan's textGenerationConfig.
+    """
+    for section in [body] + [value for value in body.values() if isinstance(value, dict)]:
+        if "temperature" in section:
+            section["temperature"] = temperature
+    return body
+
+def build_request_body(model_config, prompt_text, stop_sequences=None):
+    """
+    Builds the provider request body for a prompt with the model's config_builder.
+    A "temperature" in model_config overrides the builder's default.
+    Raises ValueError for an unsupported API type.
+    """
+    api_type = model_config.get("api_type", "invoke_model")
+
+    if api_type == "invoke_model":
+        # Build the configuration based on the model, applying its registry max_tokens default
+        if "max_tokens" in model_config:
+            body = model_config["config_builder"](prompt_text, stop_sequences, model_config["max_tokens"])
+        else:
+            body = model_config["config_builder"](prompt_text, stop_sequences)
+        if model_config.get("temperature") is not None:
+            apply_temperature(body, model_config["temperature"])
+        return body
+    if api_type == "messages":
+        # For Messages API, include system and user messages
+        return model_config["config_builder"](prompt_text)
+    if api_type == "embedding":
+        return model_config["config_builder"](prompt_text, model_config.get("dimensions"))
+    raise ValueError(f"Unsupported API type: {api_type}")
+
+# Marks the end of a stable prompt prefix that Bedrock may cache and reuse across requests
+CONVERSE_CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+def build_converse_request(model_config, prompt_text, stop_sequences=None, messages=None, system=None, context=None):
+    """
+    Builds the Converse API arguments (everything except modelId) for a prompt.
+    messages are earlier {"role", "content"} turns and context is prepended to the first user turn.
+    For models declared with prompt_caching, a cache point follows each stable prefix (the system
+    prompt, the context and the conversation history), so later requests sharing that prefix
+    read it from the prompt cache instead of processing it again.
+    """
+    caching = model_config.get("prompt_caching", False)
+    turns = [{"role": message["role"], "content": [{"text": message["content"]}]} for message in messages or []]
+    if caching and turns:
+        turns[-1]["content"].append(CONVERSE_CACHE_POINT)
+    turns.append({"role": "user", "content": [{"text": prompt_text}]})
+    if context:
+        turns[0]["content"][:0] = [{"text": context}] + ([CONVERSE_CACHE_POINT] if caching else [])
+
+    temperature = model_config.get("temperature")
+    inference_config = {"maxTokens": model_config.get("max_tokens", 512),
+                        "temperature": 0.5 if temperature is None else temperature, "topP": 0.9}
+    if stop_sequences:
+        inference_config["stopSequences"] = list(stop_sequences)
+    request = {"messages": turns, "inferenceConfig": inference_config}
+    if system:
+        request["system"] = [{"text": system}] + ([CONVERSE_CACHE_POINT] if caching else [])
+    return request
+
+def flatten_conversation(prompt_text, messages=None, system=None, context=None):
+    """
+    Folds a system prompt, context and earlier turns into a single text prompt for models
+    that are not called through the Converse API.
+    """
+    if context:
+        prompt_text = f"{context}\n\n{prompt_text}"
+    turns = ([{"role": "system", "content": system}] if system else []) + list(messages or [])
+    return messages_to_prompt(turns + [{"role": "user", "content": prompt_text}])
+
+def split_chat_messages(chat_messages):
+    """
+    Splits OpenAI chat messages into (system prompt, earlier turns, final user prompt).
+    Raises ValueError if the last message is not from the user.
+    """
+    system = "\n\n".join(message.get("content", "") for message in chat_messages if message.get("role") == "system")
+    turns = [{"role": message.get("role"), "content": message.get("content", "")}
+             for message in chat_messages if message.get("role") != "system"]
+    if not turns or turns[-1]["role"] != "user":
+        raise ValueError("The last message must have the user role.")
+    return system or None, turns[:-1], turns[-1]["content"]
+
+def invoke_model(client, model_config, model_id, prompt_text, logger, stop_sequences=None, exit_on_error=True,
+                 stream=False, cache=None, retry=None, scheduler=None, priority="interactive", tenant="default",
+                 deadline=None, coalescer=None, router=None, metrics=None, semantic_cache=None, messages=None,
+                 system=None, context=None, stream_stats=None):
+    """
+    Invokes the Bedrock model using the appropriate API and parses the response.
+    Implements retries for transient errors when a RetryEngine is given.
+    When exit_on_error is False, failures raise BedrockInvocationError instead of exiting.
+    When stream is True, returns a generator of text deltas instead of the full generation.
+    When a ResponseCache is given, cacheable payloads are served from it before calling Bedrock.
+    When a PriorityScheduler is given, the call is queued under its priority class, tenant and deadline.
+    When a RequestCoalescer is given, identical in-flight requests share one upstream call.
+    When a RegionRouter is given, it picks the region (and client) for each attempt.
+    When BedrockMetrics is given, every upstream attempt is recorded in it.
+    When a SemanticCache is given, a generation for a sufficiently similar earlier prompt is
+    returned (or streamed as a single delta) instead of calling the model.
+    messages (earlier {"role", "content"} turns), system and context (e.g. retrieved documents)
+    are sent ahead of the prompt. The converse api_type sends them as Converse turns with cache
+    points; other models get them flattened into the prompt text.
+    stream_stats is passed to stream_generation for uncoalesced streams.
+    """
+    converse = model_config.get("api_type") == "converse"
+    question = prompt_text
+    if not converse and (messages or system or context):
+        prompt_text = flatten_conversation(prompt_text, messages, system, context)
+    try:
+        if converse:
+            config = build_converse_request(model_config, prompt_text, stop_sequences, messages, system, context)
+        else:
+            config = build_request_body(model_config, prompt_text, stop_sequences)
+    except ValueError as e:
+        _fail(logger, str(e), exit_on_error)
+
+    config_json = json.dumps(config)
+    logger.info("Configuration Payload", extra={"body": config_json})
+
+    semantic_key = semantic_vector = None
+
+    def semantic_lookup():
+        nonlocal semantic_key, semantic_vector
+        prefix = [system, context, messages] if messages or system or context else None
+        semantic_key = SemanticCache.partition_key(model_id, model_config, stop_sequences, prefix)
+        generation, semantic_vector = semantic_cache.lookup(semantic_key, question)
+        if metrics is not None and semantic_vector is not None:
+            metrics.inc("bedrock_semantic_cache_requests_total",
+                        {"model_id": model_id, "provider": model_config["provider"],
+                         "result": "miss" if generation is None else "hit"})
+        return generation
+
+    schedule_options = {"scheduler": scheduler, "priority": priority, "tenant": tenant, "deadline": deadline}
+    if stream:
+        if semantic_cache is not None:
+            generation = semantic_lookup()
+            if generation is not None:
+                return iter([generation])
+            if semantic_vector is not None:
+                return _semantic_caching_stream(
+                    invoke_model(client, model_config, model_id, question, logger, stop_sequences,
+                                 exit_on_error, stream=True, retry=retry, coalescer=coalescer, router=router,
+                                 metrics=metrics, messages=messages, system=system, context=context,
+                                 **schedule_options),
+                    semantic_cache, semantic_key, semantic_vector)
+        if coalescer is None:
+            return stream_generation(client, model_config, model_id, config_json, logger, exit_on_error, retry,
+                                     router, metrics, stream_stats, **schedule_options)
+        return _coalesced_stream(coalescer, request_key(model_id, config_json), exit_on_error,
+                                 lambda: stream_generation(client, model_config, model_id, config_json, logger,
+                                                           False, retry, router, metrics, **schedule_options))
+
+    cache_key = None
+    if cache is not None and cache.is_cacheable(config):
+        cache_key = cache.make_key(model_id, config_json)
+
+    try:
+        raw_body = cache.get(cache_key) if cache_key else None
+        cache_hit = raw_body is not None
+        if cache_hit:
+            logger.info(f"Response cache hit for {model_id}")
+        else:
+            semantic_generation = semantic_lookup() if semantic_cache is not None else None
+            if semantic_generation is not None:
+                return semantic_generation
+            provider = model_config["provider"]
+            call_upstream = _call_converse if converse else _call_invoke_model
+            if router is not None:
+                upstream_call = lambda: _with_retry_routed(retry, router, model_id, lambda region_client: call_upstream(
+                    region_client, model_id, config_json, metrics, provider), **schedule_options)
+            else:
+                send = lambda: call_upstream(client, model_id, config_json, metrics, provider)
+                upstream_call = lambda: _with_retry(retry, model_id, send, **schedule_options)
+            if coalescer is not None:
+                raw_body = coalescer.call(request_key(model_id, config_json), upstream_call)
+            else:
+                raw_body = upstream_call()
+        response_body = json.loads(raw_body)
+        if converse:
+            # cacheReadInputTokens and cacheWriteInputTokens show whether the prompt cache was used
+            logger.info(f"Converse usage for {model_id}: {json.dumps(response_body.get('usage', {}))}")
+            generation = converse_text(response_body)
+        else:
+            generation = model_config["response_parser"](response_body)
+
+        if generation:
+            if cache_key and not cache_hit:
+                cache.put(cache_key, raw_body)
+            if semantic_vector is not None:
+                semantic_cache.put(semantic_key, semantic_vector, generation)
+            return generation
+        else:
+            logger.error("No generation found in the response.")
+            return None
+    except _aws_errors() as e:
+        _fail(logger, f"An error occurred while invoking the model: {e}", exit_on_error)
+    except json.JSONDecodeError:
+        _fail(logger, "Failed to decode the response body as JSON.", exit_on_error)
+    except DeadlineExceededError as e:
+        _fail(logger, str(e), exit_on_error)
+    except Exception as e:
+        _fail(logger, f"An unexpected error occurred: {e}", exit_on_error)
+
+def read_batch_prompts(batch_path, logger):
+    """
+    Yields (line_number, record) pairs from a JSONL prompt file.
+    Each line is either a JSON string or an object with a "prompt" key and optional
+    "id", "model_id", "stop_sequences", "priority", "tenant" and "slo_ms" keys.
+    Blank lines are skipped.
+    """
+    with open(batch_path, 'r', encoding='utf-8') as batch_file:
+        for line_number, line in enumerate(batch_file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.error(f"Skipping line {line_number} in {batch_path}: invalid JSON.")
+                yield line_number, {"error": "Invalid JSON line."}
+                continue
+            if isinstance(record, str):
+                record = {"prompt": record}
+            if not isinstance(record, dict) or not isinstance(record.get("prompt"), str):
+                logger.error(f"Skipping line {line_number} in {batch_path}: missing \"prompt\" string.")
+                yield line_number, {"error": "Missing \"prompt\" string."}
+                continue
+            yield line_number, record
+
+def process_batch_record(client, line_number, record, default_model_id, logger, stop_sequences, **invoke_options):
+    """
+    Runs one batch record through invoke_model and returns the output record.
+    Errors are captured in the output record instead of stopping the batch.
+    invoke_options (cache, retry, ...) are passed through to invoke_model.
+    """
+    model_id = record.get("model_id", default_model_id)
+    result = {
+        "line": line_number,
+        "id": record.get("id"),
+        "model_id": model_id,
+        "prompt": record.get("prompt"),
+        "response": None,
+        "error": record.get("error"),
+        "latency_ms": None,
+    }
+    if result["error"]:
+        return result
+
+    model_config = find_model_configuration(model_id)
+    if not model_config:
+        result["error"] = f"Unsupported model_id: {model_id}"
+        return result
+
+    # Per-record scheduling fields override the batch-wide defaults
+    invoke_options = dict(invoke_options)
+    for key in ("priority", "tenant"):
+        if key in record:
+            invoke_options[key] = record[key]
+    slo_ms = record.get("slo_ms", invoke_options.pop("slo_ms", None))
+    if slo_ms:
+        invoke_options["deadline"] = time.monotonic() + slo_ms / 1000
+
+    started = time.perf_counter()
+    try:
+        result["response"] = invoke_model(client, model_config, model_id, record["prompt"], logger,
+                                          record.get("stop_sequences", stop_sequences), exit_on_error=False,
+                                          **invoke_options)
+        if result["response"] is None:
+            result["error"] = "No generation found in the response."
+    except (BedrockInvocationError, ValueError) as e:
+        result["error"] = str(e)
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+def run_batch(client, batch_path, output_path, default_model_id, logger, stop_sequences, workers, **invoke_options):
+    """
+    Pushes every prompt in batch_path through a bounded thread pool sharing one client and
+    writes the results to output_path as JSONL, in input order.
+    At most 2 * workers records are in flight, so memory stays flat for large files.
+    """
+    max_in_flight = workers * 2
+    pending = deque()
+    completed = failed = 0
+    started = time.perf_counter()
+
+    def write_next(output_file):
+        nonlocal completed, failed
+        result = pending.popleft().result()
+        output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        completed += 1
+        if result["error"]:
+            failed += 1
+
+    logger.info(f"Starting batch run: input={batch_path}, output={output_path}, workers={workers}")
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            open(output_path, 'w', encoding='utf-8') as output_file:
+        for line_number, record in read_batch_prompts(batch_path, logger):
+            pending.append(executor.submit(process_batch_record, client, line_number, record,
+                                           default_model_id, logger, stop_sequences, **invoke_options))
+            if len(pending) >= max_in_flight:
+                write_next(output_file)
+        while pending:
+            write_next(output_file)
+
+    elapsed = time.perf_counter() - started
+    rate = completed / elapsed if elapsed > 0 else 0.0
+    summary = (f"Batch complete: {completed} prompts ({failed} failed) in {elapsed:.1f}s "
+               f"({rate:.1f} prompts/s). Results written to {output_path}")
+    print(summary)
+    logger.info(summary)
+    return completed, failed
+
+# Rough characters per token, used to size packed requests without a tokenizer
+CHARS_PER_TOKEN = 4
+
+PACKED_PROMPT_TEMPLATE = (
+    "Answer each of the following {count} questions independently and concisely.\n"
+    "The questions are given as a JSON object that maps a question number to the question.\n"
+    "Reply with only a JSON object that maps each question number to its answer as a string, "
+    "for example {{\"1\": \"...\", \"2\": \"...\"}}, with no other text.\n\n"
+    "Questions:\n{questions}"
+)
+
+# Tokens reserved for the packing instructions and for the JSON structure of the answers
+PACKED_PROMPT_OVERHEAD_TOKENS = 100
+PACKED_ANSWER_OVERHEAD_TOKENS = 8
+
+def estimate_tokens(text):
+    """
+    Returns a rough token count for text; close enough to keep packed requests under the context limit.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def pack_prompts(items, max_prompts, max_input_tokens):
+    """
+    Packs (key, tokens) items into as few bins as possible with first-fit decreasing, each bin
+    holding at most max_prompts items and max_input_tokens tokens. Items larger than
+    max_input_tokens get a bin of their own. Returns a list of bins, each a list of items.
+    """
+    bins = []
+    for item in sorted(items, key=lambda item: item[1], reverse=True):
+        for packed in bins:
+            if len(packed["items"]) < max_prompts and packed["free"] >= item[1]:
+                packed["items"].append(item)
+                packed["free"] -= item[1]
+                break
+        else:
+            bins.append({"items": [item], "free": max_input_tokens - item[1]})
+    return [packed["items"] for packed in bins]
+
+def split_packed_answers(generation, count):
+    """
+    Parses a packed response into {question number: answer} for the numbers 1..count that were
+    answered with a non-empty value. Returns an empty dict if generation is not a string or
+    no JSON object can be found.
+    """
+    if not isinstance(generation, str):
+        return {}
+    start, end = generation.find("{"), generation.rfind("}")
+    if start < 0 or end <= start:
+        return {}
+    try:
+        parsed = json.loads(generation[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    answers = {}
+    for number in range(1, count + 1):
+        answer = parsed.get(str(number))
+        if isinstance(answer, (str, int, float)) and not isinstance(answer, bool) and str(answer).strip():
+            answers[number] = str(answer).strip()
+    return answers
+
+def run_pack(client, records, model_id, model_config, logger, stop_sequences, answer_tokens, stats,
+             **invoke_options):
+    """
+    Sends several batch records as one structured request and splits the answers back into
+    one output record each. Records whose answer is missing or unparsable, or all of them if
+    the packed call fails, fall back to individual calls through process_batch_record.
+    """
+    count = len(records)
+    packed_config = dict(model_config, max_tokens=min(
+        model_config.get("max_output_tokens", 2048),
+        count * (answer_tokens + PACKED_ANSWER_OVERHEAD_TOKENS) + PACKED_ANSWER_OVERHEAD_TOKENS))
+    questions = json.dumps({str(number): record["prompt"] for number, (_, record) in enumerate(records, start=1)},
+                           ensure_ascii=False, indent=0)
+    prompt_text = PACKED_PROMPT_TEMPLATE.format(count=count, questions=questions)
+
+    pack_options = dict(invoke_options)
+    slo_ms = pack_options.pop("slo_ms", None)
+    if slo_ms:
+        pack_options["deadline"] = time.monotonic() + slo_ms / 1000
+    started = time.perf_counter()
+    try:
+        generation = generation_text(invoke_model(client, packed_config, model_id, prompt_text, logger,
+                                                  stop_sequences, exit_on_error=False, **pack_options))
+    except (BedrockInvocationError, ValueError) as e:
+        logger.warning(f"Packed request of {count} prompts failed, falling back to individual calls: {e}")
+        generation = None
+    latency_ms = round((time.perf_counter() - started) * 1000, 1)
+    answers = split_packed_answers(generation, count)
+
+    results = []
+    for number, (line_number, record) in enumerate(records, start=1):
+        if number in answers:
+            results.append({
+                "line": line_number,
+                "id": record.get("id"),
+                "model_id": model_id,
+                "prompt": record["prompt"],
+                "response": answers[number],
+                "error": None,
+                "latency_ms": latency_ms,
+                "packed": count,
+            })
+        else:
+            result = process_batch_record(client, line_number, record, model_id, logger, stop_sequences,
+                                          **invoke_options)
+            result["packed"] = 1
+            results.append(result)
+    with stats["lock"]:
+        stats["fallbacks"] += count - len(answers)
+    if len(answers) < count:
+        logger.info(f"Packed request answered {len(answers)} of {count} prompts; "
+                    f"{count - len(answers)} sent individually")
+    return results
+
+def run_packed_batch(client, batch_path, output_path, default_model_id, logger, stop_sequences, workers,
+                     pack_size=16, answer_tokens=64, **invoke_options):
+    """
+    Like run_batch, but packs short prompts for the same model and stop sequences into
+    structured multi-question requests, sized by estimated tokens to fit the model's context
+    window and output limit. Prompts are packed within windows of the input so memory stays
+    bounded; results are written in input order with a "packed" field giving how many prompts
+    shared the call that answered them. Records with their own priority, tenant or slo_ms run
+    individually.
+    """
+    window_size = workers * pack_size * 2
+    pending = deque()
+    stats = {"lock": threading.Lock(), "fallbacks": 0, "packs": 0, "individual": 0}
+    completed = failed = 0
+    started = time.perf_counter()
+
+    def single(line_number, record):
+        result = process_batch_record(client, line_number, record, default_model_id, logger, stop_sequences,
+                                      **invoke_options)
+        result["packed"] = 1
+        return [result]
+
+    def submit_window(executor, records):
+        futures = []
+        groups = {}
+        for line_number, record in records:
+            model_id = record.get("model_id", default_model_id)
+            model_config = None if record.get("error") else find_model_configuration(model_id)
+            if (model_config is None or model_config.get("api_type") == "embedding"
+                    or any(key in record for key in ("priority", "tenant", "slo_ms"))):
+                futures.append(executor.submit(single, line_number, record))
+                stats["individual"] += 1
+                continue
+            stop = tuple(record.get("stop_sequences", stop_sequences) or ())
+            groups.setdefault((model_id, stop), (model_config, []))[1].append((line_number, record))
+
+        for (model_id, stop), (model_config, group) in groups.items():
+            max_output = model_config.get("max_output_tokens", 2048)
+            max_prompts = max(1, min(pack_size, (max_output - PACKED_ANSWER_OVERHEAD_TOKENS) //
+                                     (answer_tokens + PACKED_ANSWER_OVERHEAD_TOKENS)))
+            reserved_output = (max_prompts * (answer_tokens + PACKED_ANSWER_OVERHEAD_TOKENS)
+                               + PACKED_ANSWER_OVERHEAD_TOKENS)
+            max_input_tokens = (model_config.get("context_tokens", 4096) - reserved_output
+                                - PACKED_PROMPT_OVERHEAD_TOKENS)
+            items = [(index, estimate_tokens(record["prompt"]) + PACKED_ANSWER_OVERHEAD_TOKENS)
+                     for index, (_, record) in enumerate(group)]
+            for packed in pack_prompts(items, max_prompts, max_input_tokens):
+                packed_records = [group[index] for index, _ in packed]
+                if len(packed_records) == 1:
+                    futures.append(executor.submit(single, *packed_records[0]))
+                    stats["individual"] += 1
+                else:
+                    futures.append(executor.submit(run_pack, client, packed_records, model_id, model_config, logger,
+                                                   list(stop) or None, answer_tokens, stats, **invoke_options))
+                    stats["packs"] += 1
+        return futures
+
+    def write_window(output_file):
+        nonlocal completed, failed
+        results = [result for future in pending.popleft() for result in future.result()]
+        for result in sorted(results, key=lambda result: result["line"]):
+            output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            completed += 1
+            if result["error"]:
+                failed += 1
+
+    logger.info(f"Starting packed batch run: input={batch_path}, output={output_path}, workers={workers}, "
+                f"pack_size={pack_size}, answer_tokens={answer_tokens}")
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            open(output_path, 'w', encoding='utf-8') as output_file:
+        window = []
+        for line_number, record in read_batch_prompts(batch_path, logger):
+            window.append((line_number, record))
+            if len(window) >= window_size:
+                pending.append(submit_window(executor, window))
+                window = []
+                # Keep the next window queued while writing the previous one
+                if len(pending) >= 2:
+                    write_window(output_file)
+        if window:
+            pending.append(submit_window(executor, window))
+        while pending:
+            write_window(output_file)
+
+    elapsed = time.perf_counter() - started
+    rate = completed / elapsed if elapsed > 0 else 0.0
+    calls = stats["packs"] + stats["individual"] + stats["fallbacks"]
+    summary = (f"Batch complete: {completed} prompts ({failed} failed) in {elapsed:.1f}s ({rate:.1f} prompts/s) "
+               f"using {calls} model calls: {stats['packs']} packed, {stats['individual']} individual, "
+               f"{stats['fallbacks']} fallbacks. Results written to {output_path}")
+    print(summary)
+    logger.info(summary)
+    return completed, failed
+
+# Columns of the --matrix comparison table, in output order
+MATRIX_COLUMNS = ("prompt_line", "prompt_id", "model_id", "provider", "latency_ms", "ttft_ms", "input_tokens",
+                  "output_tokens", "output_tokens_per_second", "response", "error")
+
+def select_matrix_models(patterns=None):
+    """
+    Returns the model IDs for --matrix: every registered text model, or those matching the
+    comma-separated patterns (exact model IDs or shell-style wildcards such as "meta.*").
+    Exact IDs that are not in the registry are kept if a provider configuration matches them.
+    """
+    import fnmatch
+
+    registered = [model_id for _, _, _, model_id in MODEL_REGISTRY.models()
+                  if find_model_configuration(model_id).get("api_type") != "embedding"]
+    if not patterns:
+        return registered
+    selected = []
+    for pattern in (pattern.strip() for pattern in patterns.split(",")):
+        if not pattern:
+            continue
+        if any(char in pattern for char in "*?["):
+            matches = fnmatch.filter(registered, pattern)
+        else:
+            matches = [pattern] if find_model_configuration(pattern) else []
+        for model_id in matches:
+            if model_id not in selected:
+                selected.append(model_id)
+    return selected
+
+def compare_model(client, model_id, line_number, record, logger, stop_sequences, **invoke_options):
+    """
+    Sends one prompt to one model and returns a MATRIX_COLUMNS row. Models that support streaming
+    are streamed so time to first token can be measured. Errors are captured in the row.
+    """
+    model_config = find_model_configuration(model_id)
+    row = dict.fromkeys(MATRIX_COLUMNS)
+    row.update(prompt_line=line_number, prompt_id=record.get("id"), model_id=model_id,
+               provider=model_config["provider"] if model_config else None, error=record.get("error"))
+    if row["error"]:
+        return row
+    if not model_config:
+        row["error"] = f"Unsupported model_id: {model_id}"
+        return row
+
+    stream = model_config.get("api_type") == "converse" or model_config.get("stream_parser") is not None
+    stats = {}
+    started = time.perf_counter()
+    try:
+        if stream:
+            deltas = invoke_model(client, model_config, model_id, record["prompt"], logger, stop_sequences,
+                                  exit_on_error=False, stream=True, stream_stats=stats, **invoke_options)
+            generation = "".join(deltas).strip()
+        else:
+            generation = invoke_model(client, model_config, model_id, record["prompt"], logger, stop_sequences,
+                                      exit_on_error=False, **invoke_options)
+    except (BedrockInvocationError, ValueError) as e:
+        row["error"] = str(e)
+        generation = None
+    elapsed = time.perf_counter() - started
+    row["latency_ms"] = round(elapsed * 1000, 1)
+    row["ttft_ms"] = stats.get("time_to_first_token_ms")
+    invocation_metrics = stats.get("invocation_metrics") or {}
+    row["input_tokens"] = invocation_metrics.get("inputTokenCount")
+    row["output_tokens"] = invocation_metrics.get("outputTokenCount")
+    ttlt_ms = stats.get("time_to_last_token_ms")
+    if row["output_tokens"] and row["output_tokens"] > 1 and row["ttft_ms"] is not None and ttlt_ms \
+            and ttlt_ms - row["ttft_ms"] >= 1:
+        # Generation speed between the first and last token, so queueing and prompt processing do not count
+        row["output_tokens_per_second"] = round((row["output_tokens"] - 1) / ((ttlt_ms - row["ttft_ms"]) / 1000), 1)
+    row["response"] = generation
+    if not generation and not row["error"]:
+        row["error"] = "No generation found in the response."
+    return row
+
+def write_matrix(rows, output_path):
+    """
+    Writes the comparison rows to output_path as JSON if it ends in .json, otherwise as CSV.
+    """
+    if output_path.endswith(".json"):
+        with open(output_path, 'w', encoding='utf-8') as output_file:
+            json.dump(rows, output_file, ensure_ascii=False, indent=2)
+        return
+    import csv
+
+    with open(output_path, 'w', encoding='utf-8', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=MATRIX_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def print_matrix(rows):
+    """
+    Prints the comparison rows as one table per prompt, fastest model first.
+    """
+    for line_number in sorted({row["prompt_line"] for row in rows}):
+        prompt_rows = sorted((row for row in rows if row["prompt_line"] == line_number),
+                             key=lambda row: (row["error"] is not None, row["latency_ms"] or 0))
+        print(f"\nPrompt {line_number}:")
+        print(f"{'Model ID':<46} {'Latency ms':>10} {'TTFT ms':>8} {'Out tok':>7} {'Tok/s':>6}  Response")
+        for row in prompt_rows:
+            text = f"ERROR: {row['error']}" if row["error"] else " ".join(row["response"].split())
+            cells = [row[key] if row[key] is not None else "-"
+                     for key in ("latency_ms", "ttft_ms", "output_tokens", "output_tokens_per_second")]
+            print(f"{row['model_id']:<46} {cells[0]:>10} {cells[1]:>8} {cells[2]:>7} {cells[3]:>6}  {text[:60]}")
+
+def run_matrix(client, model_ids, prompts, output_path, logger, stop_sequences, workers, **invoke_options):
+    """
+    Sends every (line_number, record) prompt to every model in model_ids concurrently, prints a
+    comparison table and writes it to output_path. With workers at least the number of models,
+    each prompt finishes in the time of its slowest model.
+    """
+    jobs = [(model_id, line_number, record) for line_number, record in prompts for model_id in model_ids]
+    logger.info(f"Starting model matrix: {len(model_ids)} models x {len(jobs) // max(len(model_ids), 1)} prompts, "
+                f"workers={workers}")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as executor:
+        futures = [executor.submit(compare_model, client, model_id, line_number, record, logger, stop_sequences,
+                                   **invoke_options)
+                   for model_id, line_number, record in jobs]
+        rows = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    print_matrix(rows)
+    write_matrix(rows, output_path)
+    failed = sum(1 for row in rows if row["error"])
+    summary = (f"Matrix complete: {len(rows)} model calls ({failed} failed) in {elapsed:.1f}s. "
+               f"Results written to {output_path}")
+    print(f"\n{summary}")
+    logger.info(summary)
+    return rows
+
+def count_embedding_rows(input_path):
+    """
+    Returns the number of non-blank lines in input_path, i.e. the number of output rows.
+    """
+    rows = 0
+    with open(input_path, 'rb') as input_file:
+        for line in input_file:
+            if line.strip():
+                rows += 1
+    return rows
+
+def read_embedding_inputs(input_path, logger):
+    """
+    Yields (line_number, id, text, error) for each non-blank line of a JSONL document file.
+    Each line is either a JSON string or an object with a "text" key and an optional "id";
+    the id defaults to the line number. Invalid lines carry an error instead of text.
+    """
+    with open(input_path, 'r', encoding='utf-8') as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.error(f"Skipping line {line_number} in {input_path}: invalid JSON.")
+                yield line_number, line_number, None, "Invalid JSON line."
+                continue
+            if isinstance(record, str):
+                record = {"text": record}
+            if not isinstance(record, dict) or not isinstance(record.get("text"), str) or not record["text"]:
+                logger.error(f"Skipping line {line_number} in {input_path}: missing \"text\" string.")
+                yield line_number, line_number, None, "Missing \"text\" string."
+                continue
+            yield line_number, record.get("id", line_number), record["text"], None
+
+def _read_completed_rows(ids_path):
+    """
+    Returns how many rows the ID sidecar records, dropping a partially written last line.
+    """
+    if not os.path.exists(ids_path):
+        return 0
+    with open(ids_path, 'rb') as ids_file:
+        content = ids_file.read()
+    complete = content[:content.rfind(b"\n") + 1]
+    if len(complete) != len(content):
+        with open(ids_path, 'r+b') as ids_file:
+            ids_file.truncate(len(complete))
+    return complete.count(b"\n")
+
+def embed_document(client, model_config, model_id, text, logger, **invoke_options):
+    """
+    Embeds one document and returns (vector, error). Errors are captured instead of raised.
+    """
+    try:
+        vector = invoke_model(client, model_config, model_id, text, logger, exit_on_error=False, **invoke_options)
+    except (BedrockInvocationError, ValueError) as e:
+        return None, str(e)
+    if not vector:
+        return None, "No embedding found in the response."
+    return vector, None
+
+def run_embedding(client, model_config, model_id, input_path, output_prefix, logger, workers, checkpoint_rows=1024,
+                  **invoke_options):
+    """
+    Embeds every document in input_path with a bounded thread pool and stores the vectors in a
+    preallocated float32 .npy file opened as a NumPy memmap, one row per non-blank input line,
+    so memory stays flat regardless of corpus size. Row i of <output_prefix>.npy belongs to
+    line i of the <output_prefix>.ids.jsonl sidecar; rows that failed are left as zeros and
+    carry an error in the sidecar. The memmap is flushed before each batch of sidecar lines is
+    written, so an interrupted run resumes after the last recorded row.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        logger.error("--embed requires NumPy. Install it with: pip install numpy")
+        sys.exit(1)
+
+    vectors_path = f"{output_prefix}.npy"
+    ids_path = f"{output_prefix}.ids.jsonl"
+    rows = count_embedding_rows(input_path)
+    done = _read_completed_rows(ids_path)
+    vectors = None
+    if done and os.path.exists(vectors_path):
+        vectors = np.load(vectors_path, mmap_mode="r+")
+        if vectors.shape[0] != rows:
+            logger.error(f"{vectors_path} has {vectors.shape[0]} rows but {input_path} has {rows} documents; "
+                         f"remove the output files to start over.")
+            sys.exit(1)
+    if done:
+        logger.info(f"Resuming embedding run at row {done} of {rows}")
+        print(f"Resuming at row {done} of {rows}")
+
+    max_in_flight = workers * 2
+    pending = deque()
+    id_lines = []
+    completed = failed = 0
+    row = done
+    started = time.perf_counter()
+
+    def checkpoint(ids_file):
+        if vectors is not None:
+            vectors.flush()
+        ids_file.write("".join(id_lines))
+        ids_file.flush()
+        os.fsync(ids_file.fileno())
+        id_lines.clear()
+
+    def write_next(ids_file):
+        nonlocal vectors, completed, failed, row
+        line_number, doc_id, future = pending.popleft()
+        vector, error = future.result()
+        if vector is not None:
+            if vectors is None:
+                # The model's output size is only known once the first vector arrives
+                vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32,
+                                                    shape=(rows, len(vector)))
+            if len(vector) != vectors.shape[1]:
+                error = f"Expected {vectors.shape[1]} dimensions, got {len(vector)}."
+            else:
+                vectors[row] = vector
+        id_lines.append(json.dumps({"row": row, "id": doc_id, "line": line_number, "error": error},
+                                   ensure_ascii=False) + "\n")
+        row += 1
+        completed += 1
+        if error:
+            failed += 1
+        if len(id_lines) >= checkpoint_rows:
+            checkpoint(ids_file)
+
+    logger.info(f"Starting embedding run: input={input_path}, output={vectors_path}, rows={rows}, "
+                f"workers={workers}")
+    executor = ThreadPoolExecutor(max_workers=workers)
+    with open(ids_path, 'a', encoding='utf-8') as ids_file:
+        try:
+            for index, (line_number, doc_id, text, error) in enumerate(read_embedding_inputs(input_path, logger)):
+                if index < done:
+                    continue
+                if error:
+                    future = executor.submit(lambda message=error: (None, message))
+                else:
+                    future = executor.submit(embed_document, client, model_config, model_id, text, logger,
+                                             **invoke_options)
+                pending.append((line_number, doc_id, future))
+                if len(pending) >= max_in_flight:
+                    write_next(ids_file)
+            while pending:
+                write_next(ids_file)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            checkpoint(ids_file)
+
+    elapsed = time.perf_counter() - started
+    rate = completed / elapsed if elapsed > 0 else 0.0
+    shape = f"{vectors.shape[0]} x {vectors.shape[1]}" if vectors is not None else "not created"
+    summary = (f"Embedding complete: {completed} documents ({failed} failed) in {elapsed:.1f}s "
+               f"({rate:.1f} documents/s). Vectors: {vectors_path} ({shape} float32), IDs: {ids_path}")
+    print(summary)
+    logger.info(summary)
+    return completed, failed
+
+# Bedrock batch inference job states after which a job no longer changes
+BATCH_JOB_TERMINAL_STATES = {"Completed", "PartiallyCompleted", "Failed", "Stopped", "Expired"}
+
+# Bedrock accepts at most 50,000 records per batch input file
+BATCH_JOB_MAX_SHARD_RECORDS = 50000
+
+def parse_s3_uri(s3_uri):
+    """
+    Splits s3://bucket/prefix into (bucket, prefix) with no trailing slash on the prefix.
+    Raises ValueError for anything that is not an s3:// URI with a bucket.
+    """
+    if not s3_uri.startswith("s3://"):
+        raise ValueError(f"Not an S3 URI: {s3_uri}")
+    bucket, _, prefix = s3_uri[len("s3://"):].partition("/")
+    if not bucket:
+        raise ValueError(f"S3 URI has no bucket: {s3_uri}")
+    return bucket, prefix.strip("/")
+
+def write_batch_job_shards(batch_path, model_id, model_config, logger, stop_sequences, shard_dir,
+                           shard_records=BATCH_JOB_MAX_SHARD_RECORDS):
+    """
+    Converts a JSONL prompt file into Bedrock batch input records and yields the path of
+    each shard file in shard_dir as soon as it is complete, so uploads can start while the
+    next shard is being written. The recordId is the zero-padded input line number.
+    Invalid lines and records for another model_id are logged and skipped.
+    """
+    shard_index = written = 0
+    shard_file = None
+    try:
+        for line_number, record in read_batch_prompts(batch_path, logger):
+            if record.get("error"):
+                continue
+            if record.get("model_id", model_id) != model_id:
+                logger.error(f"Skipping line {line_number} in {batch_path}: a batch job runs only {model_id}.")
+                continue
+            if shard_file is None:
+                shard_path = os.path.join(shard_dir, f"shard-{shard_index:05d}.jsonl")
+                shard_file = open(shard_path, 'w', encoding='utf-8')
+            model_input = build_request_body(model_config, record["prompt"],
+                                             record.get("stop_sequences", stop_sequences))
+            shard_file.write(json.dumps({"recordId": f"{line_number:011d}", "modelInput": model_input},
+                                        ensure_ascii=False) + "\n")
+            written += 1
+            if written == shard_records:
+                shard_file.close()
+                shard_file = None
+                shard_index += 1
+                written = 0
+                yield shard_path
+        if shard_file is not None:
+            shard_file.close()
+            shard_file = None
+            yield shard_path
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+def submit_batch_job(bedrock_control, s3, batch_path, model_id, model_config, logger, stop_sequences, s3_uri,
+                     role_arn, shard_records=BATCH_JOB_MAX_SHARD_RECORDS, workers=16):
+    """
+    Shards the prompt file into Bedrock batch input files, uploads them to
+    s3_uri/<job name>/input/ with multipart transfers, and submits a model invocation job
+    writing to s3_uri/<job name>/output/. Returns the job ARN.
+    Shards are uploaded in the background while later shards are still being written.
+    """
+    import tempfile
+    from boto3.s3.transfer import TransferConfig
+
+    bucket, prefix = parse_s3_uri(s3_uri)
+    job_name = f"bedrock-py-{time.strftime('%Y%m%d-%H%M%S')}"
+    job_prefix = f"{prefix}/{job_name}" if prefix else job_name
+    transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024,
+                                     max_concurrency=workers)
+
+    def upload(shard_path):
+        key = f"{job_prefix}/input/{os.path.basename(shard_path)}"
+        s3.upload_file(shard_path, bucket, key, Config=transfer_config)
+        os.remove(shard_path)
+        logger.info(f"Uploaded s3://{bucket}/{key}")
+
+    uploaded = 0
+    pending = deque()
+    with tempfile.TemporaryDirectory(prefix="bedrock-batch-") as shard_dir, \
+            ThreadPoolExecutor(max_workers=2) as executor:
+        for shard_path in write_batch_job_shards(batch_path, model_id, model_config, logger, stop_sequences,
+                                                 shard_dir, shard_records):
+            pending.append(executor.submit(upload, shard_path))
+            # Keep at most two shards on local disk at a time
+            if len(pending) >= 2:
+                pending.popleft().result()
+                uploaded += 1
+        while pending:
+            pending.popleft().result()
+            uploaded += 1
+    if uploaded == 0:
+        raise ValueError(f"No valid prompts found in {batch_path}.")
+
+    response = bedrock_control.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=model_id,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{bucket}/{job_prefix}/input/",
+                                               "s3InputFormat": "JSONL"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{bucket}/{job_prefix}/output/"}},
+    )
+    job_arn = response["jobArn"]
+    logger.info(f"Submitted batch job {job_name} ({uploaded} shards): {job_arn}")
+    return job_arn
+
+def wait_for_batch_job(bedrock_control, job_arn, logger, poll_seconds=30, max_poll_seconds=300):
+    """
+    Polls the job until it reaches a terminal state and returns its final description.
+    The polling interval doubles from poll_seconds up to max_poll_seconds while the status
+    is unchanged, and resets whenever the status changes.
+    """
+    status = None
+    interval = poll_seconds
+    while True:
+        job = bedrock_control.get_model_invocation_job(jobIdentifier=job_arn)
+        if job["status"] != status:
+            status = job["status"]
+            interval = poll_seconds
+            logger.info(f"Batch job {job_arn} is {status}")
+            print(f"Batch job status: {status}")
+        if status in BATCH_JOB_TERMINAL_STATES:
+            return job
+        time.sleep(interval)
+        interval = min(interval * 2, max_poll_seconds)
+
+def read_batch_job_results(s3, job, model_config, logger):
+    """
+    Streams the job's output files from S3 line by line and yields one result per record,
+    parsed with the provider's response_parser. Records Bedrock could not run carry its error.
+    """
+    bucket, prefix = parse_s3_uri(job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"])
+    job_id = job["jobArn"].rsplit("/", 1)[-1]
+    output_prefix = f"{prefix}/{job_id}/" if prefix else f"{job_id}/"
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=output_prefix):
+        for item in page.get("Contents", []):
+            key = item["Key"]
+            if key.endswith("manifest.json.out"):
+                manifest = s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8")
+                logger.info(f"Batch job manifest: {manifest.strip()}")
+                continue
+            if not key.endswith(".jsonl.out"):
+                continue
+            for line in s3.get_object(Bucket=bucket, Key=key)["Body"].iter_lines():
+                if not line.strip():
+                    continue
+                output = json.loads(line)
+                record_id = output.get("recordId", "")
+                result = {
+                    "line": int(record_id) if record_id.isdigit() else None,
+                    "record_id": record_id,
+                    "model_id": job["modelId"],
+                    "response": None,
+                    "error": None,
+                }
+                if output.get("error"):
+                    error = output["error"]
+                    result["error"] = error.get("errorMessage", json.dumps(error)) if isinstance(error, dict) \
+                        else str(error)
+                else:
+                    result["response"] = model_config["response_parser"](output.get("modelOutput", {})) or None
+                    if result["response"] is None:
+                        result["error"] = "No generation found in the response."
+                yield result
+
+def run_batch_job_results(s3, job, output_path, logger):
+    """
+    Writes the results of a finished batch job to output_path as JSONL and prints a summary.
+    Returns (completed, failed).
+    """
+    # Jobs may report a model ARN instead of the plain model ID
+    model_id = job["modelId"].rsplit("/", 1)[-1]
+    model_config = find_model_configuration(model_id)
+    if not model_config:
+        raise ValueError(f"Unsupported model_id: {model_id}. Please update bedrock_models.json.")
+
+    completed = failed = 0
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        for result in read_batch_job_results(s3, job, model_config, logger):
+            output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            completed += 1
+            if result["error"]:
+                failed += 1
+
+    summary = (f"Batch job {job['status']}: {completed} records ({failed} failed). "
+               f"Results written to {output_path}")
+    print(summary)
+    logger.info(summary)
+    return completed, failed
+
+class ClientPool:
+    """
+    Round-robin pool of warm bedrock-runtime clients shared by all server threads.
+    Each client keeps its own keep-alive connection pool to Bedrock.
+    """
+
+    def __init__(self, region, logger, size=4, max_pool_connections=16, endpoint_url=None):
+        from botocore.config import Config
+
+        endpoint_url = endpoint_url or os.getenv('BEDROCK_ENDPOINT_URL') or None
+        client_config = Config(
+            region_name=region,
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True,
+            connect_timeout=10,
+            read_timeout=120,
+            retries={"total_max_attempts": 1, "mode": "standard"},
+        )
+        session = _get_boto_session()
+        self.clients = [session.client(service_name='bedrock-runtime', config=client_config, endpoint_url=endpoint_url)
+                        for _ in range(size)]
+        self._next = itertools.cycle(self.clients)
+        self._lock = threading.Lock()
+        logger.info(f"Initialized {size} Bedrock clients for region: {region}")
+
+    def get(self):
+        with self._lock:
+            return next(self._next)
+
+def messages_to_prompt(messages):
+    """
+    Flattens OpenAI chat messages into a single text prompt for the text-completion
+    config_builders. A lone user message is passed through unchanged.
+    """
+    if len(messages) == 1 and messages[0].get("role") == "user":
+        return messages[0].get("content", "")
+    lines = [f"{message.get('role', 'user').capitalize()}: {message.get('content', '')}" for message in messages]
+    return "\n\n".join(lines + ["Assistant:"])
+
+def generation_text(generation):
+    """
+    Returns a parsed generation as a string. Most response_parsers return text already;
+    Mistral's returns its "outputs" list, whose "text" fields are joined. Any other shape
+    yields None.
+    """
+    if isinstance(generation, str):
+        return generation
+    if isinstance(generation, list) and all(isinstance(output, dict) for output in generation):
+        return "".join(str(output.get("text") or "") for output in generation)
+    return None
+
+def parse_stop_sequences(stop, default):
+    """
+    Validates an OpenAI "stop" value: None, a string or a list of strings.
+    Raises ValueError for anything else.
+    """
+    if stop is None:
+        return default
+    if isinstance(stop, str):
+        return [stop]
+    if isinstance(stop, list) and all(isinstance(sequence, str) for sequence in stop):
+        return stop
+    raise ValueError("'stop' must be a string or a list of strings.")
+
+def openai_response(kind, request_id, model_id, text, finish_reason="stop"):
+    """
+    Builds an OpenAI-compatible completion ("text") or chat completion ("chat") response.
+    """
+    if kind == "chat":
+        choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}
+        obj = "chat.completion"
+    else:
+        choice = {"index": 0, "text": text, "logprobs": None, "finish_reason": finish_reason}
+        obj = "text_completion"
+    return {"id": request_id, "object": obj, "created": int(time.time()), "model": model_id, "choices": [choice]}
+
+def openai_stream_chunk(kind, request_id, model_id, text=None, finish_reason=None, role=None):
+    """
+    Builds one OpenAI-compatible streaming chunk for a role announcement, a text delta
+    or the final finish_reason.
+    """
+    if kind == "chat":
+        delta = {"role": role} if role else {}
+        if text is not None:
+            delta["content"] = text
+        choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+        obj = "chat.completion.chunk"
+    else:
+        choice = {"index": 0, "text": text or "", "logprobs": None, "finish_reason": finish_reason}
+        obj = "text_completion"
+    return {"id": request_id, "object": obj, "created": int(time.time()), "model": model_id, "choices": [choice]}
+
+def run_server(client_pool, host, port, logger, stop_sequences, **invoke_options):
+    """
+    Serves an OpenAI-compatible gateway in front of Bedrock until interrupted:
+    POST /v1/completions, POST /v1/chat/completions, GET /v1/models, GET /health and GET /metrics.
+    Each connection is handled on its own thread with HTTP/1.1 keep-alive. The X-Priority
+    and X-Tenant headers select the scheduler priority class and tenant.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    stats = {"in_flight": 0, "served": 0, "started_at": time.time()}
+    stats_lock = threading.Lock()
+
+    class GatewayHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+        server_version = "bedrock-gateway"
+
+        def log_message(self, format, *args):
+            logger.info(f"{self.address_string()} - {format % args}")
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_error(self, status, message, error_type):
+            self._send_json(status, {"error": {"message": message, "type": error_type}})
+
+        def _write_chunk(self, data):
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+
+        def _send_event(self, payload):
+            data = payload if isinstance(payload, str) else json.dumps(payload)
+            self._write_chunk(f"data: {data}\n\n".encode("utf-8"))
+
+        def do_GET(self):
+            if self.path == "/health":
+                with stats_lock:
+                    health = dict(stats, status="ok", uptime_seconds=round(time.time() - stats["started_at"], 1))
+                del health["started_at"]
+                if invoke_options.get("coalescer") is not None:
+                    health["coalesced"] = invoke_options["coalescer"].coalesced
+                if invoke_options.get("semantic_cache") is not None:
+                    health["semantic_cache"] = invoke_options["semantic_cache"].stats()
+                if invoke_options.get("router") is not None:
+                    health["regions"] = invoke_options["router"].snapshot()
+                    health["hedged"] = invoke_options["router"].hedged
+                self._send_json(200, health)
+            elif self.path == "/metrics":
+                if invoke_options.get("metrics") is None:
+                    self._send_error(404, "Metrics are not enabled.", "not_found")
+                    return
+                body = invoke_options["metrics"].render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif self.path == "/v1/models":
+                models = [{"id": model_id, "object": "model", "owned_by": provider}
+                          for provider, _, _, model_id in MODEL_REGISTRY.models()]
+                self._send_json(200, {"object": "list", "data": models})
+            else:
+                self._send_error(404, f"Unknown path: {self.path}", "not_found")
+
+        def do_POST(self):
+            if self.path not in ("/v1/completions", "/v1/chat/completions"):
+                self._send_error(404, f"Unknown path: {self.path}", "not_found")
+                return
+            kind = "chat" if self.path == "/v1/chat/completions" else "text"
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                model_id = request["model"]
+                conversation = {}
+                if kind == "chat":
+                    system, history, prompt_text = split_chat_messages(request["messages"])
+                    conversation = {"messages": history, "system": system}
+                else:
+                    prompt_text = request["prompt"]
+                    if isinstance(prompt_text, list):
+                        prompt_text = "\n".join(prompt_text)
+                max_tokens = request.get("max_tokens")
+                if max_tokens is not None:
+                    max_tokens = int(max_tokens)
+                    if max_tokens < 1:
+                        raise ValueError("'max_tokens' must be a positive integer.")
+                stop = parse_stop_sequences(request.get("stop"), stop_sequences)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                self._send_error(400, f"Invalid request body: {e}", "invalid_request_error")
+                return
+
+            model_config = find_model_configuration(model_id)
+            if not model_config:
+                self._send_error(404, f"Unsupported model: {model_id}", "model_not_found")
+                return
+            if model_config.get("api_type") == "embedding":
+                self._send_error(400, f"{model_id} is an embedding model.", "invalid_request_error")
+                return
+            if max_tokens is not None:
+                model_config = dict(model_config, max_tokens=max_tokens)
+
+            request_options = dict(invoke_options, **conversation)
+            if self.headers.get("X-Priority") in PRIORITY_CLASSES:
+                request_options["priority"] = self.headers["X-Priority"]
+            request_options["tenant"] = self.headers.get("X-Tenant") or request.get("user") or "default"
+
+            request_id = f"{'chatcmpl' if kind == 'chat' else 'cmpl'}-{os.urandom(12).hex()}"
+            with stats_lock:
+                stats["in_flight"] += 1
+            try:
+                if request.get("stream"):
+                    self._stream(kind, request_id, model_id, model_config, prompt_text, stop, request_options)
+                else:
+                    generation = generation_text(invoke_model(client_pool.get(), model_config, model_id, prompt_text,
+                                                              logger, stop, exit_on_error=False, **request_options))
+                    if generation is None:
+                        self._send_error(502, "No generation found in the response.", "upstream_error")
+                    else:
+                        self._send_json(200, openai_response(kind, request_id, model_id, generation))
+            except BedrockInvocationError as e:
+                self._send_error(502, str(e), "upstream_error")
+            finally:
+                with stats_lock:
+                    stats["in_flight"] -= 1
+                    stats["served"] += 1
+
+        def _stream(self, kind, request_id, model_id, model_config, prompt_text, stop, request_options):
+            deltas = invoke_model(client_pool.get(), model_config, model_id, prompt_text, logger, stop,
+                                  exit_on_error=False, stream=True, **request_options)
+            # Pull the first delta before sending headers so upstream errors still get a proper status
+            first_delta = next(deltas, None)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                if kind == "chat":
+                    self._send_event(openai_stream_chunk(kind, request_id, model_id, role="assistant"))
+                if first_delta is not None:
+                    self._send_event(openai_stream_chunk(kind, request_id, model_id, first_delta))
+                    for delta in deltas:
+                        self._send_event(openai_stream_chunk(kind, request_id, model_id, delta))
+            except BedrockInvocationError as e:
+                self._send_event({"error": {"message": str(e), "type": "upstream_error"}})
+            self._send_event(openai_stream_chunk(kind, request_id, model_id, finish_reason="stop"))
+            self._send_event("[DONE]")
+            self._write_chunk(b"")
+
+    server = ThreadingHTTPServer((host, port), GatewayHandler)
+    server.daemon_threads = True
+    message = f"Serving OpenAI-compatible Bedrock gateway on http://{host}:{server.server_address[1]}"
+    print(message)
+    logger.info(message)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Gateway interrupted; shutting down.")
+    finally:
+        server.server_close()
+
+def run_matrix_mode(args, region, logger, stop_sequences, metrics=None):
+    """
+    Runs --matrix: resolves the models and prompts from the arguments, then calls run_matrix.
+    """
+    model_ids = select_matrix_models(args.models)
+    if not model_ids:
+        logger.error(f"No registered models match --models {args.models}.")
+        sys.exit(1)
+    if args.batch:
+        prompts = list(read_batch_prompts(args.batch, logger))
+    else:
+        try:
+            prompts = [(1, {"prompt": read_prompt(args)})]
+        except OSError as e:
+            logger.error(f"Failed to read the prompt file: {e}")
+            sys.exit(1)
+    if not prompts:
+        logger.error("No prompts to compare.")
+        sys.exit(1)
+
+    client = create_bedrock_client(region, logger, max_pool_connections=max(args.workers, 10),
+                                   endpoint_url=args.endpoint_url)
+    retry = RetryEngine(logger, max_retries=args.max_retries, rate=args.rate, max_concurrency=args.workers)
+    router = create_region_router(get_region_pool(region), logger, max(args.workers, 10), args.endpoint_url,
+                                  args.hedge)
+    try:
+        run_matrix(client, model_ids, prompts, args.matrix_output, logger, stop_sequences, args.workers,
+                   retry=retry, router=router, metrics=metrics, tenant=args.tenant)
+    except OSError as e:
+        logger.error(f"Failed to write the comparison table: {e}")
+        sys.exit(1)
+
+def run_chat(client, model_config, model_id, logger, stop_sequences, stream=False, **invoke_options):
+    """
+    Runs an interactive conversation, sending the earlier turns with each new prompt.
+    An empty line, "exit", "quit" or end of input ends the conversation.
+    """
+    history = []
+    print(f"Chatting with {model_id}. Enter an empty line or \"exit\" to quit.")
+    while True:
+        try:
+            prompt_text = input("You: ").strip()
+        except EOFError:
+            print()
+            break
+        if prompt_text.lower() in ("", "exit", "quit"):
+            break
+        logger.info(f"Prompt: {prompt_text}")
+        try:
+            if stream:
+                print("Assistant: ", end="", flush=True)
+                deltas = []
+                for delta in invoke_model(client, model_config, model_id, prompt_text, logger, stop_sequences,
+                                          exit_on_error=False, stream=True, messages=list(history),
+                                          **invoke_options):
+                    print(delta, end="", flush=True)
+                    deltas.append(delta)
+                print()
+                generation = "".join(deltas).strip()
+            else:
+                generation = generation_text(invoke_model(client, model_config, model_id, prompt_text, logger,
+                                                          stop_sequences, exit_on_error=False,
+                                                          messages=list(history), **invoke_options))
+                print(f"Assistant: {generation}")
+        except BedrockInvocationError as e:
+            print(f"\nError: {e}")
+            continue
+        if not generation:
+            print("No generation received from the model.")
+            continue
+        logger.info("Response", extra={"body": generation})
+        history += [{"role": "user", "content": prompt_text}, {"role": "assistant", "content": generation}]
+
+def run_batch_job(bedrock_control, s3, job_arn, args, logger):
+    """
+    Waits for a submitted batch job and writes its results to --output, exiting on failure.
+    """
+    try:
+        job = wait_for_batch_job(bedrock_control, job_arn, logger, args.poll_seconds)
+        if job["status"] not in ("Completed", "PartiallyCompleted"):
+            logger.error(f"Batch job ended as {job['status']}: {job.get('message', 'no message')}")
+            sys.exit(1)
+        run_batch_job_results(s3, job, args.output, logger)
+    except _aws_errors() + (OSError, ValueError) as e:
+        logger.error(f"Failed to process batch job {job_arn}: {e}")
+        sys.exit(1)
+
+def parse_arguments():
+    """
+    Parses command-line arguments for log file path and execution directory.
+    """
+    parser = argparse.ArgumentParser(description="Invoke Bedrock model with a fixed prompt.")
+    parser.add_argument('--log', type=str, default="bedrock.log",
+                        help='Path to the log file.')
+    parser.add_argument('--execution_dir', type=str, default=None,
+                        help='Directory containing the .env file.')
+    parser.add_argument('--log-format', choices=["text", "json"], default="text",
+                        help='Write log records as plain text or as one JSON object per line.')
+    parser.add_argument('--log-max-bytes', type=int, default=10 * 1024 * 1024,
+                        help='Rotate the log file when it reaches this size.')
+    parser.add_argument('--log-rotate-seconds', type=int, default=86400,
+                        help='Rotate the log file after this many seconds (0 = size only).')
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help='Number of rotated log files to keep.')
+    parser.add_argument('--log-body-max-chars', type=int, default=2000,
+                        help='Truncate logged request payloads and responses to this many characters (0 = no limit).')
+    parser.add_argument('--log-body-sample-rate', type=float, default=1.0,
+                        help='Fraction of request payloads and responses to log (0.0-1.0).')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='Write Prometheus metrics to this file (textfile collector format) '
+                             'periodically and at exit.')
+    parser.add_argument('--metrics-interval', type=float, default=15.0,
+                        help='Seconds between --metrics-file writes.')
+    parser.add_argument('--model', type=str, default=None,
+                        help='Model ID to use instead of choosing from the interactive menu.')
+    prompt_group = parser.add_mutually_exclusive_group()
+    prompt_group.add_argument('--prompt', type=str, default=None,
+                              help='Prompt to send instead of the fixed prompt.')
+    prompt_group.add_argument('--prompt-file', type=str, default=None,
+                              help='File containing the prompt to send ("-" reads standard input).')
+    parser.add_argument('--converse', action='store_true',
+                        help='Call the model through the Converse API instead of its native request format.')
+    parser.add_argument('--chat', action='store_true',
+                        help='Start an interactive multi-turn conversation instead of sending a single prompt.')
+    parser.add_argument('--system-prompt-file', type=str, default=None,
+                        help='File with a system prompt sent ahead of every prompt.')
+    parser.add_argument('--context-file', type=str, default=None,
+                        help='File with shared context (e.g. reference documents) sent ahead of every prompt.')
+    parser.add_argument('--endpoint-url', type=str, default=None,
+                        help='Override the bedrock-runtime endpoint, e.g. for a local stand-in.')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run an OpenAI-compatible HTTP gateway instead of sending a single prompt.')
+    parser.add_argument('--host', type=str, default="127.0.0.1",
+                        help='Address the --serve gateway listens on.')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port the --serve gateway listens on.')
+    parser.add_argument('--serve-clients', type=int, default=4,
+                        help='Number of warm Bedrock clients shared by the --serve gateway.')
+    parser.add_argument('--batch', type=str, default=None,
+                        help='Path to a JSONL prompt file to run concurrently instead of the fixed prompt.')
+    parser.add_argument('--output', type=str, default="bedrock_results.jsonl",
+                        help='Path to the JSONL results file written in --batch and --batch-job mode.')
+    parser.add_argument('--matrix', action='store_true',
+                        help='Send the prompt (or each --batch prompt) to every model and compare them.')
+    parser.add_argument('--models', type=str, default=None,
+                        help='Comma-separated model IDs or wildcards (e.g. "meta.*") for --matrix (default: all).')
+    parser.add_argument('--matrix-output', type=str, default="bedrock_matrix.csv",
+                        help='Comparison table written by --matrix (.csv or .json).')
+    parser.add_argument('--pack', action='store_true',
+                        help='In --batch mode, pack several short prompts into each model call.')
+    parser.add_argument('--pack-size', type=int, default=16,
+                        help='Maximum prompts per packed call.')
+    parser.add_argument('--pack-answer-tokens', type=int, default=64,
+                        help='Output tokens reserved per answer in a packed call.')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Number of concurrent requests in --batch mode.')
+    parser.add_argument('--embed', type=str, default=None,
+                        help='Path to a JSONL document file to embed with an embedding model.')
+    parser.add_argument('--embed-output', type=str, default="embeddings",
+                        help='Output prefix for --embed: <prefix>.npy vectors and <prefix>.ids.jsonl IDs.')
+    parser.add_argument('--embed-dimensions', type=int, default=None,
+                        help='Embedding size for models that support it (e.g. 256, 512 or 1024 for Titan V2).')
+    parser.add_argument('--batch-job', type=str, default=None,
+                        help='Path to a JSONL prompt file to run as an asynchronous Bedrock batch inference job.')
+    parser.add_argument('--batch-job-arn', type=str, default=None,
+                        help='Wait for an already submitted batch job and download its results.')
+    parser.add_argument('--s3-uri', type=str, default=None,
+                        help='s3://bucket/prefix for --batch-job input and output files.')
+    parser.add_argument('--role-arn', type=str, default=None,
+                        help='IAM service role Bedrock assumes to read and write --s3-uri '
+                             '(default: BEDROCK_BATCH_ROLE_ARN).')
+    parser.add_argument('--s3-endpoint-url', type=str, default=None,
+                        help='Override the S3 endpoint, e.g. for a local stand-in such as moto.')
+    parser.add_argument('--shard-records', type=int, default=BATCH_JOB_MAX_SHARD_RECORDS,
+                        help='Maximum records per --batch-job input file.')
+    parser.add_argument('--poll-seconds', type=float, default=30,
+                        help='Initial interval between --batch-job status checks.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Print the response as it is generated using the response-stream API.')
+    parser.add_argument('--max-retries', type=int, default=4,
+                        help='Maximum retries for throttling and other transient errors.')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Maximum requests per second per model (0 = unlimited).')
+    parser.add_argument('--priority', choices=sorted(PRIORITY_CLASSES, key=PRIORITY_CLASSES.get), default=None,
+                        help='Priority class for requests (default: interactive, or bulk in --batch mode).')
+    parser.add_argument('--tenant', type=str, default="default",
+                        help='Tenant name used for fair queuing between callers sharing the client.')
+    parser.add_argument('--slo-ms', type=int, default=None,
+                        help='Drop a request that has not been sent within this many milliseconds.')
+    parser.add_argument('--reserved-interactive', type=int, default=None,
+                        help='Concurrent slots reserved for the interactive priority class '
+                             '(default: 2, at most --workers - 1).')
+    parser.add_argument('--hedge', action=argparse.BooleanOptionalAction, default=True,
+                        help='With several AWS_REGIONS, resend slow requests (past the p95) to a second region.')
+    parser.add_argument('--coalesce', action=argparse.BooleanOptionalAction, default=True,
+                        help='Share one upstream call among identical in-flight requests.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Path to a SQLite response cache shared across runs (enables caching).')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='Maximum number of responses kept in the in-memory cache tier.')
+    parser.add_argument('--cache-ttl', type=int, default=86400,
+                        help='Seconds before a cached response expires.')
+    parser.add_argument('--cache-nondeterministic', action='store_true',
+                        help='Also cache payloads with temperature > 0.')
+    parser.add_argument('--semantic-cache', action='store_true',
+                        help='Reuse generations for prompts similar in meaning to earlier prompts (requires NumPy).')
+    parser.add_argument('--semantic-cache-model', type=str, default="amazon.titan-embed-text-v2:0",
+                        help='Embedding model used to compare prompts for --semantic-cache.')
+    parser.add_argument('--semantic-threshold', type=float, default=0.95,
+                        help='Minimum cosine similarity for a --semantic-cache hit.')
+    parser.add_argument('--semantic-cache-size', type=int, default=10000,
+                        help='Maximum prompts kept per model in the --semantic-cache.')
+    parser.add_argument('--semantic-cache-policy', choices=["lru", "lfu"], default="lru",
+                        help='Eviction policy when the --semantic-cache is full.')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+    if args.pack and not args.batch:
+        parser.error("--pack requires --batch.")
+    if args.pack_size < 2 or args.pack_answer_tokens < 1:
+        parser.error("--pack-size must be at least 2 and --pack-answer-tokens at least 1.")
+    if args.max_retries < 0 or args.rate < 0:
+        parser.error("--max-retries and --rate must not be negative.")
+    if args.reserved_interactive is None:
+        args.reserved_interactive = max(0, min(2, args.workers - 1))
+    if not 0 <= args.reserved_interactive < args.workers:
+        parser.error("--reserved-interactive must be between 0 and --workers - 1.")
+    if not 0.0 <= args.log_body_sample_rate <= 1.0:
+        parser.error("--log-body-sample-rate must be between 0.0 and 1.0.")
+    if not 0.0 < args.semantic_threshold <= 1.0:
+        parser.error("--semantic-threshold must be between 0.0 (exclusive) and 1.0.")
+    if args.semantic_cache_size < 1:
+        parser.error("--semantic-cache-size must be at least 1.")
+    if args.metrics_interval <= 0:
+        parser.error("--metrics-interval must be positive.")
+    # --batch only supplies the prompts when combined with --matrix
+    modes = (args.serve, args.batch and not args.matrix, args.embed, args.batch_job, args.batch_job_arn, args.chat,
+             args.matrix)
+    if sum(bool(mode) for mode in modes) > 1:
+        parser.error("--serve, --batch, --embed, --batch-job, --batch-job-arn, --chat and --matrix "
+                     "cannot be combined (except --matrix with --batch).")
+    if args.models and not args.matrix:
+        parser.error("--models requires --matrix.")
+    if args.embed_dimensions is not None and not args.embed:
+        parser.error("--embed-dimensions requires --embed.")
+    if args.pack and args.matrix:
+        parser.error("--pack cannot be used with --matrix.")
+    if args.batch_job and not args.s3_uri:
+        parser.error("--batch-job requires --s3-uri.")
+    if args.s3_uri and not args.s3_uri.startswith("s3://"):
+        parser.error("--s3-uri must start with s3://.")
+    if not 1 <= args.shard_records <= BATCH_JOB_MAX_SHARD_RECORDS:
+        parser.error(f"--shard-records must be between 1 and {BATCH_JOB_MAX_SHARD_RECORDS}.")
+    if args.poll_seconds <= 0:
+        parser.error("--poll-seconds must be positive.")
+    return args
+
+def read_prompt(args):
+    """
+    Returns the prompt from --prompt or --prompt-file, or the fixed prompt if neither is given.
+    """
+    if args.prompt is not None:
+        return args.prompt
+    if args.prompt_file == "-":
+        return sys.stdin.read().strip()
+    if args.prompt_file:
+        with open(args.prompt_file, 'r', encoding='utf-8') as prompt_file:
+            return prompt_file.read().strip()
+    return "Siapa presiden ke-4 Indonesia?"
+
+def display_model_selection(logger):
+    """
+    Displays the model selection menu and returns the selected model_id.
+    """
+    print("----------------------------------------")
+    print("Choose the model to deploy:")
+    print("----------------------------------------")
+
+    # The list of available models comes from the model registry file
+    models = MODEL_REGISTRY.models()
+
+    # Display the models with numbering
+    for index, model in enumerate(models, start=1):
+        provider, model_name, version, model_id = model
+        print(f"{index}. {provider} - {model_name} (Version: {version})")
+
+    # Prompt the user for selection
+    while True:
+        try:
+            model_choice = int(input("Enter the number corresponding to the model:"))
+            if 1 <= model_choice <= len(models):
+                selected_model = models[model_choice - 1]
+                provider, model_name, version, model_id = selected_model
+                logger.info(f"Selected Model: {provider} - {model_name} (Version: {version})")
+                logger.info(f"Model ID set to: {model_id}")
+
+                # Confirmation message to the user
+                print("----------------------------------------------------------------")
+                print(f"Selected Model: {provider} - {model_name} (Version: {version})")
+                return model_id
+            else:
+                print("Invalid choice. Please select a valid number from the list.")
+        except ValueError:
+            print("Invalid input. Please enter a number.")
+
+def main():
+    args = parse_arguments()
+    logger = setup_logger(args.log, args.log_max_bytes, args.log_backups, args.log_rotate_seconds, args.log_format,
+                          args.log_body_max_chars, args.log_body_sample_rate)
+
+    load_environment(args.execution_dir, logger)
+    region, stop_sequences = get_env_variables(logger, args)
+
+    # Load the model registry before anything looks up a model
+    try:
+        MODEL_REGISTRY.load()
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load the model registry: {e}")
+        sys.exit(1)
+
+    # The gateway always collects metrics for GET /metrics; other modes only when a file is requested
+    metrics = BedrockMetrics() if args.serve or args.metrics_file else None
+    if args.metrics_file:
+        start_metrics_file_writer(metrics, args.metrics_file, logger, args.metrics_interval)
+
+    # Gateway mode serves any registered model, so it skips model selection
+    if args.serve:
+        client_pool = ClientPool(region, logger, args.serve_clients, max(args.workers, 10), args.endpoint_url)
+        cache = None
+        if args.cache:
+            cache = ResponseCache(logger, args.cache, args.cache_size, args.cache_ttl, args.cache_nondeterministic)
+        retry = RetryEngine(logger, max_retries=args.max_retries, rate=args.rate, max_concurrency=args.workers)
+        scheduler = PriorityScheduler(logger, capacity=args.workers, reserved_interactive=args.reserved_interactive)
+        coalescer = RequestCoalescer(logger) if args.coalesce else None
+        router = create_region_router(get_region_pool(region), logger, max(args.workers, 10), args.endpoint_url,
+                                      args.hedge)
+        semantic_cache = None
+        if args.semantic_cache:
+            semantic_cache = create_semantic_cache(logger, client_pool.get, args.semantic_cache_model,
+                                                   args.semantic_threshold, args.semantic_cache_size,
+                                                   args.semantic_cache_policy, retry, metrics)
+        run_server(client_pool, args.host, args.port, logger, stop_sequences, cache=cache, retry=retry,
+                   scheduler=scheduler, priority=args.priority or "interactive", coalescer=coalescer, router=router,
+                   metrics=metrics, semantic_cache=semantic_cache)
+        if cache is not None:
+            cache.close()
+        return
+
+    # Resuming a batch job takes the model from the job itself
+    if args.batch_job_arn:
+        bedrock_control = create_aws_client("bedrock", region, logger)
+        s3 = create_aws_client("s3", region, logger, args.s3_endpoint_url or os.getenv('S3_ENDPOINT_URL'),
+                               max(args.workers, 10))
+        run_batch_job(bedrock_control, s3, args.batch_job_arn, args, logger)
+        return
+
+    # Matrix mode compares many models, so it skips model selection
+    if args.matrix:
+        run_matrix_mode(args, region, logger, stop_sequences, metrics)
+        return
+
+    # Model Selection, skipped when --model is given
+    if args.model:
+        model_id = args.model
+        logger.info(f"Model ID set to: {model_id}")
+    else:
+        model_id = display_model_selection(logger)
+
+    # Find the model configuration based on model_id before building any client
+    model_config = find_model_configuration(model_id)
+    if not model_config:
+        logger.error(f"Unsupported model_id: {model_id}. Please update bedrock_models.json.")
+        sys.exit(1)
+    if (model_config.get("api_type") == "embedding") != bool(args.embed):
+        if args.embed:
+            logger.error(f"{model_id} is not an embedding model.")
+        else:
+            logger.error(f"{model_id} is an embedding model; use --embed.")
+        sys.exit(1)
+    if args.embed_dimensions:
+        # Models without a declared list ignore the parameter (Titan V1 always returns 1536 values)
+        supported_dimensions = model_config.get("embed_dimensions", [])
+        if args.embed_dimensions not in supported_dimensions:
+            supported = ", ".join(map(str, supported_dimensions)) or "none"
+            logger.error(f"--embed-dimensions {args.embed_dimensions} is not supported by {model_id} "
+                         f"(supported: {supported}).")
+            sys.exit(1)
+        model_config = dict(model_config, dimensions=args.embed_dimensions)
+    if args.converse:
+        if model_config.get("api_type") == "embedding":
+            logger.error("--converse cannot be used with an embedding model.")
+            sys.exit(1)
+        model_config = dict(model_config, api_type="converse")
+
+    # Shared system prompt and context, sent ahead of every prompt
+    conversation = {}
+    try:
+        for key, path in (("system", args.system_prompt_file), ("context", args.context_file)):
+            if path:
+                with open(path, 'r', encoding='utf-8') as prefix_file:
+                    conversation[key] = prefix_file.read().strip() or None
+    except OSError as e:
+        logger.error(f"Failed to read the system prompt or context file: {e}")
+        sys.exit(1)
+    if conversation and (args.embed or args.batch_job):
+        logger.error("--system-prompt-file and --context-file cannot be used with --embed or --batch-job.")
+        sys.exit(1)
+
+    # Batch inference jobs run inside Bedrock, so they need no bedrock-runtime client
+    if args.batch_job:
+        role_arn = args.role_arn or os.getenv('BEDROCK_BATCH_ROLE_ARN')
+        if not role_arn:
+            logger.error("--batch-job requires --role-arn or BEDROCK_BATCH_ROLE_ARN.")
+            sys.exit(1)
+        bedrock_control = create_aws_client("bedrock", region, logger)
+        s3 = create_aws_client("s3", region, logger, args.s3_endpoint_url or os.getenv('S3_ENDPOINT_URL'),
+                               max(args.workers, 10))
+        try:
+            job_arn = submit_batch_job(bedrock_control, s3, args.batch_job, model_id, model_config, logger,
+                                       stop_sequences, args.s3_uri, role_arn, args.shard_records, args.workers)
+        except _aws_errors() + (OSError, ValueError) as e:
+            logger.error(f"Failed to submit the batch job: {e}")
+            sys.exit(1)
+        print(f"Submitted batch job: {job_arn}")
+        run_batch_job(bedrock_control, s3, job_arn, args, logger)
+        return
+
+    # Initialize Bedrock client, sized so every batch worker gets its own pooled connection
+    client = create_bedrock_client(region, logger, max_pool_connections=max(args.workers, 10),
+                                   endpoint_url=args.endpoint_url)
+
+    cache = None
+    if args.cache:
+        cache = ResponseCache(logger, args.cache, args.cache_size, args.cache_ttl, args.cache_nondeterministic)
+        # Every request to this model has the same temperature, so one sample payload tells whether any is cached
+        if model_config.get("api_type") == "converse":
+            sample_body = build_converse_request(model_config, "", stop_sequences)
+        else:
+            sample_body = build_request_body(model_config, "", stop_sequences)
+        if not cache.is_cacheable(sample_body):
+            logger.warning(f"{model_id} samples with a temperature above 0, so --cache will store nothing. "
+                           f"Add --cache-nondeterministic, or set \"temperature\": 0 for it in bedrock_models.json.")
+    retry = RetryEngine(logger, max_retries=args.max_retries, rate=args.rate, max_concurrency=args.workers)
+    scheduler = PriorityScheduler(logger, capacity=args.workers, reserved_interactive=args.reserved_interactive)
+    coalescer = RequestCoalescer(logger) if args.coalesce else None
+    router = create_region_router(get_region_pool(region), logger, max(args.workers, 10), args.endpoint_url,
+                                  args.hedge)
+    semantic_cache = None
+    if args.semantic_cache and not args.embed:
+        semantic_cache = create_semantic_cache(logger, lambda: client, args.semantic_cache_model,
+                                               args.semantic_threshold, args.semantic_cache_size,
+                                               args.semantic_cache_policy, retry, metrics)
+    invoke_options = {
+        "coalescer": coalescer,
+        "router": router,
+        "scheduler": scheduler,
+        "priority": args.priority or ("bulk" if args.batch or args.embed else "interactive"),
+        "tenant": args.tenant,
+        "metrics": metrics,
+        "semantic_cache": semantic_cache,
+        **conversation,
+    }
+
+    # Batch Prompt Handling
+    if args.batch:
+        if args.pack:
+            run_packed_batch(client, args.batch, args.output, model_id, logger, stop_sequences, args.workers,
+                             args.pack_size, args.pack_answer_tokens, cache=cache, retry=retry, slo_ms=args.slo_ms,
+                             **invoke_options)
+        else:
+            run_batch(client, args.batch, args.output, model_id, logger, stop_sequences, args.workers,
+                      cache=cache, retry=retry, slo_ms=args.slo_ms, **invoke_options)
+        if router is not None:
+            logger.info(f"Region health: {json.dumps(router.snapshot())} (hedged={router.hedged})")
+        if semantic_cache is not None:
+            logger.info(f"Semantic cache stats: {json.dumps(semantic_cache.stats())}")
+        if cache is not None:
+            cache.close()
+        return
+
+    # Embedding Handling
+    if args.embed:
+        try:
+            run_embedding(client, model_config, model_id, args.embed, args.embed_output, logger, args.workers,
+                          cache=cache, retry=retry, **invoke_options)
+        except (OSError, ValueError) as e:
+            logger.error(f"Embedding run failed: {e}")
+            sys.exit(1)
+        if cache is not None:
+            cache.close()
+        return
+
+    # Interactive multi-turn conversation
+    if args.chat:
+        run_chat(client, model_config, model_id, logger, stop_sequences, args.stream, retry=retry, **invoke_options)
+        return
+
+    # Prompt Handling: --prompt, --prompt-file or the fixed prompt
+    try:
+        prompt_text = read_prompt(args)
+    except OSError as e:
+        logger.error(f"Failed to read the prompt file: {e}")
+        sys.exit(1)
+    if not prompt_text:
+        logger.error("The prompt is empty.")
+        sys.exit(1)
+
+    # Log the prompt
+    logger.info(f"Using prompt: {prompt_text}")
+
+    # Log which provider is being used
+    logger.info(f"Using provider: {model_config['provider']}")
+
+    deadline = time.monotonic() + args.slo_ms / 1000 if args.slo_ms else None
+    if args.stream:
+        print(f"Model ID: {model_id}")
+        print(f"Prompt: {prompt_text}")
+        print("Response: ", end="", flush=True)
+        deltas = []
+        for delta in invoke_model(client, model_config, model_id, prompt_text, logger, stop_sequences, stream=True,
+                                  retry=retry, deadline=deadline, **invoke_options):
+            print(delta, end="", flush=True)
+            deltas.append(delta)
+        print()
+        generation = "".join(deltas).strip()
+        if generation:
+            logger.info(f"Model ID: {model_id}")
+            logger.info(f"Prompt: {prompt_text}")
+            logger.info("Response", extra={"body": generation})
+        else:
+            logger.error("No generation received from the model.")
+        return
 
-    generation = invoke_model(client, model_config, model_id, prompt_text, logger, stop_sequences)
+    generation = invoke_model(client, model_config, model_id, prompt_text, logger, stop_sequences, cache=cache,
+                              retry=retry, deadline=deadline, **invoke_options)
+    if cache is not None:
+        cache.close()
 
     if generation:
         formatted_model_id = f"Model ID: {model_id}"
@@ -296,7 +3590,7 @@ def main():
         # Log the information
         logger.info(formatted_model_id)
         logger.info(formatted_prompt)
-        logger.info(formatted_response)
+        logger.info("Response", extra={"body": generation})
     else:
         logger.error("No generation received from the model.")
 
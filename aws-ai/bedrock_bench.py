@@ -0,0 +1,298 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+# Never sign requests to the local stand-in with real credentials
+os.environ["AWS_ACCESS_KEY_ID"] = "bench"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "bench"
+os.environ.pop("AWS_SESSION_TOKEN", None)
+
+import bedrock
+from latency_stats import percentile
+
+# One representative model per provider in MODEL_PREFIX_CONFIGURATIONS
+BENCH_MODELS = {
+    "amazon": "amazon.titan-text-express-v1",
+    "anthropic": "anthropic.claude-v2:1",
+    "meta": "meta.llama3-8b-instruct-v1:0",
+    "mistral": "mistral.mistral-7b-instruct-v0:2",
+}
+
+BENCH_PROMPT = "Siapa presiden ke-4 Indonesia?"
+
+def fake_response_body(provider, payload_bytes):
+    """
+    Returns a response body in the provider's format whose generated text is payload_bytes long.
+    """
+    text = ("Abdurrahman Wahid " * (payload_bytes // 18 + 1))[:payload_bytes]
+    if provider == "amazon":
+        return {"inputTextTokenCount": 8, "results": [{"tokenCount": 64, "outputText": text,
+                                                       "completionReason": "FINISH"}]}
+    if provider == "anthropic":
+        return {"completion": text, "stop_reason": "stop_sequence"}
+    if provider == "meta":
+        return {"generation": text, "prompt_token_count": 8, "generation_token_count": 64, "stop_reason": "stop"}
+    return {"outputs": [{"text": text, "stop_reason": "stop"}]}
+
+class FakeBedrockHandler(BaseHTTPRequestHandler):
+    """
+    Serves POST /model/{modelId}/invoke like bedrock-runtime, after a configurable delay.
+    """
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; Nagle's algorithm would add ~40 ms per response
+    disable_nagle_algorithm = True
+    latency_seconds = 0.0
+    payload_bytes = 512
+    bodies = {}
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        parts = self.path.split("/")
+        model_id = unquote(parts[2]) if len(parts) > 3 and parts[1] == "model" else ""
+        model_config = bedrock.find_model_configuration(model_id)
+        if model_config is None:
+            body = json.dumps({"message": f"Unknown model {model_id}"}).encode("utf-8")
+            self.send_response(400)
+            self.send_header("x-amzn-ErrorType", "ValidationException")
+        else:
+            provider = model_config["provider"]
+            if provider not in self.bodies:
+                self.bodies[provider] = json.dumps(fake_response_body(provider, self.payload_bytes)).encode("utf-8")
+            body = self.bodies[provider]
+            time.sleep(self.latency_seconds)
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_server(latency_ms, payload_bytes):
+    """
+    Starts the fake bedrock-runtime on a free local port and returns (server, endpoint_url).
+    """
+    FakeBedrockHandler.latency_seconds = latency_ms / 1000
+    FakeBedrockHandler.payload_bytes = payload_bytes
+    FakeBedrockHandler.bodies = {}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBedrockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def time_operation(operation, iterations):
+    """
+    Runs operation iterations times and returns the mean cost in nanoseconds.
+    """
+    started = time.perf_counter_ns()
+    for _ in range(iterations):
+        operation()
+    return (time.perf_counter_ns() - started) / iterations
+
+def run_micro_benchmarks(iterations, payload_bytes):
+    """
+    Measures the local cost of each step of invoke_model, per provider.
+    """
+    results = {}
+    lookups = {
+        "exact": BENCH_MODELS["meta"],
+        "prefix": "meta.llama9-unreleased-v1:0",
+        "miss": "cohere.command-text-v14",
+    }
+    for name, model_id in lookups.items():
+        results[f"find_model_configuration.{name}"] = time_operation(
+            lambda: bedrock.find_model_configuration(model_id), iterations)
+
+    for provider, model_id in BENCH_MODELS.items():
+        model_config = bedrock.find_model_configuration(model_id)
+        config = model_config["config_builder"](BENCH_PROMPT, [], model_config["max_tokens"])
+        config_json = json.dumps(config)
+        response_body = fake_response_body(provider, payload_bytes)
+        response_json = json.dumps(response_body)
+        results[f"config_builder.{provider}"] = time_operation(
+            lambda: model_config["config_builder"](BENCH_PROMPT, [], model_config["max_tokens"]), iterations)
+        results[f"json_encode.{provider}"] = time_operation(lambda: json.dumps(config), iterations)
+        results[f"json_decode.{provider}"] = time_operation(lambda: json.loads(response_json), iterations)
+        results[f"response_parser.{provider}"] = time_operation(
+            lambda: model_config["response_parser"](response_body), iterations)
+        results[f"payload_bytes.{provider}"] = len(config_json)
+    return {name: round(value, 1) for name, value in results.items()}
+
+def run_end_to_end(endpoint_url, concurrency, requests_count, logger):
+    """
+    Sends requests_count prompts through invoke_model at the given concurrency against the
+    fake endpoint and returns throughput and latency percentiles.
+    """
+    client = bedrock.create_bedrock_client("us-west-2", logger, max_pool_connections=concurrency,
+                                           endpoint_url=endpoint_url)
+    retry = bedrock.RetryEngine(logger, max_concurrency=concurrency)
+    scheduler = bedrock.PriorityScheduler(logger, capacity=concurrency, reserved_interactive=0)
+    model_ids = list(BENCH_MODELS.values())
+
+    def one_request(index):
+        model_id = model_ids[index % len(model_ids)]
+        model_config = bedrock.find_model_configuration(model_id)
+        started = time.perf_counter()
+        try:
+            generation = bedrock.invoke_model(client, model_config, model_id, BENCH_PROMPT, logger, [],
+                                              exit_on_error=False, retry=retry, scheduler=scheduler,
+                                              priority="interactive")
+        except bedrock.BedrockInvocationError:
+            generation = None
+        return (time.perf_counter() - started) * 1000, generation is not None
+
+    # Warm the connection pool so connection setup is not counted in the percentiles
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(concurrency)))
+        started = time.perf_counter()
+        samples = list(executor.map(one_request, range(requests_count)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in samples)
+    return {
+        "concurrency": concurrency,
+        "requests": requests_count,
+        "errors": sum(1 for _, ok in samples if not ok),
+        "throughput_rps": round(requests_count / elapsed, 1),
+        "mean_ms": round(statistics.fmean(latencies), 2),
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+    }
+
+def run_startup_benchmark(endpoint_url, runs):
+    """
+    Measures cold-start cost in fresh interpreters: bare interpreter startup, importing
+    bedrock, and a full non-interactive `bedrock.py --model --prompt` run against the fake endpoint.
+    Returns the median of each over the given number of runs, in milliseconds.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, AWS_REGION="us-west-2", BEDROCK_ENDPOINT_URL=endpoint_url)
+    import_snippet = ("import time; started = time.perf_counter(); import bedrock; "
+                      "print((time.perf_counter() - started) * 1000)")
+    samples = {"interpreter_ms": [], "import_ms": [], "cli_first_request_ms": []}
+    with tempfile.TemporaryDirectory() as work_dir:
+        cli = [sys.executable, os.path.join(script_dir, "bedrock.py"), "--model", BENCH_MODELS["meta"],
+               "--prompt", BENCH_PROMPT, "--log", os.path.join(work_dir, "bench.log")]
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "pass"], check=True)
+            samples["interpreter_ms"].append((time.perf_counter() - started) * 1000)
+
+            output = subprocess.run([sys.executable, "-c", import_snippet], cwd=script_dir, env=env,
+                                    check=True, capture_output=True, text=True).stdout
+            samples["import_ms"].append(float(output.strip()))
+
+            # Run from an empty directory so no .env is loaded and nothing is written next to the script
+            started = time.perf_counter()
+            subprocess.run(cli, cwd=work_dir, env=env, check=True, capture_output=True)
+            samples["cli_first_request_ms"].append((time.perf_counter() - started) * 1000)
+    return {name: round(statistics.median(values), 1) for name, values in samples.items()}
+
+def compare_with_baseline(results, baseline_path, threshold):
+    """
+    Prints every measurement that is more than threshold slower than the baseline file
+    and returns the number of regressions found.
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = 0
+    for name, value in results["micro"].items():
+        previous = baseline.get("micro", {}).get(name)
+        if name.startswith("payload_bytes.") or not previous:
+            continue
+        if value > previous * (1 + threshold):
+            print(f"REGRESSION {name}: {previous} ns -> {value} ns")
+            regressions += 1
+    for name, value in results.get("startup", {}).items():
+        previous = baseline.get("startup", {}).get(name)
+        if previous and value > previous * (1 + threshold):
+            print(f"REGRESSION startup {name}: {previous} ms -> {value} ms")
+            regressions += 1
+    previous_runs = {run["concurrency"]: run for run in baseline.get("end_to_end", [])}
+    for run in results["end_to_end"]:
+        previous = previous_runs.get(run["concurrency"])
+        if previous and run["p99_ms"] > previous["p99_ms"] * (1 + threshold):
+            print(f"REGRESSION end_to_end c={run['concurrency']} p99: {previous['p99_ms']} ms -> {run['p99_ms']} ms")
+            regressions += 1
+    return regressions
+
+def parse_arguments():
+    """
+    Parses command-line arguments for the benchmark run.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark bedrock.py against a local bedrock-runtime stand-in.")
+    parser.add_argument('--iterations', type=int, default=20000,
+                        help='Iterations per micro-benchmark.')
+    parser.add_argument('--requests', type=int, default=400,
+                        help='Requests per end-to-end concurrency level.')
+    parser.add_argument('--concurrency', type=str, default="1,4,16,64",
+                        help='Comma-separated end-to-end concurrency levels.')
+    parser.add_argument('--latency-ms', type=float, default=20,
+                        help='Simulated model latency of the fake endpoint.')
+    parser.add_argument('--payload-bytes', type=int, default=512,
+                        help='Length of the generated text returned by the fake endpoint.')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='Fresh-interpreter runs for the startup benchmark (0 = skip).')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write the JSON results to this file instead of stdout.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Previous results file; exit with status 1 if any measurement regressed.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown relative to --baseline (0.2 = 20%%).')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    logger = logging.getLogger("bedrock_bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    concurrency_levels = [int(level) for level in args.concurrency.split(",") if level]
+    bedrock.MODEL_REGISTRY.load()
+
+    server, endpoint_url = start_fake_server(args.latency_ms, args.payload_bytes)
+    try:
+        results = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "latency_ms": args.latency_ms,
+                "payload_bytes": args.payload_bytes,
+                "iterations": args.iterations,
+            },
+            "micro": run_micro_benchmarks(args.iterations, args.payload_bytes),
+            "end_to_end": [run_end_to_end(endpoint_url, level, args.requests, logger)
+                           for level in concurrency_levels],
+        }
+        if args.startup_runs > 0:
+            results["startup"] = run_startup_benchmark(endpoint_url, args.startup_runs)
+    finally:
+        server.shutdown()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + "\n")
+        print(f"Benchmark results written to {args.output}")
+    else:
+        print(output)
+
+    if args.baseline and compare_with_baseline(results, args.baseline, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import math
+import threading
+from collections import deque
+
+# Latency statistics shared by bedrock.py, bedrock_bench.py and multi-cloud-ai/llm_client.py.
+# Standard library only, so importing it never pulls in boto3 or botocore.
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the nearest-rank percentile (fraction between 0 and 1) of an already sorted list,
+    or None if it is empty.
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+class LatencyWindow:
+    """
+    The most recent latencies of one upstream, for percentile estimates. Once min_samples
+    latencies have been seen, hedge_delay returns their p95. Thread-safe.
+    """
+
+    def __init__(self, maxlen=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def _sorted(self):
+        with self._lock:
+            return sorted(self._samples)
+
+    def percentile(self, fraction):
+        """
+        Returns the given percentile of the recent latencies, or None without samples.
+        """
+        return percentile(self._sorted(), fraction)
+
+    def hedge_delay(self):
+        """
+        Returns the p95 latency, or None until min_samples latencies have been seen.
+        """
+        samples = self._sorted()
+        if len(samples) < self.min_samples:
+            return None
+        return percentile(samples, 0.95)
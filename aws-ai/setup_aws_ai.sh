@@ -415,6 +415,22 @@ download_bedrock_py() {
   fi
 }
 
+# Function to ensure bedrock_models.json (the model registry read by bedrock.py) is present
+download_bedrock_models() {
+  if [ ! -f "bedrock_models.json" ]; then
+    log "INFO" "bedrock_models.json not found. Downloading from repository..."
+    curl -sL "https://raw.githubusercontent.com/GDP-ADMIN/codehub/main/aws-ai/bedrock_models.json" -o "bedrock_models.json" >> "$LOG_FILE" 2>&1
+    if [ $? -eq 0 ]; then
+      log "INFO" "bedrock_models.json downloaded successfully."
+    else
+      handle_error "Failed to download bedrock_models.json." 36
+      exit 1
+    fi
+  else
+    log "INFO" "bedrock_models.json is already present."
+  fi
+}
+
 # Function to run bedrock.py and capture the model response
 run_bedrock_py() {
   if [ -f "bedrock.py" ]; then
@@ -533,6 +549,9 @@ configure_aws_profile "$profile_name"
 # Ensure bedrock.py is present; if not, download it
 download_bedrock_py
 
+# Ensure the model registry is present next to bedrock.py
+download_bedrock_models
+
 # Run bedrock.py script and capture the model response
 run_bedrock_py
 
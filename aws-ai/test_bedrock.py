@@ -0,0 +1,301 @@
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import bedrock
+
+
+class LoggingPipelineTest(unittest.TestCase):
+
+    def test_json_log_keeps_exception_through_queue(self):
+        handler = bedrock.DroppingQueueHandler(queue.Queue())
+        logger = logging.getLogger("test_bedrock.logging")
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            try:
+                raise ValueError("boom")
+            except ValueError:
+                logger.exception("Request %s failed", "r-1")
+        finally:
+            logger.removeHandler(handler)
+
+        record = handler.queue.get_nowait()
+        entry = json.loads(bedrock.JsonLogFormatter().format(record))
+        self.assertEqual(entry["message"], "Request r-1 failed")
+        self.assertIn("ValueError: boom", entry["exception"])
+
+    def test_text_log_keeps_exception_through_queue(self):
+        handler = bedrock.DroppingQueueHandler(queue.Queue())
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = logging.LogRecord("x", logging.ERROR, __file__, 1, "failed", None, sys.exc_info())
+        prepared = handler.prepare(record)
+        text = bedrock.BodyTextFormatter("%(message)s").format(prepared)
+        self.assertTrue(text.startswith("failed\n"))
+        self.assertEqual(text.count("ValueError: boom"), 1)
+
+
+class GatewayHelpersTest(unittest.TestCase):
+
+    def test_generation_text_joins_mistral_outputs(self):
+        outputs = [{"text": "Hello ", "stop_reason": None}, {"text": "world", "stop_reason": "stop"}]
+        self.assertEqual(bedrock.generation_text(outputs), "Hello world")
+        self.assertEqual(bedrock.generation_text("plain"), "plain")
+        self.assertIsNone(bedrock.generation_text({"text": "x"}))
+
+    def test_parse_stop_sequences(self):
+        self.assertEqual(bedrock.parse_stop_sequences(None, ["\n"]), ["\n"])
+        self.assertEqual(bedrock.parse_stop_sequences("END", None), ["END"])
+        self.assertEqual(bedrock.parse_stop_sequences(["a", "b"], None), ["a", "b"])
+        for invalid in (3, ["a", 1], {"a": "b"}):
+            with self.assertRaises(ValueError):
+                bedrock.parse_stop_sequences(invalid, None)
+
+
+class RegionRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = bedrock.RegionRouter({"us-east-1": None, "us-west-2": None, "eu-west-1": None},
+                                           logging.getLogger("test_bedrock.router"), hedge=False, explore=0)
+
+    def tearDown(self):
+        self.router._executor.shutdown()
+
+    def test_failed_only_region_ranks_last(self):
+        self.router.record("us-east-1", "m", 5.0, True)
+        self.router.record("us-west-2", "m", 2.0, False)
+        self.router.record("eu-west-1", "m", 1.0, False)
+        self.assertEqual(self.router.ranked_regions("m"), ["eu-west-1", "us-west-2", "us-east-1"])
+
+    def test_untried_region_ranks_first(self):
+        self.router.record("us-east-1", "m", 5.0, True)
+        self.router.record("us-west-2", "m", 2.0, False)
+        self.assertEqual(self.router.ranked_regions("m"), ["eu-west-1", "us-west-2", "us-east-1"])
+
+    def test_failed_only_regions_ordered_by_error_rate(self):
+        for _ in range(3):
+            self.router.record("us-east-1", "m", 1.0, True)
+        self.router.record("us-west-2", "m", 1.0, True)
+        self.router.record("eu-west-1", "m", 1.0, False)
+        self.assertEqual(self.router.ranked_regions("m"), ["eu-west-1", "us-west-2", "us-east-1"])
+
+    def test_hedged_call_settles_after_loser_finishes(self):
+        router = bedrock.RegionRouter({"slow": "slow", "fast": "fast"}, logging.getLogger("test_bedrock.router"),
+                                      min_hedge_samples=1, explore=0)
+        self.addCleanup(router._executor.shutdown)
+        router.record("slow", "m", 0.01, False)
+        router.record("fast", "m", 0.02, False)
+        unblock = threading.Event()
+        settled = threading.Event()
+
+        def operation(client):
+            if client == "slow":
+                unblock.wait(5)
+            return client
+
+        self.assertEqual(router.call("m", operation, on_settled=settled.set), "fast")
+        self.assertEqual(router.hedged, 1)
+        self.assertFalse(settled.is_set())
+        unblock.set()
+        self.assertTrue(settled.wait(5))
+
+    def test_hedged_request_keeps_scheduler_slot_until_settled(self):
+        scheduler = bedrock.PriorityScheduler(logging.getLogger("test_bedrock.scheduler"), capacity=2,
+                                              reserved_interactive=1)
+        settle = []
+        router = mock.Mock()
+        router.call.side_effect = lambda model_id, operation, on_settled: settle.append(on_settled) or "answer"
+        result = bedrock._with_retry_routed(None, router, "m", None, scheduler=scheduler)
+        self.assertEqual(result, "answer")
+        self.assertEqual(scheduler.running, 1)
+        settle[0]()
+        self.assertEqual(scheduler.running, 0)
+
+
+class ModelRegistryTest(unittest.TestCase):
+
+    DECLARATION = {
+        "providers": {
+            "amazon": {"prefixes": ["^amazon.*"], "max_tokens": 150},
+            "titan-embed": {"prefixes": ["^amazon\\.titan-embed.*"]},
+            "meta": {"prefixes": ["^(meta|llama)-.*"]},
+        },
+        "models": [{"model_id": "amazon.titan-text-express-v1", "provider": "amazon", "name": "Express",
+                    "version": "1.x", "max_tokens": 300}],
+    }
+
+    def setUp(self):
+        registry_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        self.addCleanup(os.remove, registry_file.name)
+        with registry_file:
+            json.dump(self.DECLARATION, registry_file)
+        self.path = registry_file.name
+        self.registry = bedrock.ModelRegistry(self.path, reload_interval=0)
+
+    def test_lookup_falls_back_from_exact_id_to_prefix_and_regex(self):
+        self.assertEqual(self.registry.lookup("amazon.titan-text-express-v1")["max_tokens"], 300)
+        self.assertEqual(self.registry.lookup("amazon.titan-embed-image-v1")["provider"], "titan-embed")
+        self.assertEqual(self.registry.lookup("amazonx")["max_tokens"], 150)
+        self.assertEqual(self.registry.lookup("llama-3")["provider"], "meta")
+        self.assertIsNone(self.registry.lookup("amazo"))
+        self.assertIsNone(self.registry.lookup("llama3"))
+
+    def test_malformed_reload_keeps_previous_index(self):
+        self.assertIsNotNone(self.registry.lookup("amazon.titan-text-express-v1"))
+        with open(self.path, "w", encoding="utf-8") as registry_file:
+            registry_file.write("{not json")
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        with self.assertLogs(level="ERROR") as logs:
+            model_config = self.registry.lookup("amazon.titan-text-express-v1")
+        self.assertEqual(model_config["max_tokens"], 300)
+        self.assertIn("Failed to reload model registry", logs.output[0])
+
+
+class PrioritySchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = bedrock.PriorityScheduler(logging.getLogger("test_bedrock.scheduler"), capacity=3,
+                                                   reserved_interactive=1)
+
+    def test_bulk_cannot_take_reserved_interactive_slot(self):
+        bulk_releases = [self.scheduler.acquire("bulk") for _ in range(2)]
+        with self.assertRaises(bedrock.DeadlineExceededError):
+            self.scheduler.acquire("bulk", deadline=time.monotonic() + 0.05)
+        release = self.scheduler.acquire("interactive", deadline=time.monotonic() + 1)
+        self.assertEqual(self.scheduler.running, 3)
+        for release_slot in bulk_releases + [release]:
+            release_slot()
+        self.assertEqual(self.scheduler.running, 0)
+
+    def test_queued_bulk_request_runs_when_a_slot_frees_up(self):
+        release = self.scheduler.acquire("bulk")
+        self.scheduler.acquire("bulk")
+        admitted = threading.Event()
+        waiter = threading.Thread(target=lambda: self.scheduler.acquire("bulk") and admitted.set())
+        waiter.start()
+        self.assertFalse(admitted.wait(0.05))
+        release()
+        waiter.join(5)
+        self.assertTrue(admitted.is_set())
+
+    def test_request_past_its_deadline_is_dropped(self):
+        with self.assertRaises(bedrock.DeadlineExceededError):
+            self.scheduler.acquire("interactive", deadline=time.monotonic() - 1)
+        self.assertEqual(self.scheduler.dropped, 1)
+        self.assertEqual(self.scheduler.running, 0)
+        operation = mock.Mock()
+        with self.assertRaises(bedrock.DeadlineExceededError):
+            self.scheduler.call(operation, deadline=time.monotonic() - 1)
+        operation.assert_not_called()
+
+
+class RequestCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.coalescer = bedrock.RequestCoalescer(logging.getLogger("test_bedrock.coalescer"))
+        self.gate = threading.Event()
+        self.opened = 0
+
+    def open_stream(self, error=None):
+        self.opened += 1
+        yield "Hello "
+        self.gate.wait(5)
+        if error is not None:
+            raise error
+        yield "world"
+
+    def test_late_subscriber_receives_every_delta(self):
+        first = self.coalescer.stream("k", self.open_stream)
+        self.assertEqual(next(first), "Hello ")
+        second = self.coalescer.stream("k", self.open_stream)
+        self.assertEqual(next(second), "Hello ")
+        self.gate.set()
+        self.assertEqual(list(first), ["world"])
+        self.assertEqual(list(second), ["world"])
+        self.assertEqual(self.opened, 1)
+        self.assertEqual(self.coalescer.coalesced, 1)
+
+    def test_stream_error_reaches_every_subscriber(self):
+        open_stream = lambda: self.open_stream(ValueError("upstream failed"))
+        subscribers = [self.coalescer.stream("k", open_stream) for _ in range(2)]
+        for subscriber in subscribers:
+            self.assertEqual(next(subscriber), "Hello ")
+        self.gate.set()
+        for subscriber in subscribers:
+            with self.assertRaises(ValueError):
+                list(subscriber)
+        self.assertEqual(self.opened, 1)
+
+    def test_finished_stream_is_not_shared_with_new_subscribers(self):
+        self.gate.set()
+        self.assertEqual(list(self.coalescer.stream("k", self.open_stream)), ["Hello ", "world"])
+        self.assertEqual(list(self.coalescer.stream("k", self.open_stream)), ["Hello ", "world"])
+        self.assertEqual(self.opened, 2)
+        self.assertEqual(self.coalescer.coalesced, 0)
+
+
+class BedrockMetricsTest(unittest.TestCase):
+
+    def test_render_keeps_full_precision(self):
+        metrics = bedrock.BedrockMetrics()
+        labels = {"model_id": "m", "provider": "p"}
+        metrics.inc("bedrock_input_tokens_total", labels, 123456789)
+        metrics.inc("bedrock_output_tokens_total", labels, 0.1)
+        metrics.inc("bedrock_output_tokens_total", labels, 0.2)
+        metrics.observe("bedrock_request_duration_seconds", labels, 1.23456789)
+        lines = metrics.render().splitlines()
+        self.assertIn('bedrock_input_tokens_total{model_id="m",provider="p"} 123456789', lines)
+        self.assertIn('bedrock_output_tokens_total{model_id="m",provider="p"} 0.30000000000000004', lines)
+        self.assertIn('bedrock_request_duration_seconds_sum{model_id="m",provider="p"} 1.23456789', lines)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_registry_temperature_makes_payload_cacheable(self):
+        cache = bedrock.ResponseCache(logging.getLogger("test_bedrock.cache"))
+        model_config = dict(bedrock.MODEL_PREFIX_CONFIGURATIONS[0])
+        self.assertFalse(cache.is_cacheable(bedrock.build_request_body(model_config, "Hi")))
+        deterministic = dict(model_config, temperature=0)
+        self.assertTrue(cache.is_cacheable(bedrock.build_request_body(deterministic, "Hi")))
+        self.assertTrue(cache.is_cacheable(bedrock.build_converse_request(deterministic, "Hi")))
+
+
+class PackedBatchTest(unittest.TestCase):
+
+    def run_pack(self, generation):
+        records = [(1, {"id": "a", "prompt": "First?"}), (2, {"id": "b", "prompt": "Second?"})]
+        stats = {"lock": threading.Lock(), "fallbacks": 0}
+        individual = lambda client, line_number, record, *args, **kwargs: {"line": line_number, "response": "single"}
+        with mock.patch.object(bedrock, "invoke_model", return_value=generation), \
+                mock.patch.object(bedrock, "process_batch_record", side_effect=individual):
+            results = bedrock.run_pack(None, records, "mistral.mistral-7b-instruct-v0:2", {}, logging.getLogger(),
+                                       None, 50, stats)
+        return results, stats
+
+    def test_list_shaped_generation_is_joined(self):
+        outputs = [{"text": '{"1": "one", ', "stop_reason": None}, {"text": '"2": "two"}', "stop_reason": "stop"}]
+        results, stats = self.run_pack(outputs)
+        self.assertEqual([result["response"] for result in results], ["one", "two"])
+        self.assertEqual(stats["fallbacks"], 0)
+
+    def test_unparseable_generation_falls_back_to_individual_calls(self):
+        results, stats = self.run_pack({"unexpected": "shape"})
+        self.assertEqual([result["response"] for result in results], ["single", "single"])
+        self.assertEqual(stats["fallbacks"], 2)
+
+    def test_split_packed_answers_rejects_non_strings(self):
+        self.assertEqual(bedrock.split_packed_answers([{"text": '{"1": "one"}'}], 1), {})
+        self.assertEqual(bedrock.split_packed_answers(None, 1), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
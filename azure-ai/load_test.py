@@ -0,0 +1,493 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from model_testing import MESSAGES, build_headers, build_payload, chat_completions_url
+
+# Log-linear histogram of durations in microseconds, like HdrHistogram with two significant digits:
+# 128 linear sub-buckets per power of two keep every value within 1% in bounded memory
+class LatencyHistogram:
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        self.counts = Counter()
+        self.total = 0
+        self.sum = 0.0
+        self.sum_of_squares = 0.0
+        self.min = None
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def _index(self, value):
+        shift = max(value.bit_length() - self.SUB_BUCKET_BITS, 0)
+        return shift, value >> shift
+
+    @staticmethod
+    def _bucket_value(index):
+        # The highest value that falls into the bucket, as HdrHistogram reports it
+        shift, sub_bucket = index
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = max(int(seconds * 1_000_000), 1)
+        with self._lock:
+            self.counts[self._index(value)] += 1
+            self.total += 1
+            self.sum += value
+            self.sum_of_squares += value * value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = max(self.max, value)
+
+    # Value in microseconds at a percentile between 0 and 100
+    def value_at(self, percentile):
+        with self._lock:
+            if not self.total:
+                return None
+            target = max(math.ceil(percentile / 100 * self.total), 1)
+            seen = 0
+            for index in sorted(self.counts):
+                seen += self.counts[index]
+                if seen >= target:
+                    return min(self._bucket_value(index), self.max)
+            return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total else None
+
+    def stddev(self):
+        if not self.total:
+            return None
+        mean = self.mean()
+        return math.sqrt(max(self.sum_of_squares / self.total - mean * mean, 0.0))
+
+    # The usual percentiles in milliseconds
+    def summary(self):
+        if not self.total:
+            return {"count": 0}
+        to_ms = lambda value: round(value / 1000, 2)
+        return {
+            "count": self.total,
+            "min_ms": to_ms(self.min),
+            "mean_ms": to_ms(self.mean()),
+            "p50_ms": to_ms(self.value_at(50)),
+            "p90_ms": to_ms(self.value_at(90)),
+            "p99_ms": to_ms(self.value_at(99)),
+            "p99_9_ms": to_ms(self.value_at(99.9)),
+            "max_ms": to_ms(self.max),
+        }
+
+    # Percentile distribution in milliseconds in HdrHistogram's .hgrm text format, for its plotter.
+    # Percentiles get denser towards the tail.
+    def percentile_distribution(self, ticks_per_half_distance=5):
+        lines = [f"{'Value':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>14}", ""]
+        if not self.total:
+            return "\n".join(lines) + "\n"
+        with self._lock:
+            buckets = sorted(self.counts.items())
+        seen = 0
+        next_percentile = 0.0
+        half_distance = 0
+        for index, count in buckets:
+            seen += count
+            reached = seen / self.total * 100
+            value = min(self._bucket_value(index), self.max) / 1000
+            while next_percentile <= reached and next_percentile < 100:
+                inverse = 1 / (1 - next_percentile / 100)
+                lines.append(f"{value:>12.3f} {next_percentile / 100:>14.12f} {seen:>10} {inverse:>14.2f}")
+                # Each halving of the remaining distance to 100% gets the same number of ticks
+                while next_percentile >= 100 - 100 / 2 ** (half_distance + 1):
+                    half_distance += 1
+                next_percentile += 100 / 2 ** (half_distance + 1) / ticks_per_half_distance
+                if 1 / (1 - next_percentile / 100) > self.total:
+                    next_percentile = 100
+        lines.append(f"{self.max / 1000:>12.3f} {1:>14.12f} {self.total:>10}")
+        lines.append(f"#[Mean    = {self.mean() / 1000:>12.3f}, StdDeviation   = {self.stddev() / 1000:>12.3f}]")
+        lines.append(f"#[Max     = {self.max / 1000:>12.3f}, Total count    = {self.total:>12}]")
+        lines.append(f"#[Buckets = {len(buckets):>12}, SubBuckets     = {2 ** self.SUB_BUCKET_BITS:>12}]")
+        return "\n".join(lines) + "\n"
+
+# Results of one load test. latency counts from each request's intended start on the arrival schedule,
+# so time spent waiting to be sent is not silently dropped (coordinated omission); service_time counts
+# from the actual send, and send_lag is the difference.
+class LoadTestStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.service_time = LatencyHistogram()
+        self.send_lag = LatencyHistogram()
+        self.ttft = LatencyHistogram()
+        self.tokens_per_second = []
+        self.output_tokens = 0
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.started = None
+        self.last_sent = None
+        self._lock = threading.Lock()
+
+    def record(self, result):
+        self.send_lag.record(result["sent"] - result["intended"])
+        with self._lock:
+            self.last_sent = max(self.last_sent or result["sent"], result["sent"])
+            if result.get("error"):
+                self.errors[result["error"]] += 1
+            else:
+                self.statuses[result["status"]] += 1
+        if result.get("status") != 200 or result.get("error"):
+            return
+        self.latency.record(result["finished"] - result["intended"])
+        self.service_time.record(result["finished"] - result["sent"])
+        if result.get("first_token") is not None:
+            self.ttft.record(result["first_token"] - result["intended"])
+        with self._lock:
+            self.output_tokens += result.get("output_tokens") or 0
+            if result.get("tokens_per_second"):
+                self.tokens_per_second.append(result["tokens_per_second"])
+
+# Intended start of every request in seconds from the start of the test: exactly 1/rate apart for
+# constant arrivals, exponential gaps with the same mean for poisson (like independent users)
+def arrival_offsets(rate, count, arrival, seed=None):
+    if arrival == "constant":
+        return [index / rate for index in range(count)]
+    generator = random.Random(seed)
+    offsets = []
+    elapsed = 0.0
+    for _ in range(count):
+        offsets.append(elapsed)
+        elapsed += generator.expovariate(rate)
+    return offsets
+
+# Yield the data of each Server-Sent Event in a streaming response until [DONE]
+def iter_sse_data(response):
+    buffer = b""
+    for chunk in response.iter_content(chunk_size=None):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line.startswith(b"data:"):
+                data = line[5:].strip().decode("utf-8")
+                if data == "[DONE]":
+                    return
+                yield data
+
+# Send one chat completion and return its timings, status and token counts.
+# Errors go into the result instead of being raised, so the schedule keeps going.
+def send_request(session, url, headers, payload, intended, timeout, stream):
+    result = {"intended": intended, "sent": time.perf_counter(), "status": None}
+    try:
+        response = session.post(url, headers=headers, json=payload, stream=stream, timeout=timeout)
+        with response:
+            result["status"] = response.status_code
+            if response.status_code != 200:
+                response.content  # Drain the body so the connection goes back to the pool
+            elif stream:
+                chunks = 0
+                usage = None
+                last_token = None
+                for data in iter_sse_data(response):
+                    chunk = json.loads(data)
+                    usage = chunk.get("usage") or usage
+                    for choice in chunk.get("choices", []):
+                        if choice.get("delta", {}).get("content"):
+                            last_token = time.perf_counter()
+                            if result.get("first_token") is None:
+                                result["first_token"] = last_token
+                            chunks += 1
+                tokens = (usage or {}).get("completion_tokens") or chunks
+                result["output_tokens"] = tokens
+                if tokens > 1 and last_token and last_token > result["first_token"]:
+                    result["tokens_per_second"] = (tokens - 1) / (last_token - result["first_token"])
+            else:
+                body = response.json()
+                result["output_tokens"] = body.get("usage", {}).get("completion_tokens")
+    except requests.Timeout:
+        result["error"] = "timeout"
+    except requests.ConnectionError:
+        result["error"] = "connection_error"
+    except requests.RequestException as e:
+        result["error"] = type(e).__name__
+    except (ValueError, KeyError) as e:
+        result["error"] = f"bad_response: {type(e).__name__}"
+    result["finished"] = time.perf_counter()
+    return result
+
+def create_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Send count requests on an open-loop schedule at rate requests per second, however fast the endpoint
+# answers, and return (stats, elapsed seconds)
+def run_load_test(url, headers, payload, rate, count, arrival, max_in_flight, timeout, stream, seed=None):
+    session = create_session(max_in_flight)
+    stats = LoadTestStats()
+    offsets = arrival_offsets(rate, count, arrival, seed)
+    # Open the pool's connections up front so connection setup is not part of the first requests
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        warmup = min(max_in_flight, 8)
+        list(executor.map(lambda _: send_request(session, url, headers, payload, time.perf_counter(), timeout, stream),
+                          range(warmup)))
+
+        started = stats.started = time.perf_counter()
+        futures = []
+        for offset in offsets:
+            intended = started + offset
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # Requests that find every worker busy queue up; their wait counts from intended
+            future = executor.submit(send_request, session, url, headers, payload, intended, timeout, stream)
+            future.add_done_callback(lambda done: stats.record(done.result()))
+            futures.append(future)
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - started
+    session.close()
+    return stats, elapsed
+
+# Serves POST /chat/completions like an Azure AI serverless endpoint after a configurable delay,
+# streaming one token per event when asked; a share of requests can get 429 to exercise the error breakdown
+class FakeAzureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency_seconds = 0.0
+    tokens = 20
+    token_seconds = 0.0
+    throttle_rate = 0.0
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if random.random() < self.throttle_rate:
+            body = b'{"error": {"code": "429", "message": "Rate limit exceeded"}}'
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        time.sleep(self.latency_seconds)
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for index in range(self.tokens):
+                if index:
+                    time.sleep(self.token_seconds)
+                self._write_chunk(f'data: {{"choices": [{{"index": 0, "delta": {{"content": "tok{index} "}}}}]}}\n\n')
+            self._write_chunk("data: [DONE]\n\n")
+            self._write_chunk("")
+        else:
+            time.sleep(self.token_seconds * max(self.tokens - 1, 0))
+            body = json.dumps({"choices": [{"index": 0, "message": {"role": "assistant", "content": "tok " * self.tokens},
+                                            "finish_reason": "stop"}],
+                               "usage": {"completion_tokens": self.tokens}}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def handle(self):
+        # The load generator closes its idle keep-alive connections when it finishes
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+def _serve_fake(port_queue, latency_ms, tokens, token_ms, throttle_rate):
+    FakeAzureHandler.latency_seconds = latency_ms / 1000
+    FakeAzureHandler.tokens = tokens
+    FakeAzureHandler.token_seconds = token_ms / 1000
+    FakeAzureHandler.throttle_rate = throttle_rate
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAzureHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+# Start the fake endpoint on a free local port in its own process, so it does not compete with the
+# load generator for the GIL, and return (process, scoring_uri)
+def start_fake_server(latency_ms, tokens, token_ms, throttle_rate):
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_fake, args=(port_queue, latency_ms, tokens, token_ms, throttle_rate),
+                                      daemon=True)
+    process.start()
+    port = port_queue.get(timeout=30)
+    return process, f"http://127.0.0.1:{port}"
+
+# JSON-serialisable results of a run
+def build_report(stats, elapsed, args, fake_service_ms=None):
+    sent = sum(stats.statuses.values()) + sum(stats.errors.values())
+    # The rate requests actually went out at; it falls below the target when the client cannot keep up
+    send_seconds = stats.last_sent - stats.started if sent > 1 else 0
+    speeds = sorted(stats.tokens_per_second)
+    # Nearest rank, the same rule as LatencyHistogram.value_at
+    speed_at = lambda fraction: round(speeds[max(math.ceil(fraction * len(speeds)), 1) - 1], 1) if speeds else None
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "target": "fake" if args.fake else "azure",
+            "rate_rps": args.rate,
+            "arrival": args.arrival,
+            "stream": args.stream,
+            "max_in_flight": args.max_in_flight,
+        },
+        "requests": sent,
+        "elapsed_seconds": round(elapsed, 2),
+        "achieved_rps": round((sent - 1) / send_seconds, 2) if send_seconds > 0 else None,
+        "succeeded": stats.statuses.get(200, 0),
+        "throttled_429": stats.statuses.get(429, 0),
+        "status_codes": {str(status): count for status, count in sorted(stats.statuses.items())},
+        "errors": dict(stats.errors),
+        "latency": stats.latency.summary(),
+        "service_time": stats.service_time.summary(),
+        "send_lag": stats.send_lag.summary(),
+        "output_tokens": stats.output_tokens,
+    }
+    if args.stream:
+        report["ttft"] = stats.ttft.summary()
+        report["tokens_per_second"] = {"p50": speed_at(0.5), "p10": speed_at(0.1)}
+    if fake_service_ms is not None and stats.service_time.total:
+        # Whatever the fake endpoint did not spend sleeping is the cost of this client and the local HTTP stack
+        report["client_overhead_ms"] = {
+            "p50": round(stats.service_time.value_at(50) / 1000 - fake_service_ms, 2),
+            "p99": round(stats.service_time.value_at(99) / 1000 - fake_service_ms, 2),
+        }
+    return report
+
+def print_report(report, stats):
+    print(f"\nSent {report['requests']} requests in {report['elapsed_seconds']} s "
+          f"({report['achieved_rps']} req/s, target {report['meta']['rate_rps']} req/s, {report['meta']['arrival']} arrivals)")
+    print(f"Succeeded: {report['succeeded']}, 429 Too Many Requests: {report['throttled_429']}")
+    other_statuses = {status: count for status, count in report["status_codes"].items() if status not in ("200", "429")}
+    if other_statuses or report["errors"]:
+        print(f"Other failures: {json.dumps(dict(other_statuses, **report['errors']))}")
+    rows = [("Latency (CO-corrected)", report["latency"]), ("Service time", report["service_time"]),
+            ("Send lag", report["send_lag"])]
+    if "ttft" in report:
+        rows.append(("Time to first token", report["ttft"]))
+    print(f"\n{'':<24} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'p99.9 ms':>9} {'max ms':>9}")
+    for label, summary in rows:
+        if summary.get("count"):
+            print(f"{label:<24} {summary['p50_ms']:>9} {summary['p90_ms']:>9} {summary['p99_ms']:>9} "
+                  f"{summary['p99_9_ms']:>9} {summary['max_ms']:>9}")
+    if report.get("tokens_per_second", {}).get("p50") is not None:
+        print(f"\nTokens per second per stream: p50 {report['tokens_per_second']['p50']}, "
+              f"p10 {report['tokens_per_second']['p10']}")
+    if "client_overhead_ms" in report:
+        print(f"Client overhead against the fake endpoint: p50 {report['client_overhead_ms']['p50']} ms, "
+              f"p99 {report['client_overhead_ms']['p99']} ms")
+    if report["send_lag"].get("p99_ms", 0) > 50:
+        print("\nNote: requests were sent late; raise --max-in-flight or lower --rate, or the endpoint is saturated.")
+    print("\nLatency percentile distribution (ms):")
+    print(stats.latency.percentile_distribution())
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Open-loop load test for an Azure AI serverless endpoint.")
+    parser.add_argument('--rate', type=float, default=5,
+                        help='Requests per second to send, whatever the response times (default: 5).')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Length of the test in seconds (default: 60).')
+    parser.add_argument('--arrival', choices=("constant", "poisson"), default="constant",
+                        help='Evenly spaced requests, or Poisson arrivals with the same mean rate.')
+    parser.add_argument('--max-in-flight', type=int, default=256,
+                        help='Most requests open at once; later arrivals queue and their wait is measured.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Request streamed responses and report time to first token and tokens per second.')
+    parser.add_argument('--max-tokens', type=int, default=100,
+                        help='max_tokens of every request (default: 100).')
+    parser.add_argument('--prompt', type=str, default=None,
+                        help='User prompt to send instead of the one in model_testing.py.')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='Request timeout in seconds (default: 120).')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed for Poisson arrivals.')
+    parser.add_argument('--fake', action='store_true',
+                        help='Target a local fake endpoint instead of AZURE_ENDPOINT_SCORING_URI to measure client overhead.')
+    parser.add_argument('--fake-latency-ms', type=float, default=200,
+                        help='Fake endpoint delay before the first token (default: 200).')
+    parser.add_argument('--fake-tokens', type=int, default=20,
+                        help='Tokens returned by the fake endpoint (default: 20).')
+    parser.add_argument('--fake-token-ms', type=float, default=10,
+                        help='Fake endpoint delay between tokens (default: 10).')
+    parser.add_argument('--fake-429-rate', type=float, default=0.0,
+                        help='Share of requests the fake endpoint throttles with 429 (default: 0).')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write the JSON results to this file.')
+    parser.add_argument('--hgrm', type=str, default=None,
+                        help='Write the latency percentile distribution to this .hgrm file for the HdrHistogram plotter.')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    if args.rate <= 0 or args.duration <= 0 or args.max_in_flight < 1:
+        print("--rate and --duration must be positive and --max-in-flight at least 1.")
+        sys.exit(1)
+
+    fake_server = None
+    fake_service_ms = None
+    if args.fake:
+        fake_server, scoring_uri = start_fake_server(args.fake_latency_ms, args.fake_tokens, args.fake_token_ms,
+                                                args.fake_429_rate)
+        api_key, model = "fake", "fake"
+        fake_service_ms = args.fake_latency_ms + args.fake_token_ms * max(args.fake_tokens - 1, 0)
+    else:
+        from dotenv import load_dotenv
+        load_dotenv()
+        api_key = os.getenv("AZURE_ENDPOINT_PRIMARY_KEY")
+        scoring_uri = os.getenv("AZURE_ENDPOINT_SCORING_URI")
+        model = os.getenv("AZURE_LLM_MODEL")
+        if not (api_key and scoring_uri):
+            print("AZURE_ENDPOINT_PRIMARY_KEY and AZURE_ENDPOINT_SCORING_URI must be set in .env.")
+            sys.exit(1)
+
+    messages = MESSAGES if args.prompt is None else [MESSAGES[0], {"role": "user", "content": args.prompt}]
+    payload = build_payload(messages, model=model, max_tokens=args.max_tokens, stream=args.stream)
+    url = chat_completions_url(scoring_uri)
+    count = max(int(args.rate * args.duration), 1)
+    print(f"Sending {count} requests to {url} at {args.rate} req/s ({args.arrival} arrivals"
+          f"{', streaming' if args.stream else ''})")
+
+    try:
+        stats, elapsed = run_load_test(url, build_headers(api_key), payload, args.rate, count, args.arrival,
+                                       args.max_in_flight, args.timeout, args.stream, args.seed)
+    finally:
+        if fake_server is not None:
+            fake_server.terminate()
+
+    report = build_report(stats, elapsed, args, fake_service_ms)
+    print_report(report, stats)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(json.dumps(report, indent=2) + "\n")
+        print(f"Results written to {args.output}")
+    if args.hgrm:
+        with open(args.hgrm, 'w', encoding='utf-8') as hgrm_file:
+            hgrm_file.write(stats.latency.percentile_distribution())
+        print(f"Percentile distribution written to {args.hgrm}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from gcp_auth import get_token_broker
+from vertex_llama import (CHAT_COMPLETIONS_URL, GEMINI_URL, create_session, gemini_payload, gemini_answer,
+                          llama_payload, llama_answer, percentile)
+
+DEFAULT_GEMINI_MODEL = "gemini-1.0-pro"
+DEFAULT_LLAMA_MODEL = "meta/llama-3.1-405b-instruct-maas"
+
+# Status codes worth retrying; 429 honours the Retry-After header
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# One HTTP client shared by all workers: HTTP/2 over httpx when it is installed with HTTP/2 support,
+# otherwise a pooled keep-alive requests Session. Both are safe to share between threads.
+def create_http_client(concurrency, timeout):
+    try:
+        import httpx
+        import h2  # noqa: F401 -- httpx needs it for HTTP/2
+    except ImportError:
+        print("httpx[http2] is not installed, using HTTP/1.1 keep-alive connections "
+              "(pip install 'httpx[http2]' for HTTP/2).")
+        return create_session(pool_size=concurrency), "HTTP/1.1"
+    client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        timeout=httpx.Timeout(timeout, connect=10)
+    )
+    return client, "HTTP/2"
+
+
+# Read prompts from a text file (one per line) or a JSONL file ({"id": ..., "prompt": ...} per line).
+# Raises ValueError naming the file and line of a malformed JSONL record.
+def read_prompts(path):
+    prompts = []
+    with open(path, "r", encoding="utf-8") as prompt_file:
+        for line_number, line in enumerate(prompt_file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                try:
+                    record = json.loads(line)
+                    prompts.append((str(record.get("id", line_number)), record["prompt"]))
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{path}:{line_number}: invalid JSON ({e})")
+                except (KeyError, AttributeError):
+                    raise ValueError(f"{path}:{line_number}: expected a JSON object with a 'prompt' field")
+            else:
+                prompts.append((str(line_number), line))
+    return prompts
+
+
+# Model IDs and API host from the .env written by setup_gcp_ai.sh. It configures one model at a time, so
+# GCP_MODEL_NAME only sets the default of the matching model, and GCP_ENDPOINT_NAME is either the API host
+# (Llama) or a full Gemini URL, whose host is used.
+def env_defaults():
+    model = os.getenv("GCP_MODEL_NAME")
+    gemini_model = model if model and model.startswith("gemini") else DEFAULT_GEMINI_MODEL
+    llama_model = model if model and not model.startswith("gemini") else DEFAULT_LLAMA_MODEL
+    endpoint = os.getenv("GCP_ENDPOINT_NAME")
+    if endpoint and "://" in endpoint:
+        endpoint = urlparse(endpoint).netloc
+    return gemini_model, llama_model, endpoint
+
+
+def gemini_request(prompt, args):
+    url = GEMINI_URL.format(endpoint=args.endpoint, region=args.region, project_id=args.project_id,
+                            model=args.gemini_model)
+    return url, gemini_payload(prompt, args.max_tokens, args.temperature)
+
+
+def llama_request(prompt, args):
+    url = CHAT_COMPLETIONS_URL.format(endpoint=args.endpoint, project_id=args.project_id, region=args.region)
+    return url, llama_payload(args.llama_model, prompt, args.max_tokens, args.temperature)
+
+
+TARGETS = {
+    "gemini": (gemini_request, gemini_answer),
+    "llama": (llama_request, llama_answer),
+}
+
+
+# Seconds to wait before retrying: the server's Retry-After when given, otherwise exponential backoff with jitter
+def retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            try:
+                return max((parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    return min(2 ** attempt, 30) * random.uniform(0.5, 1.5)
+
+
+# Send one prompt to one model, retrying throttled and failed requests, and return its result record
+def run_prompt(client, broker, target, prompt_id, prompt, args):
+    build_request, parse_answer = TARGETS[target]
+    url, payload = build_request(prompt, args)
+    result = {"id": prompt_id, "model": target, "status": None, "attempts": 0}
+    started = time.perf_counter()
+    refreshed_token = False
+    for attempt in range(args.max_retries + 1):
+        result["attempts"] = attempt + 1
+        attempt_started = time.perf_counter()
+        response = None
+        result["status"] = None
+        try:
+            response = client.post(url, headers=broker.headers(), json=payload, timeout=args.timeout)
+            if response.status_code == 200:
+                # The status is only recorded once the body parsed, so a broken 200 counts as a failure
+                text, input_tokens, output_tokens = parse_answer(response.json())
+                result.update(status=200, output=text, input_tokens=input_tokens, output_tokens=output_tokens)
+                result.pop("error", None)
+                break
+            result["status"] = response.status_code
+            result["error"] = response.text[:500]
+            if response.status_code == 401 and not refreshed_token:
+                broker.invalidate()
+                refreshed_token = True
+                continue
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                break
+        except Exception as e:  # Connection errors and timeouts from either HTTP client
+            result["error"] = f"{type(e).__name__}: {e}"
+        if attempt < args.max_retries:
+            time.sleep(retry_delay(response, attempt))
+    result["last_attempt_ms"] = round((time.perf_counter() - attempt_started) * 1000)
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000)
+    return result
+
+
+def print_summary(results, wall_seconds, protocol):
+    print(f"\nCompleted {len(results)} requests in {wall_seconds:.1f} s over {protocol} "
+          f"({len(results) / wall_seconds if wall_seconds else 0:.1f} requests/s)")
+    for target in sorted({result["model"] for result in results}):
+        target_results = [result for result in results if result["model"] == target]
+        succeeded = [result for result in target_results if result["status"] == 200 and "error" not in result]
+        latencies = [result["last_attempt_ms"] for result in succeeded]
+        retries = sum(result["attempts"] - 1 for result in target_results)
+        p50, p95 = (percentile(latencies, fraction) for fraction in (0.5, 0.95))
+        print(f"  {target}: {len(succeeded)}/{len(target_results)} succeeded, {retries} retries, "
+              f"p50 {'-' if p50 is None else p50} ms, p95 {'-' if p95 is None else p95} ms")
+
+
+def main():
+    load_dotenv()
+    gemini_model, llama_model, endpoint = env_defaults()
+    parser = argparse.ArgumentParser(description="Run a file of prompts concurrently against Gemini and Llama on Vertex AI")
+    parser.add_argument("prompts", help="Text file with one prompt per line, or JSONL with 'id' and 'prompt' fields")
+    parser.add_argument("--models", nargs="+", choices=sorted(TARGETS), default=sorted(TARGETS),
+                        help="Models to send every prompt to (default: all)")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file for per-prompt results and timings")
+    parser.add_argument("--concurrency", type=int, default=16, help="Maximum requests in flight (default: 16)")
+    parser.add_argument("--max-retries", type=int, default=5, help="Retries per request on 429, 5xx and network errors")
+    parser.add_argument("--timeout", type=float, default=120, help="Request timeout in seconds")
+    parser.add_argument("--max-tokens", type=int, default=250, help="Maximum output tokens per answer")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--gemini-model", default=gemini_model,
+                        help=f"Gemini model ID (default: GCP_MODEL_NAME for a Gemini model, else {DEFAULT_GEMINI_MODEL})")
+    parser.add_argument("--llama-model", default=llama_model,
+                        help=f"Llama model ID (default: GCP_MODEL_NAME for a Llama model, else {DEFAULT_LLAMA_MODEL})")
+    parser.add_argument("--endpoint", default=endpoint,
+                        help="Vertex AI API host (default: the host in GCP_ENDPOINT_NAME, "
+                             "else <region>-aiplatform.googleapis.com)")
+    args = parser.parse_args()
+
+    args.project_id = os.getenv("GCP_PROJECT_ID")
+    args.region = os.getenv("GCP_REGION_NAME")
+    args.endpoint = args.endpoint or f"{args.region}-aiplatform.googleapis.com"
+    service_account_file = os.getenv("GCP_SERVICE_ACCOUNT_FILE")
+    if not (args.project_id and args.region and service_account_file):
+        print("Error: GCP_PROJECT_ID, GCP_REGION_NAME and GCP_SERVICE_ACCOUNT_FILE must be set in .env")
+        sys.exit(1)
+    if args.concurrency < 1:
+        print("Error: --concurrency must be at least 1")
+        sys.exit(1)
+
+    try:
+        prompts = read_prompts(args.prompts)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if not prompts:
+        print(f"Error: no prompts found in {args.prompts}")
+        sys.exit(1)
+
+    broker = get_token_broker(service_account_file)
+    broker.token()  # Fetch the token once up front instead of in every worker
+    client, protocol = create_http_client(args.concurrency, args.timeout)
+    jobs = [(target, prompt_id, prompt) for prompt_id, prompt in prompts for target in args.models]
+    print(f"Sending {len(prompts)} prompts to {', '.join(args.models)} ({len(jobs)} requests, "
+          f"concurrency {args.concurrency})")
+
+    results = []
+    started = time.perf_counter()
+    with open(args.output, "w", encoding="utf-8") as output_file, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_prompt, client, broker, target, prompt_id, prompt, args)
+                   for target, prompt_id, prompt in jobs]
+        # Write each result as soon as it completes so an interrupted run keeps what it has
+        for future in as_completed(futures):
+            result = future.result()
+            output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            results.append(result)
+            if len(results) % 100 == 0 or len(results) == len(jobs):
+                print(f"{len(results)}/{len(jobs)} done")
+    client.close()
+
+    print_summary(results, time.perf_counter() - started, protocol)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
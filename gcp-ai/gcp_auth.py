@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import timezone
+
+# Scope used by every Vertex AI request in this folder
+DEFAULT_SCOPES = ("https://www.googleapis.com/auth/cloud-platform",)
+
+# Refresh the access token this many seconds before it expires
+REFRESH_MARGIN_SECONDS = 300
+
+# Shared on-disk token cache, readable only by the current user
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "codehub", "gcp-ai")
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Exclusive inter-process lock on a lock file, so only one process refreshes the token at a time
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a+")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after about 10 seconds; keep waiting for the other process
+                    continue
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+
+# Hands out OAuth access tokens for a service account to any number of threads and processes.
+# A valid token is served from memory without locking or network calls. Otherwise the broker
+# tries the on-disk cache shared by all processes and only asks Google's token endpoint when
+# that is also about to expire, under a file lock so concurrent processes refresh it once.
+# A daemon thread refreshes the token before it expires, so callers never wait for a refresh.
+class TokenBroker:
+    def __init__(self, service_account_file, scopes=DEFAULT_SCOPES, cache_dir=DEFAULT_CACHE_DIR,
+                 refresh_margin=REFRESH_MARGIN_SECONDS, background=True):
+        self.service_account_file = os.path.abspath(service_account_file)
+        self.scopes = tuple(scopes)
+        self.refresh_margin = refresh_margin
+        self.background = background
+        cache_key = hashlib.sha256(f"{self.service_account_file}|{' '.join(self.scopes)}".encode()).hexdigest()[:16]
+        self.cache_path = os.path.join(cache_dir, f"token-{cache_key}.json") if cache_dir else None
+        self._token = None  # (access token, expiry as a Unix timestamp), replaced atomically
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self.refreshes = 0
+
+    def _is_fresh(self, token):
+        return token is not None and token[1] - self.refresh_margin > time.time()
+
+    # Read the shared cache file; writes are atomic renames, so no lock is needed to read
+    def _read_cache(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as cache_file:
+                cached = json.load(cache_file)
+            return cached["access_token"], float(cached["expiry"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_cache(self, token):
+        temporary_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w", encoding="utf-8") as cache_file:
+            json.dump({"access_token": token[0], "expiry": token[1]}, cache_file)
+        os.replace(temporary_path, self.cache_path)
+
+    # The only call that reaches Google's token endpoint
+    def _fetch(self):
+        from google.oauth2 import service_account
+        from google.auth.transport.requests import Request
+
+        if self._credentials is None:
+            self._credentials = service_account.Credentials.from_service_account_file(
+                self.service_account_file, scopes=list(self.scopes))
+        self._credentials.refresh(Request())
+        self.refreshes += 1
+        expiry = self._credentials.expiry.replace(tzinfo=timezone.utc).timestamp()
+        return self._credentials.token, expiry
+
+    # Load a fresh token from the shared cache or from Google, refreshing at most once across processes
+    def _load(self, force=False):
+        with self._lock:
+            if not force and self._is_fresh(self._token):
+                return self._token
+            token = None if force else self._read_cache()
+            if not self._is_fresh(token):
+                if self.cache_path:
+                    os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+                    with _FileLock(f"{self.cache_path}.lock"):
+                        # Another process may have refreshed the token while we waited for the lock
+                        token = self._read_cache()
+                        if force or not self._is_fresh(token):
+                            token = self._fetch()
+                            self._write_cache(token)
+                else:
+                    token = self._fetch()
+            self._token = token
+            return token
+
+    # Return a valid access token; usually a plain memory read
+    def token(self):
+        token = self._token
+        if not self._is_fresh(token):
+            token = self._load()
+        if self.background and self._refresher is None:
+            self._start_refresher()
+        return token[0]
+
+    # Return the Authorization header for a Vertex AI request
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token()}"}
+
+    # Drop the current token, e.g. after a 401 response, and fetch a new one
+    def invalidate(self):
+        self._load(force=True)
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name="gcp-token-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            token = self._token
+            # Wake up shortly before the refresh margin is reached
+            delay = token[1] - self.refresh_margin - time.time() - 5 if token else 0
+            time.sleep(max(delay, 1))
+            try:
+                self._load()
+            except Exception as e:  # Keep the thread alive; token() retries in the foreground if needed
+                print(f"Background token refresh failed: {e}")
+                time.sleep(30)
+
+
+_BROKERS = {}
+_BROKERS_LOCK = threading.Lock()
+
+
+# Return the process-wide TokenBroker for a service account file
+def get_token_broker(service_account_file, scopes=DEFAULT_SCOPES):
+    key = (os.path.abspath(service_account_file), tuple(scopes))
+    with _BROKERS_LOCK:
+        broker = _BROKERS.get(key)
+        if broker is None:
+            broker = _BROKERS[key] = TokenBroker(service_account_file, scopes)
+        return broker
+
+
+# Return a valid access token for a service account file, from memory or the shared cache when possible
+def get_access_token(service_account_file, scopes=DEFAULT_SCOPES):
+    return get_token_broker(service_account_file, scopes).token()
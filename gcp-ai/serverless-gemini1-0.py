@@ -1,8 +1,10 @@
 import os
+import json
+import time
+import codecs
 from dotenv import load_dotenv
 import requests
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
+from gcp_auth import get_access_token
 
 # Load environment variables from .env file
 load_dotenv()
@@ -13,15 +15,6 @@ location = os.getenv("GCP_REGION_NAME")
 service_account_file = os.getenv("GCP_SERVICE_ACCOUNT_FILE")
 endpoint = os.getenv("GCP_ENDPOINT_NAME")
 
-# Load service account credentials and get an access token
-credentials = service_account.Credentials.from_service_account_file(
-    service_account_file,
-    scopes=["https://www.googleapis.com/auth/cloud-platform"]
-)
-auth_request = Request()
-credentials.refresh(auth_request)
-access_token = credentials.token
-
 # Define the API request payload with controlled output
 def create_payload(prompt: str):
     return {
@@ -44,15 +37,45 @@ def create_payload(prompt: str):
         }
     }
 
-# Function to send a POST request to the endpoint and parse only the text content
+# Incrementally parse a streamed JSON array, yielding each element as soon as it is complete.
+# Only the unparsed tail is buffered, so memory stays flat however long the response is.
+def iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += utf8_decoder.decode(chunk)
+        position = 0
+        while True:
+            # Skip whitespace, the opening bracket and the commas between elements
+            while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ","
+                                              or (not started and buffer[position] == "[")):
+                started = started or buffer[position] == "["
+                position += 1
+            if position >= len(buffer) or buffer[position] == "]":
+                break
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # The element is incomplete; wait for more data
+            yield element
+            position = end
+        buffer = buffer[position:]
+    if buffer.strip() not in ("", "]"):
+        raise ValueError("Incomplete JSON array in the response stream.")
+
+# Function to send a POST request to the endpoint and print the text content as it streams in
 def send_request(prompt: str):
+    # The token comes from the shared cache and is only refreshed shortly before it expires
     headers = {
-        "Authorization": f"Bearer {access_token}",
+        "Authorization": f"Bearer {get_access_token(service_account_file)}",
         "Content-Type": "application/json; charset=utf-8"
     }
     data = create_payload(prompt)
 
     # Send POST request
+    started = time.perf_counter()
     response = requests.post(
         endpoint,
         headers=headers,
@@ -60,42 +83,45 @@ def send_request(prompt: str):
         stream=True
     )
 
-    # Collect response lines and combine them into a single JSON response
+    # Parse each response element as it arrives instead of waiting for the whole array
     if response.status_code == 200:
         print("Response Status Code:", response.status_code)
-        response_text = ''.join([line.decode("utf-8") for line in response.iter_lines() if line])
-        
+        total_token_count = 0
+        truncated = False
+        first_text_at = None
+
         try:
-            # Parse the combined response
-            json_response = requests.models.complexjson.loads(response_text)
-            full_text = []
-            total_token_count = 0
-            truncated = False
+            for item in iter_json_array(response.iter_content(chunk_size=None)):
+                if "error" in item:
+                    print(f"\nError: {item['error']}")
+                    break
 
-            # Extract and print only the "text" content in a readable format
-            for item in json_response:
-                # Track token usage if available
+                # Track token usage if available; the last element carries the final count
                 if "usageMetadata" in item:
-                    total_token_count = item["usageMetadata"].get("totalTokenCount", 0)
+                    total_token_count = item["usageMetadata"].get("totalTokenCount", total_token_count)
 
                 for candidate in item.get("candidates", []):
-                    parts = candidate.get("content", {}).get("parts", [])
-                    for part in parts:
-                        full_text.append(part.get("text", "").strip())
-                    
+                    for part in candidate.get("content", {}).get("parts", []):
+                        text = part.get("text", "")
+                        if text:
+                            if first_text_at is None:
+                                first_text_at = time.perf_counter()
+                            print(text, end="", flush=True)
+
                     # Check for truncation
                     if candidate.get("finishReason") == "MAX_TOKENS":
                         truncated = True
 
-            # Join all parts and print the output
-            print("\n".join(full_text))
-            print("\nTotal Token Usage:", total_token_count)
+            print("\n\nTotal Token Usage:", total_token_count)
+            if first_text_at is not None:
+                print(f"Time to First Token: {(first_text_at - started) * 1000:.0f} ms, "
+                      f"Total Time: {(time.perf_counter() - started) * 1000:.0f} ms")
 
             if truncated:
                 print("\nNote: The response was truncated. Consider increasing maxOutputTokens for more content.")
 
         except ValueError:
-            print("Failed to parse JSON response.")
+            print("\nFailed to parse JSON response.")
     else:
         print(f"Error: {response.status_code} - {response.text}")
 
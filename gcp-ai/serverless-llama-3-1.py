@@ -1,7 +1,7 @@
 import requests
-from google.auth.transport.requests import Request
-from google.oauth2 import service_account
 from dotenv import load_dotenv
+from gcp_auth import get_token_broker
+from vertex_llama import VertexLlamaClient, StreamStats
 import os
 
 # Load environment variables from .env file
@@ -14,64 +14,31 @@ region = os.getenv("GCP_REGION_NAME")
 endpoint = os.getenv("GCP_ENDPOINT_NAME")
 model = os.getenv("GCP_MODEL_NAME")
 
-# Load service account credentials
-credentials = service_account.Credentials.from_service_account_file(
-    service_account_file,
-    scopes=["https://www.googleapis.com/auth/cloud-platform"]
-)
+# Streaming client with a pooled keep-alive session; the access token comes from the shared token cache
+client = VertexLlamaClient(endpoint, project_id, region, model, get_token_broker(service_account_file).token)
 
-# Get an access token
-auth_req = Request()
-credentials.refresh(auth_req)
-access_token = credentials.token
+# Test Prompt
+messages = [
+    {"role": "user", "content": "What is Buitenzorg?"}
+]
 
-# Define the API request data
-data = {
-    "model": model,
-    "stream": True,
-    # Test Prompt
-    "messages": [
-        {"role": "user", "content": "What is Buitenzorg?"}
-    ]
-}
-
-# Set up the headers with the access token
-headers = {
-    "Authorization": f"Bearer {access_token}",
-    "Content-Type": "application/json"
-}
-
-# Send the POST request with stream enabled
-response = requests.post(
-    f"https://{endpoint}/v1/projects/{project_id}/locations/{region}/endpoints/openapi/chat/completions",
-    headers=headers,
-    json=data,
-    stream=True  # Enable streaming response
-)
+# Send the request with streaming enabled
+stats = StreamStats()
+response = client.open(messages, stats)
 
 # Check if the request was successful
 print("Status Code:", response.status_code)
 
-# Accumulate content from the response
-accumulated_content = ""
-
-# Process each line in the streamed response
-for line in response.iter_lines():
-    if line:  # Skip empty lines
-        # Remove 'data: ' prefix and parse JSON content
-        line = line.decode("utf-8").strip()
-        if line.startswith("data:"):
-            try:
-                json_data = line[5:].strip()  # Remove 'data:' prefix
-                chunk = requests.models.complexjson.loads(json_data)  # Parse JSON data
-                
-                # Extract and accumulate only the "content" field if it exists
-                if "choices" in chunk:
-                    for choice in chunk["choices"]:
-                        if "delta" in choice and "content" in choice["delta"]:
-                            accumulated_content += choice["delta"]["content"]
-            except ValueError:
-                print("Non-JSON response:", line)
-
-# Print the final accumulated content
-print(accumulated_content)
\ No newline at end of file
+# Print the content as it streams in
+if response.status_code == 200:
+    try:
+        for delta in client.iter_deltas(response, stats):
+            print(delta, end="", flush=True)
+        print()
+        print(stats.summary())
+    except (ValueError, RuntimeError, requests.RequestException) as e:
+        print(f"\nStream interrupted: {e}")
+else:
+    print(response.text)
+
+client.close()
@@ -0,0 +1,294 @@
+import json
+import math
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# OpenAI-compatible chat completions endpoint that serves Llama on Vertex AI
+CHAT_COMPLETIONS_URL = "https://{endpoint}/v1/projects/{project_id}/locations/{region}/endpoints/openapi/chat/completions"
+
+# Gemini endpoint; generateContent returns the whole answer in one response
+GEMINI_URL = ("https://{endpoint}/v1/projects/{project_id}/locations/{region}"
+              "/publishers/google/models/{model}:generateContent")
+
+# Sentinel sent as the last event of a stream
+DONE = "[DONE]"
+
+
+# Timings and token counts for one streamed response
+class StreamStats:
+    def __init__(self):
+        self.status_code = None
+        self.started = None
+        self.first_token_at = None
+        self.finished_at = None
+        self.chunks = 0
+        self.usage = None
+        self.finish_reason = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def record_delta(self):
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.finished_at = now
+        self.chunks += 1
+
+    # Time to first token in seconds
+    @property
+    def ttft(self):
+        if self.started is None or self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started
+
+    # Total time in seconds
+    @property
+    def total(self):
+        if self.started is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started
+
+    # Output tokens as reported by the endpoint, or the number of content chunks when it sends no usage
+    @property
+    def output_tokens(self):
+        if self.usage and self.usage.get("completion_tokens") is not None:
+            return self.usage["completion_tokens"]
+        return self.chunks
+
+    # Generation speed after the first token, which is what a reader of the streamed text sees
+    @property
+    def tokens_per_second(self):
+        if self.first_token_at is None or self.finished_at is None or self.output_tokens < 2:
+            return None
+        elapsed = self.finished_at - self.first_token_at
+        return (self.output_tokens - 1) / elapsed if elapsed > 0 else None
+
+    def summary(self):
+        if self.ttft is None:
+            return "No tokens received"
+        speed = f"{self.tokens_per_second:.1f} tokens/s" if self.tokens_per_second else "n/a tokens/s"
+        return (f"Time to First Token: {self.ttft * 1000:.0f} ms, Total Time: {self.total * 1000:.0f} ms, "
+                f"Output Tokens: {self.output_tokens}, {speed}")
+
+
+# Incremental Server-Sent Events parser: feed raw bytes, get back the data of each complete event.
+# Multi-line events are joined with newlines, comments and other fields are ignored.
+class SSEParser:
+    def __init__(self):
+        self._buffer = b""
+        self._data = []
+
+    def feed(self, chunk):
+        events = []
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for raw_line in lines:
+            line = raw_line.rstrip(b"\r").decode("utf-8")
+            if not line:
+                # A blank line ends the event
+                if self._data:
+                    events.append("\n".join(self._data))
+                    self._data = []
+            elif line.startswith(":"):
+                continue
+            else:
+                field, _, value = line.partition(":")
+                if field == "data":
+                    self._data.append(value[1:] if value.startswith(" ") else value)
+        return events
+
+    # Flush an event left without a trailing blank line when the connection closes
+    def close(self):
+        if self._buffer:
+            events = self.feed(b"\n")
+        else:
+            events = []
+        if self._data:
+            events.append("\n".join(self._data))
+            self._data = []
+        return events
+
+
+# Yield the data of each event in a stream of byte chunks
+def iter_sse_events(chunks):
+    parser = SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+# Turn the data of one event into content deltas; returns None once the stream is done
+def parse_event(data, stats=None):
+    if data.strip() == DONE:
+        return None
+    chunk = json.loads(data)
+    if "error" in chunk:
+        raise RuntimeError(f"Stream error: {chunk['error']}")
+    deltas = []
+    for choice in chunk.get("choices", []):
+        content = choice.get("delta", {}).get("content")
+        if content:
+            deltas.append(content)
+            if stats is not None:
+                stats.record_delta()
+        if choice.get("finish_reason") and stats is not None:
+            stats.finish_reason = choice["finish_reason"]
+    if chunk.get("usage") and stats is not None:
+        stats.usage = chunk["usage"]
+    return deltas
+
+
+# A requests Session that keeps up to pool_size connections alive for reuse
+def create_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Non-streaming request bodies for one prompt, and parsers returning (text, input tokens, output tokens).
+# Shared by batch_prompts.py and multi-cloud-ai/llm_client.py.
+def gemini_payload(prompt, max_tokens, temperature):
+    return {
+        "contents": {"role": "user", "parts": {"text": prompt}},
+        "generation_config": {"temperature": temperature, "maxOutputTokens": max_tokens}
+    }
+
+
+def gemini_answer(body):
+    parts = [part.get("text", "")
+             for candidate in body.get("candidates", [])
+             for part in candidate.get("content", {}).get("parts", [])]
+    usage = body.get("usageMetadata", {})
+    return "".join(parts), usage.get("promptTokenCount"), usage.get("candidatesTokenCount")
+
+
+def llama_payload(model, prompt, max_tokens, temperature):
+    return {
+        "model": model,
+        "stream": False,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+
+
+def llama_answer(body):
+    text = "".join(choice.get("message", {}).get("content") or "" for choice in body.get("choices", []))
+    usage = body.get("usage", {})
+    return text, usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+
+# Nearest-rank percentile (fraction between 0 and 1) of a list of values; None when it is empty
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))]
+
+
+# Streaming client for Llama chat completions on Vertex AI. token_provider is a callable returning
+# an access token, e.g. gcp_auth.get_token_broker(service_account_file).token.
+class VertexLlamaClient:
+    def __init__(self, endpoint, project_id, region, model, token_provider, pool_size=10, timeout=(10, 300)):
+        self.url = CHAT_COMPLETIONS_URL.format(endpoint=endpoint, project_id=project_id, region=region)
+        self.model = model
+        self.token_provider = token_provider
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = create_session(pool_size)
+        self._async_client = None
+
+    def _headers(self):
+        return {
+            "Authorization": f"Bearer {self.token_provider()}",
+            "Content-Type": "application/json"
+        }
+
+    def _payload(self, messages, params):
+        return {"model": self.model, "stream": True, "messages": messages, **params}
+
+    # Send the request and return the streaming response; the caller checks the status code
+    def open(self, messages, stats=None, **params):
+        if stats is not None:
+            stats.start()
+        response = self.session.post(self.url, headers=self._headers(), json=self._payload(messages, params),
+                                     stream=True, timeout=self.timeout)
+        if stats is not None:
+            stats.status_code = response.status_code
+        return response
+
+    # Yield content deltas from an open response as they arrive
+    def iter_deltas(self, response, stats=None):
+        with response:
+            for data in iter_sse_events(response.iter_content(chunk_size=None)):
+                deltas = parse_event(data, stats)
+                if deltas is None:
+                    break
+                yield from deltas
+
+    # Yield content deltas for a chat; raises requests.HTTPError if the endpoint rejects the request
+    def stream(self, messages, stats=None, **params):
+        response = self.open(messages, stats, **params)
+        if response.status_code != 200:
+            with response:
+                raise requests.HTTPError(f"{response.status_code} - {response.text}", response=response)
+        yield from self.iter_deltas(response, stats)
+
+    # Return the whole answer; the deltas are joined once instead of concatenated one by one
+    def complete(self, messages, stats=None, **params):
+        return "".join(self.stream(messages, stats, **params))
+
+    # Asyncio variant of stream(), built on httpx
+    async def astream(self, messages, stats=None, **params):
+        client = self._get_async_client()
+        if stats is not None:
+            stats.start()
+        async with client.stream("POST", self.url, headers=self._headers(),
+                                 json=self._payload(messages, params)) as response:
+            if stats is not None:
+                stats.status_code = response.status_code
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", "replace")
+                raise requests.HTTPError(f"{response.status_code} - {body}")
+            parser = SSEParser()
+            async for chunk in response.aiter_bytes():
+                for data in parser.feed(chunk):
+                    deltas = parse_event(data, stats)
+                    if deltas is None:
+                        return
+                    for delta in deltas:
+                        yield delta
+            for data in parser.close():
+                deltas = parse_event(data, stats)
+                if deltas is None:
+                    return
+                for delta in deltas:
+                    yield delta
+
+    async def acomplete(self, messages, stats=None, **params):
+        return "".join([delta async for delta in self.astream(messages, stats, **params)])
+
+    def _get_async_client(self):
+        if self._async_client is None:
+            try:
+                import httpx
+            except ImportError:
+                raise ImportError("The asyncio client requires httpx. Install it with: pip install httpx")
+            connect, read = self.timeout
+            self._async_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                timeout=httpx.Timeout(read, connect=connect)
+            )
+        return self._async_client
+
+    def close(self):
+        self.session.close()
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
@@ -0,0 +1,362 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
+
+# The provider scripts live in sibling folders of this checkout
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _import_from(folder, module_name):
+    """
+    Imports a module from one of the provider folders (aws-ai, gcp-ai, ...) of this checkout.
+    """
+    path = os.path.join(REPO_ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return importlib.import_module(module_name)
+
+def create_http_session(pool_size=32):
+    """
+    Creates the keep-alive requests Session shared by every HTTP provider adapter.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+class ProviderError(Exception):
+    """
+    Raised by an adapter when its provider rejects or fails a request.
+    """
+
+def _post_json(session, name, url, headers, payload, timeout):
+    response = session.post(url, headers=headers, json=payload, timeout=timeout)
+    if response.status_code != 200:
+        raise ProviderError(f"{name} returned {response.status_code}: {response.text[:200]}")
+    return response.json()
+
+def _chat_completion_text(body):
+    return "".join(choice.get("message", {}).get("content") or "" for choice in body.get("choices", []))
+
+def _vertex_host(region):
+    return f"{region}-aiplatform.googleapis.com"
+
+# Provider adapters. Each has a name and complete(prompt, max_tokens, temperature) returning the
+# answer text, and raises on failure. HTTP adapters share one session and its connection pool.
+
+class BedrockAdapter:
+    """
+    Amazon Bedrock through invoke_model in aws-ai/bedrock.py, on its cached, pooled bedrock-runtime client.
+    """
+
+    def __init__(self, model_id, region, logger, pool_size=32):
+        self.bedrock = _import_from("aws-ai", "bedrock")
+        self.model_config = self.bedrock.find_model_configuration(model_id)
+        if self.model_config is None:
+            raise ValueError(f"Unknown Bedrock model: {model_id}")
+        self.name = "bedrock"
+        self.model_id = model_id
+        self.logger = logger
+        self.client = self.bedrock.create_bedrock_client(region, logger, pool_size)
+
+    def complete(self, prompt, max_tokens, temperature):
+        model_config = dict(self.model_config, max_tokens=max_tokens, temperature=temperature)
+        generation = self.bedrock.generation_text(self.bedrock.invoke_model(self.client, model_config, self.model_id,
+                                                                            prompt, self.logger, exit_on_error=False))
+        if not generation:
+            raise ProviderError(f"bedrock returned no generation for {self.model_id}")
+        return generation
+
+class VertexGeminiAdapter:
+    """
+    Gemini on Vertex AI (generateContent), authenticated through the shared token cache in gcp-ai.
+    """
+
+    def __init__(self, session, service_account_file, project_id, region, model, timeout=120):
+        self.vertex = _import_from("gcp-ai", "vertex_llama")
+        self.broker = _import_from("gcp-ai", "gcp_auth").get_token_broker(service_account_file)
+        self.url = self.vertex.GEMINI_URL.format(endpoint=_vertex_host(region), region=region, project_id=project_id,
+                                                 model=model)
+        self.name = "gemini"
+        self.session = session
+        self.timeout = timeout
+
+    def complete(self, prompt, max_tokens, temperature):
+        payload = self.vertex.gemini_payload(prompt, max_tokens, temperature)
+        body = _post_json(self.session, self.name, self.url, self.broker.headers(), payload, self.timeout)
+        return self.vertex.gemini_answer(body)[0]
+
+class VertexLlamaAdapter:
+    """
+    Llama on Vertex AI through its OpenAI-compatible chat completions endpoint.
+    """
+
+    def __init__(self, session, service_account_file, project_id, region, model, timeout=120):
+        self.vertex = _import_from("gcp-ai", "vertex_llama")
+        self.broker = _import_from("gcp-ai", "gcp_auth").get_token_broker(service_account_file)
+        self.url = self.vertex.CHAT_COMPLETIONS_URL.format(endpoint=_vertex_host(region), project_id=project_id,
+                                                           region=region)
+        self.name = "llama"
+        self.model = model
+        self.session = session
+        self.timeout = timeout
+
+    def complete(self, prompt, max_tokens, temperature):
+        payload = self.vertex.llama_payload(self.model, prompt, max_tokens, temperature)
+        body = _post_json(self.session, self.name, self.url, self.broker.headers(), payload, self.timeout)
+        return self.vertex.llama_answer(body)[0]
+
+class AzureServerlessAdapter:
+    """
+    An Azure AI serverless endpoint, called the same way as azure-ai/model_testing.py.
+    """
+
+    def __init__(self, session, scoring_uri, api_key, model, timeout=120):
+        self.url = f"{scoring_uri.rstrip('/')}/chat/completions"
+        self.headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+        self.name = "azure"
+        self.model = model
+        self.session = session
+        self.timeout = timeout
+
+    def complete(self, prompt, max_tokens, temperature):
+        payload = {"model": self.model, "messages": [{"role": "user", "content": prompt}],
+                   "max_tokens": max_tokens, "temperature": temperature}
+        return _chat_completion_text(_post_json(self.session, self.name, self.url, self.headers, payload,
+                                                self.timeout))
+
+# One client over several provider adapters in order of preference, with p95 hedging and failover
+class LLMClient:
+
+    def __init__(self, adapters, logger, hedge=True, min_hedge_samples=20, max_hedge_ratio=0.1, max_workers=64,
+                 window=500):
+        if not adapters:
+            raise ValueError("LLMClient needs at least one provider adapter")
+        latency_window = _import_from("aws-ai", "latency_stats").LatencyWindow
+        self.adapters = {adapter.name: adapter for adapter in adapters}
+        self.logger = logger
+        self.hedge = hedge and len(self.adapters) > 1
+        self.max_hedge_ratio = max_hedge_ratio
+        self.requests = 0
+        self.hedged = 0
+        self._stats = {name: {"latencies": latency_window(maxlen=window, min_samples=min_hedge_samples),
+                              "calls": 0, "errors": 0, "wins": 0}
+                       for name in self.adapters}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="provider-hedge")
+
+    def record(self, name, latency, failed):
+        """
+        Records the latency of one call to a provider.
+        """
+        with self._lock:
+            stats = self._stats[name]
+            stats["calls"] += 1
+            if failed:
+                stats["errors"] += 1
+            else:
+                stats["latencies"].add(latency)
+
+    def _hedge_allowed(self):
+        with self._lock:
+            return self.hedged < self.max_hedge_ratio * self.requests
+
+    def _timed(self, name, prompt, max_tokens, temperature):
+        started = time.perf_counter()
+        try:
+            text = self.adapters[name].complete(prompt, max_tokens, temperature)
+        except Exception:
+            self.record(name, time.perf_counter() - started, True)
+            raise
+        self.record(name, time.perf_counter() - started, False)
+        return text
+
+    def complete(self, prompt, max_tokens=256, temperature=0.7, providers=None):
+        """
+        Returns {"provider", "text", "latency_ms", "hedged"} for the first successful answer.
+        providers overrides the order of preference for this call. Raises the last error if
+        every provider failed.
+        """
+        names = list(providers or self.adapters)
+        with self._lock:
+            self.requests += 1
+        started = time.perf_counter()
+        pending = {}
+        index = 0
+        hedged = False
+        last_error = None
+
+        def launch():
+            nonlocal index
+            name = names[index]
+            index += 1
+            future = self._executor.submit(self._timed, name, prompt, max_tokens, temperature)
+            pending[future] = (name, time.perf_counter())
+
+        launch()
+        while pending:
+            timeout = None
+            if self.hedge and index < len(names) and len(pending) == 1:
+                name, launched = next(iter(pending.values()))
+                delay = self._stats[name]["latencies"].hedge_delay()
+                if delay is not None:
+                    timeout = max(delay - (time.perf_counter() - launched), 0)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if self._hedge_allowed():
+                    # The provider is slower than its p95: hedge to the next provider
+                    with self._lock:
+                        self.hedged += 1
+                    hedged = True
+                    self.logger.info(f"Hedging request from {name} to {names[index]}")
+                    launch()
+                else:
+                    # Out of hedge budget: wait for the current provider without a timeout
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, _ = pending.pop(future)
+                try:
+                    text = future.result()
+                except Exception as e:
+                    last_error = e
+                    self.logger.warning(f"Provider {name} failed: {e}")
+                    if not pending and index < len(names):
+                        launch()
+                    continue
+                with self._lock:
+                    self._stats[name]["wins"] += 1
+                return {"provider": name, "text": text, "hedged": hedged,
+                        "latency_ms": round((time.perf_counter() - started) * 1000)}
+        raise last_error
+
+    def snapshot(self):
+        """
+        Returns per-provider call counts, errors, wins and latency percentiles in milliseconds.
+        """
+        with self._lock:
+            stats = {name: dict(values) for name, values in self._stats.items()}
+        snapshot = {}
+        for name, values in stats.items():
+            snapshot[name] = {"calls": values["calls"], "errors": values["errors"], "wins": values["wins"]}
+            for key, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+                latency = values["latencies"].percentile(fraction)
+                snapshot[name][key] = round(latency * 1000) if latency is not None else None
+        return snapshot
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+PROVIDER_NAMES = ("azure", "gemini", "llama", "bedrock")
+
+def build_adapters(names, args, logger):
+    """
+    Builds the adapters for the named providers from the environment (.env) and arguments.
+    """
+    session = create_http_session(args.concurrency * 2)
+    adapters = []
+    for name in names:
+        if name == "bedrock":
+            if not os.getenv("AWS_REGION"):
+                logger.error("AWS_REGION not found in the environment variables.")
+                sys.exit(1)
+            adapters.append(BedrockAdapter(args.bedrock_model, os.getenv("AWS_REGION"), logger,
+                                           args.concurrency * 2))
+        elif name in ("gemini", "llama"):
+            gcp_settings = (os.getenv("GCP_SERVICE_ACCOUNT_FILE"), os.getenv("GCP_PROJECT_ID"),
+                            os.getenv("GCP_REGION_NAME"))
+            if not all(gcp_settings):
+                logger.error("GCP_SERVICE_ACCOUNT_FILE, GCP_PROJECT_ID and GCP_REGION_NAME must be set for Vertex AI.")
+                sys.exit(1)
+            if name == "gemini":
+                adapters.append(VertexGeminiAdapter(session, *gcp_settings, args.gemini_model))
+            else:
+                adapters.append(VertexLlamaAdapter(session, *gcp_settings, args.llama_model))
+        elif name == "azure":
+            scoring_uri = os.getenv("AZURE_ENDPOINT_SCORING_URI")
+            api_key = os.getenv("AZURE_ENDPOINT_PRIMARY_KEY")
+            if not (scoring_uri and api_key):
+                logger.error("AZURE_ENDPOINT_SCORING_URI and AZURE_ENDPOINT_PRIMARY_KEY must be set for Azure.")
+                sys.exit(1)
+            adapters.append(AzureServerlessAdapter(session, scoring_uri, api_key, os.getenv("AZURE_LLM_MODEL")))
+    return adapters
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Send prompts through one hedged client over Bedrock, Vertex AI and Azure")
+    parser.add_argument("--providers", nargs="+", choices=PROVIDER_NAMES, required=True,
+                        help="Providers in order of preference; the first is the primary")
+    parser.add_argument("--prompt", default="What is Buitenzorg?", help="Prompt to send")
+    parser.add_argument("--prompts-file", help="Text file with one prompt per line, sent instead of --prompt")
+    parser.add_argument("--repeat", type=int, default=1, help="Send the prompts this many times (default: 1)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once (default: 4)")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--no-hedge", action="store_true", help="Only fail over on errors, never hedge")
+    parser.add_argument("--hedge-ratio", type=float, default=0.1,
+                        help="Maximum share of requests that may be hedged (default: 0.1)")
+    parser.add_argument("--min-hedge-samples", type=int, default=20,
+                        help="Latency samples needed before a provider's p95 is used (default: 20)")
+    parser.add_argument("--bedrock-model", default=os.getenv("BEDROCK_MODEL_ID", "meta.llama3-70b-instruct-v1:0"))
+    parser.add_argument("--gemini-model", default="gemini-1.0-pro")
+    parser.add_argument("--llama-model", default="meta/llama-3.1-405b-instruct-maas")
+    parser.add_argument("--output", help="Write one JSON line per answer to this file")
+    return parser.parse_args()
+
+def main():
+    from dotenv import load_dotenv
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logger = logging.getLogger("llm_client")
+    load_dotenv()
+    args = parse_arguments()
+
+    if args.prompts_file:
+        with open(args.prompts_file, "r", encoding="utf-8") as prompt_file:
+            prompts = [line.strip() for line in prompt_file if line.strip()]
+    else:
+        prompts = [args.prompt]
+    prompts = prompts * args.repeat
+
+    client = LLMClient(build_adapters(args.providers, args, logger), logger, hedge=not args.no_hedge,
+                       min_hedge_samples=args.min_hedge_samples, max_hedge_ratio=args.hedge_ratio)
+    output_file = open(args.output, "w", encoding="utf-8") if args.output else None
+    started = time.perf_counter()
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(client.complete, prompt, args.max_tokens, args.temperature) for prompt in prompts]
+        for number, future in enumerate(futures, start=1):
+            try:
+                result = future.result()
+            except Exception as e:
+                failures += 1
+                logger.error(f"Prompt {number} failed on every provider: {e}")
+                continue
+            if output_file:
+                output_file.write(json.dumps(dict(result, prompt=prompts[number - 1]), ensure_ascii=False) + "\n")
+            elif len(prompts) == 1:
+                print(result["text"])
+            logger.info(f"Prompt {number}: {result['provider']} in {result['latency_ms']} ms"
+                        f"{' (hedged)' if result['hedged'] else ''}")
+    if output_file:
+        output_file.close()
+    client.close()
+
+    print(f"\n{len(prompts) - failures}/{len(prompts)} answered in {time.perf_counter() - started:.1f} s, "
+          f"{client.hedged} hedged")
+    print(f"{'Provider':<10} {'Calls':>6} {'Errors':>6} {'Wins':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, stats in client.snapshot().items():
+        print(f"{name:<10} {stats['calls']:>6} {stats['errors']:>6} {stats['wins']:>6} "
+              f"{stats['p50_ms'] if stats['p50_ms'] is not None else '-':>8} "
+              f"{stats['p95_ms'] if stats['p95_ms'] is not None else '-':>8} "
+              f"{stats['p99_ms'] if stats['p99_ms'] is not None else '-':>8}")
+
+if __name__ == "__main__":
+    main()